@@ -0,0 +1,316 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+"""End-to-end benchmark of a build on a synthetic dump
+
+Generates a dump with gen_dump.py (unless <dump> already holds one), serves
+its images with image_server.py and runs the build stages as run() does,
+without network access: prepare, users (UsersRender), questions
+(QuestionRender), images (waiting for pending downloads), tags
+(TagsRender), static (copy, redirections) and zim. Reports seconds and
+items/second per stage and appends them, with the parameters and commit,
+to a JSON-lines results file.
+
+Usage:
+  bench_build.py [<dump>] [--questions=<n>] [--users=<n>] [--images=<n>] [--seed=<seed>] [--threads=<n>] [--shards=<n>] [--nopic] [--nozim] [--sharded-layout] [--delay=<s>] [--results=<file>] [--port=<port>]
+
+Options:
+  --questions=<n>       Number of questions of a generated dump [default: 10000]
+  --users=<n>           Number of users of a generated dump [default: 5000]
+  --images=<n>          Mean number of images per post of a generated dump [default: 0.2]
+  --seed=<seed>         Random seed of a generated dump [default: 0]
+  --threads=<n>         Rendering processes [default: 2]
+  --shards=<n>          Question shards [default: 1]
+  --nopic               Don't fetch images
+  --nozim               Write pages to the output tree instead of a ZIM
+  --sharded-layout      Use the sharded layout for the output tree
+  --delay=<s>           Seconds the image server waits before each response [default: 0]
+  --results=<file>      JSON-lines file results are appended to [default: bench_build.jsonl]
+  --port=<port>         Port of the image server [default: 8765]
+"""
+
+import os
+import json
+import time
+import shutil
+import tempfile
+import datetime
+import subprocess
+from xml.sax import make_parser
+
+import mistune
+from docopt import docopt
+from mistune.plugins import plugin_url
+from PIL import Image
+
+import gen_dump
+import image_server
+import sotoki.sotoki as sotoki
+from sotoki import layout, storage, zimsink
+from sotoki.checkpoint import Checkpoint
+from sotoki.downloader import DownloadService
+from sotoki.imagecache import ImageCache
+from sotoki.redirects import RedirectSink
+from sotoki.userdir import UserDirectory
+
+DOMAIN = "example.stackexchange.com"
+TITLE = "Example Stack Exchange"
+
+
+class Stages:
+    """duration of stages, in order"""
+
+    def __init__(self):
+        self.durations = {}
+
+    def run(self, name, func, *args, **kwargs):
+        print(f"--- {name}")
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        self.durations[name] = time.perf_counter() - start
+        return result
+
+
+def parse(path, handler):
+    parser = make_parser()
+    parser.setContentHandler(handler)
+    parser.parse(path)
+
+
+def commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+        ).stdout.strip()
+    except OSError:
+        return None
+
+
+def build(dump, threads, shards, nopic, nozim, sharded, stages):
+    """run the stages of a build of dump"""
+    layout.setup(sharded)
+    sotoki.output_dir = os.path.join(dump, "output")
+    shutil.rmtree(sotoki.output_dir, ignore_errors=True)
+    for path in ("common_images", os.path.join("static", "images")):
+        os.makedirs(os.path.join(sotoki.output_dir, path))
+    for name in ("se-dump.db", "images.db", "checkpoint.db", "prepare.xml"):
+        if os.path.exists(os.path.join(dump, name)):
+            os.remove(os.path.join(dump, name))
+    sotoki.REDIRECTS = RedirectSink(os.path.join(dump, "redirection.csv"))
+    sotoki.REDIRECTS.remove()
+    sotoki.CHECKPOINT = Checkpoint(os.path.join(dump, "checkpoint.db"))
+    sotoki.CHECKPOINT.reset()
+    templates = os.path.join(os.path.dirname(sotoki.__file__), "templates")
+    sotoki.jinja_init(templates, tempfile.mkdtemp())
+    sotoki.MARKDOWN = mistune.Markdown(mistune.HTMLRenderer(), plugins=[plugin_url])
+    magick_tmp = os.path.join(dump, "magick")
+    shutil.rmtree(magick_tmp, ignore_errors=True)
+    os.makedirs(magick_tmp)
+    os.environ.update({"MAGICK_TEMPORARY_PATH": magick_tmp})
+    Image.new("RGB", (48, 48), (255, 128, 0)).save(
+        os.path.join(sotoki.output_dir, "favicon.png")
+    )
+
+    stages.run("prepare", sotoki.prepare_dump, dump)
+
+    conn = sotoki.open_db(os.path.join(dump, "se-dump.db"))
+    conn.row_factory = sotoki.dict_factory
+    cursor = conn.cursor()
+    cursor.execute(sotoki.QUESTIONTAG_SCHEMA)
+    cursor.execute(
+        "CREATE TABLE users(id INTEGER PRIMARY KEY UNIQUE, DisplayName TEXT, Reputation TEXT)"
+    )
+    cursor.execute("CREATE TABLE links(id INTEGER, title TEXT)")
+    conn.commit()
+    if not nozim:
+        zim_name = sotoki.start_zim(
+            DOMAIN,
+            "en",
+            os.path.join(dump, "bench.zim"),
+            False,
+            nopic,
+            zimsink.NB_WORKERS,
+            zimsink.CLUSTER_SIZE,
+        )
+    if not nopic:
+        sotoki.IMAGE_CACHE = ImageCache(os.path.join(dump, "images.db"))
+        sotoki.IMAGE_SERVICE = DownloadService(
+            sotoki.fetch_image,
+            initializer=sotoki.image_service_init,
+            finalizer=sotoki.image_service_done,
+        )
+        sotoki.IMAGE_SERVICE.start()
+
+    users = UserDirectory()
+    stages.run(
+        "users",
+        parse,
+        os.path.join(dump, "usersbadges.xml"),
+        sotoki.UsersRender(
+            templates,
+            TITLE,
+            "Kiwix",
+            dump,
+            threads,
+            cursor,
+            conn,
+            users,
+            "https://" + DOMAIN,
+            True,
+            nopic,
+            False,
+            False,
+            False,
+            DOMAIN,
+        ),
+    )
+    conn.commit()
+
+    question_args = dict(
+        templates=templates,
+        title=TITLE,
+        publisher="Kiwix",
+        users=users,
+        site_url="https://" + DOMAIN,
+        domain=DOMAIN,
+        mathjax=True,
+        nopic=nopic,
+        nouserprofile=False,
+        noexternallink=False,
+        no_unansweredquestion=False,
+    )
+    if shards > 1:
+        stages.run(
+            "questions", sotoki.render_question_shards, dump, conn, shards, question_args
+        )
+    else:
+        stages.run(
+            "questions",
+            parse,
+            os.path.join(dump, "prepare.xml"),
+            sotoki.QuestionRender(
+                dump=dump, cores=threads, cursor=cursor, conn=conn, **question_args
+            ),
+        )
+    conn.commit()
+
+    if not nopic:
+        stages.run("images", sotoki.IMAGE_SERVICE.close)
+        sotoki.IMAGE_SERVICE = None
+
+    stages.run(
+        "tags",
+        parse,
+        os.path.join(dump, "Tags.xml"),
+        sotoki.TagsRender(
+            templates,
+            TITLE,
+            "Kiwix",
+            dump,
+            threads,
+            cursor,
+            conn,
+            -1,
+            "A synthetic site",
+            True,
+        ),
+    )
+    conn.close()
+
+    def static():
+        for name in ("static_mathjax", "static"):
+            storage.link_tree(
+                os.path.join(os.path.dirname(sotoki.__file__), name),
+                os.path.join(sotoki.output_dir, "static"),
+            )
+        sotoki.REDIRECTS.merge()
+
+    stages.run("static", static)
+    if not nozim:
+        stages.run(
+            "zim",
+            sotoki.create_zim,
+            TITLE,
+            "A synthetic site",
+            "en",
+            "Kiwix",
+            zim_name,
+            nopic,
+            sotoki.SCRAPER,
+            DOMAIN,
+        )
+
+
+def main():
+    arguments = docopt(__doc__)
+    dump = arguments["<dump>"] or tempfile.mkdtemp(prefix="sotoki-bench-")
+    port = int(arguments["--port"])
+    params = dict(
+        questions=int(arguments["--questions"]),
+        users=int(arguments["--users"]),
+        images=float(arguments["--images"]),
+        seed=int(arguments["--seed"]),
+    )
+    counts_path = os.path.join(dump, "counts.json")
+    if not os.path.exists(counts_path):
+        print(f"Generating dump in {dump}")
+        counts = gen_dump.generate(
+            dump, image_host=f"http://127.0.0.1:{port}", domain=DOMAIN, **params
+        )
+        with open(counts_path, "w") as fh:
+            json.dump(dict(counts=counts, params=params), fh)
+    with open(counts_path) as fh:
+        generated = json.load(fh)
+    counts = generated["counts"]
+
+    server = None
+    if not arguments["--nopic"]:
+        server = image_server.serve(port, delay=float(arguments["--delay"]))
+    stages = Stages()
+    try:
+        build(
+            dump,
+            int(arguments["--threads"]),
+            int(arguments["--shards"]),
+            arguments["--nopic"],
+            arguments["--nozim"],
+            arguments["--sharded-layout"],
+            stages,
+        )
+    finally:
+        if server is not None:
+            server.shutdown()
+
+    items = dict(
+        prepare=counts["questions"] + counts["answers"] + counts["comments"],
+        users=counts["users"],
+        questions=counts["questions"],
+        images=counts["images"],
+        tags=counts["tags"],
+    )
+    result = dict(
+        date=datetime.datetime.now().isoformat(timespec="seconds"),
+        commit=commit(),
+        params=generated["params"],
+        counts=counts,
+        options={
+            name: arguments[f"--{name}"]
+            for name in ("threads", "shards", "nopic", "nozim", "sharded-layout", "delay")
+        },
+        stages={name: round(duration, 3) for name, duration in stages.durations.items()},
+    )
+    print()
+    for name, duration in stages.durations.items():
+        rate = f"{items[name] / duration:10.0f} items/s" if name in items else ""
+        print(f"{name:>10}: {duration:8.2f}s {rate}")
+    print(f"{'total':>10}: {sum(stages.durations.values()):8.2f}s")
+    with open(arguments["--results"], "a") as fh:
+        fh.write(json.dumps(result) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+"""Benchmark of the question phase parser to workers channel
+
+Usage: python benchmarks/bench_channel.py [nb_questions] [nb_workers] [queue_depth]
+
+Sends nb_questions (default 200000) synthetic questions (with answers and
+comments) to nb_workers (default 4) processes doing nothing with them and
+reports messages/second for the former one-list-per-question queue of
+depth workers*2 (function and all arguments pickled with every question)
+and for the batched TaskChannel."""
+
+import sys
+import time
+from multiprocessing import Process, Queue
+
+from sotoki.channel import TaskChannel, QUEUE_DEPTH
+
+CONFIG = dict(
+    templates="/usr/lib/python3/site-packages/sotoki/templates",
+    title="Stack Overflow",
+    publisher="Kiwix",
+    template_name="question.html",
+    site_url="https://stackoverflow.com",
+    domain="stackoverflow.com",
+    mathjax=True,
+    nopic=False,
+    nouserprofile=False,
+    noexternallink=False,
+)
+
+
+def make_question(ident):
+    body = "<p>" + "Lorem ipsum dolor sit amet, consectetur adipiscing. " * 30 + "</p>"
+    comments = [
+        {"Id": str(ident * 10 + i), "Text": "a comment " * 10, "Score": "1"}
+        for i in range(3)
+    ]
+    return {
+        "Id": str(ident),
+        "Title": f"Question {ident}",
+        "Body": body,
+        "Score": "12",
+        "Tags": ["python", "multiprocessing"],
+        "comments": comments,
+        "answers": [
+            {"Id": str(ident * 100 + i), "Body": body, "Score": i, "comments": comments}
+            for i in range(3)
+        ],
+    }
+
+
+def render(question, **config):
+    pass
+
+
+def legacy_render(templates, title, publisher, question, *args):
+    pass
+
+
+class LegacyWorker(Process):
+    def __init__(self, queue):
+        super(LegacyWorker, self).__init__()
+        self.queue = queue
+
+    def run(self):
+        for data in iter(self.queue.get, None):
+            data[0](*data[1:])
+
+
+def legacy(questions, nb_workers, queue_depth):
+    queue = Queue(nb_workers * 2)
+    workers = [LegacyWorker(queue) for i in range(nb_workers)]
+    for worker in workers:
+        worker.start()
+    flags = list(CONFIG.values())[3:]
+    for question in questions:
+        queue.put(
+            [legacy_render, CONFIG["templates"], CONFIG["title"], CONFIG["publisher"]]
+            + [question]
+            + flags
+        )
+    for worker in workers:
+        queue.put(None)
+    for worker in workers:
+        worker.join()
+
+
+def batched(questions, nb_workers, queue_depth):
+    channel = TaskChannel(render, CONFIG, nb_workers, depth=queue_depth)
+    for question in questions:
+        channel.put(question)
+    channel.close()
+
+
+def main():
+    nb_questions = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    nb_workers = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    queue_depth = int(sys.argv[3]) if len(sys.argv) > 3 else QUEUE_DEPTH
+    questions = [make_question(ident) for ident in range(nb_questions)]
+    for name, func in [("per question", legacy), ("batched", batched)]:
+        start = time.perf_counter()
+        func(questions, nb_workers, queue_depth)
+        duration = time.perf_counter() - start
+        print(
+            f"{name:>12}: {nb_questions / duration:10.0f} messages/s "
+            f"({duration / nb_questions * 1e6:.1f} µs/message)"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+"""Micro-benchmark of the prepare stage row joiners
+
+Usage: python benchmarks/bench_prepare.py [nb_rows] [workdir]
+
+Writes a synthetic Comments.xml of nb_rows (default 10M) rows then reports
+lines/second for the former merge_* approach (re.sub + split + str +=),
+the lxml iterparse path and the byte-level scanner fast path."""
+
+import os
+import re
+import sys
+import time
+import tempfile
+
+from sotoki.prepare_xml import iter_parsed_rows, iter_rows, row_xml, POST_ID, ID
+
+
+def write_dump(path, nb_rows):
+    with open(path, "wb", buffering=16 * 1024 * 1024) as fh:
+        fh.write(b'<?xml version="1.0" encoding="utf-8"?>\r\n<comments>\r\n')
+        for ident in range(1, nb_rows + 1):
+            fh.write(
+                b'  <row Id="%d" PostId="%d" Score="%d" Text="Comment number %d '
+                b'with &lt;b&gt;some&lt;/b&gt; text" CreationDate="2020-01-01T00:00:00.000"'
+                b' UserId="%d" />\r\n' % (ident, ident // 3, ident % 7, ident, ident % 1000)
+            )
+        fh.write(b"</comments>\r\n")
+
+
+def legacy(path):
+    """what merge_comments_and_postsanswers.py did for each comment line"""
+    comments = ""
+    with open(path, "r") as fh:
+        for line in fh:
+            if "<row" not in line:
+                continue
+            line.split('"')[3]
+            comments += re.sub("<row", "<comment", re.sub("\n$", "", line))
+            if len(comments) > 1000000:
+                comments = ""
+
+
+def parsed(path):
+    chunk = []
+    for line in iter_parsed_rows(path):
+        (int(POST_ID(line)), int(ID(line)))
+        chunk.append(row_xml(line, b"comment"))
+        if len(chunk) > 10000:
+            b"".join(chunk)
+            chunk = []
+
+
+def fast(path):
+    chunk = []
+    for line in iter_rows(path):
+        (int(POST_ID(line)), int(ID(line)))
+        chunk.append(row_xml(line, b"comment"))
+        if len(chunk) > 10000:
+            b"".join(chunk)
+            chunk = []
+
+
+def main():
+    nb_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 10000000
+    workdir = sys.argv[2] if len(sys.argv) > 2 else None
+    path = tempfile.mkstemp(suffix=".xml", dir=workdir)[1]
+    try:
+        write_dump(path, nb_rows)
+        for name, func in [("legacy", legacy), ("iterparse", parsed), ("fast", fast)]:
+            start = time.perf_counter()
+            func(path)
+            duration = time.perf_counter() - start
+            print(f"{name:>10}: {nb_rows / duration:12.0f} lines/s ({duration:.1f}s)")
+    finally:
+        os.remove(path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+"""Benchmark of the post HTML rewriting (links and images)
+
+Usage: python benchmarks/bench_rewrite.py <Posts.xml or Comments.xml> [nb_posts]
+
+Takes the first nb_posts (default 100000) bodies/texts of a real dump file
+and reports posts/second for the former two passes (interne_link then image,
+each parsing and serializing) and the single rewrite_html pass.
+Images are not fetched (nopic)."""
+
+import sys
+import time
+import tempfile
+
+from lxml import etree
+
+import sotoki.sotoki as sotoki
+from sotoki.prepare_xml import iter_rows
+
+
+def two_passes(text_post, domain):
+    body = sotoki.string2html(text_post)
+    if sotoki.interne_link(body, domain, False, False):
+        text_post = sotoki.html2string(body, method="html", encoding="unicode")
+    body = sotoki.string2html(text_post)
+    if sotoki.image(body, True):
+        text_post = sotoki.html2string(body, method="html", encoding="unicode")
+    return text_post
+
+
+def single_pass(text_post, domain):
+    return sotoki.rewrite_html(text_post, domain, False, False, True)
+
+
+def main():
+    path = sys.argv[1]
+    nb_posts = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+    sotoki.output_dir = tempfile.mkdtemp()
+    texts = []
+    for line in iter_rows(path):
+        row = etree.fromstring(line)
+        text = row.get("Body", row.get("Text"))
+        if text:
+            texts.append(text)
+        if len(texts) >= nb_posts:
+            break
+    for name, func in [("two passes", two_passes), ("single pass", single_pass)]:
+        start = time.perf_counter()
+        for text in texts:
+            func(text, "stackoverflow.com")
+        duration = time.perf_counter() - start
+        print(
+            f"{name:>12}: {len(texts) / duration:10.0f} posts/s "
+            f"({duration / len(texts) * 1e6:.1f} µs/post)"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+"""Benchmark of question pages rendering
+
+Usage: python benchmarks/bench_templates.py [nb_pages] [nb_answers]
+
+Renders nb_pages (default 20000) synthetic questions with nb_answers
+(default 5) answers to files and reports pages/second for the former
+environment (get_template with auto-reload checks for every page, whole
+page rendered to a string then written) and for the jinja() layer
+(templates compiled once, page streamed to the file)."""
+
+import os
+import sys
+import time
+import tempfile
+
+from jinja2 import Environment, FileSystemLoader
+
+import sotoki.sotoki as sotoki
+
+TEMPLATES = os.path.join(os.path.dirname(sotoki.__file__), "templates")
+
+
+def make_post(ident, score):
+    return {
+        "Id": str(ident),
+        "Score": score,
+        "FavoriteCount": 3,
+        "Body": "<p>" + "Lorem ipsum dolor sit amet, consectetur adipiscing. " * 30,
+        "OwnerUserId": {
+            "Id": 42,
+            "Path": "42/someone",
+            "DisplayName": "someone",
+            "Reputation": 12345,
+        },
+        "comments": [
+            {
+                "Score": 2,
+                "Text": "a comment " * 10,
+                "Path": "43/other",
+                "UserDisplayName": "other",
+                "CreationDate": "2020-01-01T00:00:00.000",
+            }
+            for _ in range(3)
+        ],
+    }
+
+
+def make_question(ident, nb_answers):
+    question = make_post(ident, 12)
+    question.update(
+        Title=f"Question {ident}",
+        Tags=["python", "jinja"],
+        CreationDate="2020-01-01T00:00:00.000",
+        LastActivityDate="2020-01-02T00:00:00.000",
+        ViewCount=1234,
+        answers=[make_post(ident * 100 + i, i) for i in range(nb_answers)],
+        relateds=[{"PostId": 1, "PostName": "related"}],
+    )
+    return question
+
+
+def context(question):
+    return dict(
+        question=question,
+        rooturl="..",
+        title="Stack Overflow",
+        publisher="Kiwix",
+        site_url="https://stackoverflow.com",
+        mathjax=True,
+        nopic=False,
+    )
+
+
+def former(questions, outdir):
+    env = Environment(loader=FileSystemLoader((TEMPLATES,)))
+    env.filters.update(sotoki.ENV.filters)
+    for question in questions:
+        page = env.get_template("question.html").render(**context(question))
+        with open(os.path.join(outdir, question["Id"]), "w") as fh:
+            fh.write(page)
+
+
+def current(questions, outdir):
+    for question in questions:
+        sotoki.jinja(
+            os.path.join(outdir, question["Id"]),
+            "question.html",
+            TEMPLATES,
+            False,
+            **context(question),
+        )
+
+
+def main():
+    nb_pages = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    nb_answers = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    sotoki.jinja_init(TEMPLATES, tempfile.mkdtemp())
+    questions = [make_question(ident, nb_answers) for ident in range(nb_pages)]
+    for name, func in [("former", former), ("jinja()", current)]:
+        outdir = tempfile.mkdtemp()
+        start = time.perf_counter()
+        func(questions, outdir)
+        duration = time.perf_counter() - start
+        print(
+            f"{name:>8}: {nb_pages / duration:8.0f} pages/s "
+            f"({duration / nb_pages * 1e3:.2f} ms/page)"
+        )
+
+
+if __name__ == "__main__":
+    main()
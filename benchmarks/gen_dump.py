@@ -0,0 +1,355 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+"""Synthetic Stack Exchange dump
+
+Writes Posts.xml, Comments.xml, Users.xml, Badges.xml, Tags.xml and
+PostLinks.xml in the schema and layout (one row per line, Id order) of the
+published dumps. Images of posts and user profiles point to image-host,
+served by image_server.py; some URLs differ only by their query string so
+that identical images are downloaded under different URLs.
+
+Usage:
+  gen_dump.py <directory> [--questions=<n>] [--answers=<n>] [--comments=<n>] [--users=<n>] [--tags=<n>] [--tags-per-question=<n>] [--tag-skew=<s>] [--images=<n>] [--links=<n>] [--words=<n>] [--image-host=<url>] [--domain=<domain>] [--seed=<seed>]
+
+Options:
+  --questions=<n>           Number of questions [default: 10000]
+  --answers=<n>             Mean number of answers per question [default: 2]
+  --comments=<n>            Mean number of comments per post [default: 1.5]
+  --users=<n>               Number of users [default: 5000]
+  --tags=<n>                Number of tags [default: 500]
+  --tags-per-question=<n>   Maximum number of tags of a question [default: 5]
+  --tag-skew=<s>            Exponent of the (Zipf) popularity of tags [default: 1.1]
+  --images=<n>              Mean number of images per post [default: 0.2]
+  --links=<n>               Mean number of links per post [default: 0.5]
+  --words=<n>               Mean number of words of a post body [default: 120]
+  --image-host=<url>        Base URL of images [default: http://127.0.0.1:8765]
+  --domain=<domain>         Domain of the site internal links point to [default: example.stackexchange.com]
+  --seed=<seed>             Random seed, the same seed gives the same dump [default: 0]
+"""
+
+import os
+import sys
+import html
+import json
+import bisect
+import random
+import datetime
+import itertools
+
+from docopt import docopt
+
+BUFFER_SIZE = 16 * 1024 * 1024
+START = datetime.datetime(2010, 1, 1)
+HEADER = '<?xml version="1.0" encoding="utf-8"?>\r\n<{}>\r\n'
+WORDS = (
+    "the of and to in is that for it as with was on be by this are or from at "
+    "which an not have has but can all one use value function file error data "
+    "list string class object method return type code query server client test "
+    "variable array number loop index table column row key map set thread lock"
+).split()
+NAMES = ["José", "Zoë", "Łukasz", "Søren", "Ahmed", "Mei", "Olga", "Kwame", "Ana"]
+BADGES = ["Teacher", "Student", "Editor", "Supporter", "Scholar", "Autobiographer"]
+CODE = "for (int i = 0; i &lt; n; i++) {\n    total += values[i];\n}"
+
+
+def count(rng, mean):
+    """random number of items, mean on average with a long tail"""
+    if mean <= 0:
+        return 0
+    return int(rng.expovariate(1 / mean) + 0.5)
+
+
+def date(seconds):
+    return (START + datetime.timedelta(seconds=seconds)).strftime(
+        "%Y-%m-%dT%H:%M:%S.%f"
+    )[:-3]
+
+
+def row(**attrs):
+    return "  <row {} />\r\n".format(
+        " ".join(
+            '{}="{}"'.format(
+                name, html.escape(str(value), quote=True).replace("\n", "&#xA;")
+            )
+            for name, value in attrs.items()
+            if value is not None
+        )
+    )
+
+
+class Generator:
+    def __init__(
+        self,
+        questions=10000,
+        answers=2,
+        comments=1.5,
+        users=5000,
+        tags=500,
+        tags_per_question=5,
+        tag_skew=1.1,
+        images=0.2,
+        links=0.5,
+        words=120,
+        image_host="http://127.0.0.1:8765",
+        domain="example.stackexchange.com",
+        seed=0,
+    ):
+        self.rng = random.Random(seed)
+        self.nb_questions = questions
+        self.answers = answers
+        self.comments = comments
+        self.nb_users = users
+        self.tags = ["tag-{}".format(index) for index in range(tags)]
+        self.tags_per_question = tags_per_question
+        weights = [1 / (rank + 1) ** tag_skew for rank in range(tags)]
+        self.tag_weights = list(itertools.accumulate(weights))
+        self.images = images
+        self.links = links
+        self.words = words
+        self.image_host = image_host.rstrip("/")
+        self.domain = domain
+        self.question_ids = []
+        self.tag_counts = {}
+        self.nb_images = 0
+
+    def user_id(self):
+        return self.rng.randint(1, self.nb_users)
+
+    def pick_tags(self):
+        tags = set()
+        for _ in range(self.rng.randint(1, self.tags_per_question)):
+            point = self.rng.random() * self.tag_weights[-1]
+            tags.add(self.tags[bisect.bisect_left(self.tag_weights, point)])
+        return sorted(tags)
+
+    def image_url(self):
+        self.nb_images += 1
+        # images are reused across posts, some under another URL
+        ident = self.rng.randint(1, max(self.nb_questions, 10))
+        ext = self.rng.choice(("png", "png", "jpg"))
+        url = f"{self.image_host}/images/{ident}.{ext}"
+        if self.rng.random() < 0.1:
+            url += f"?s={self.rng.randint(1, 9)}"
+        return url
+
+    def link(self):
+        kind = self.rng.random()
+        if kind < 0.5 and self.question_ids:
+            qid = self.rng.choice(self.question_ids)
+            return f"https://{self.domain}/questions/{qid}/some-title"
+        if kind < 0.6:
+            uid = self.user_id()
+            return f"https://{self.domain}/users/{uid}/someone"
+        if kind < 0.7:
+            return f"/questions/tagged/{self.rng.choice(self.tags)}"
+        return f"https://example.org/page/{self.rng.randint(1, 1000)}"
+
+    def text(self, nb_words):
+        return " ".join(self.rng.choice(WORDS) for _ in range(max(nb_words, 1)))
+
+    def body(self):
+        parts = []
+        nb_words = count(self.rng, self.words)
+        while nb_words > 0:
+            size = min(nb_words, self.rng.randint(20, 60))
+            parts.append(f"<p>{self.text(size)}</p>")
+            nb_words -= size
+            if self.rng.random() < 0.2:
+                parts.append(f"<pre><code>{CODE}</code></pre>")
+        for _ in range(count(self.rng, self.links)):
+            parts.insert(
+                self.rng.randint(0, len(parts)),
+                f'<p>See <a href="{self.link()}">{self.text(3)}</a></p>',
+            )
+        for _ in range(count(self.rng, self.images)):
+            parts.insert(
+                self.rng.randint(0, len(parts)),
+                f'<p><img src="{self.image_url()}" alt="{self.text(2)}"></p>',
+            )
+        return "\n\n".join(parts)
+
+    def comment_text(self):
+        text = self.text(count(self.rng, 25))
+        if self.rng.random() < 0.1:
+            text += f" [link]({self.link()})"
+        return text
+
+    def write(self, directory):
+        """write the dump files in directory, returns counts of items"""
+        os.makedirs(directory, exist_ok=True)
+        files = {
+            name: open(
+                os.path.join(directory, f"{name}.xml"),
+                "w",
+                encoding="utf-8",
+                buffering=BUFFER_SIZE,
+            )
+            for name in ("Posts", "Comments", "PostLinks", "Users", "Badges", "Tags")
+        }
+        for name, fh in files.items():
+            fh.write(HEADER.format(name.lower()))
+        counts = dict(questions=0, answers=0, comments=0, postlinks=0, badges=0)
+        post_id = comment_id = link_id = 0
+        for _ in range(self.nb_questions):
+            post_id += 1
+            question_id = post_id
+            tags = self.pick_tags()
+            for tag in tags:
+                self.tag_counts[tag] = self.tag_counts.get(tag, 0) + 1
+            nb_answers = count(self.rng, self.answers)
+            answer_ids = list(range(post_id + 1, post_id + 1 + nb_answers))
+            accepted = self.rng.choice(answer_ids) if answer_ids else None
+            posts = [
+                dict(
+                    Id=question_id,
+                    PostTypeId=1,
+                    AcceptedAnswerId=accepted if self.rng.random() < 0.5 else None,
+                    CreationDate=date(question_id * 60),
+                    Score=count(self.rng, 5) - 1,
+                    ViewCount=count(self.rng, 500),
+                    Body=self.body(),
+                    OwnerUserId=self.user_id(),
+                    LastActivityDate=date(question_id * 60 + 3600),
+                    Title=self.text(self.rng.randint(4, 12)).capitalize() + "?",
+                    Tags="".join(f"<{tag}>" for tag in tags),
+                    AnswerCount=nb_answers,
+                    CommentCount=0,
+                    FavoriteCount=count(self.rng, 1),
+                )
+            ]
+            for answer_id in answer_ids:
+                owner = self.user_id()
+                posts.append(
+                    dict(
+                        Id=answer_id,
+                        PostTypeId=2,
+                        ParentId=question_id,
+                        CreationDate=date(answer_id * 60),
+                        Score=count(self.rng, 3) - 1,
+                        Body=self.body(),
+                        OwnerUserId=owner if self.rng.random() < 0.95 else None,
+                        OwnerDisplayName=None if owner else self.text(1),
+                        LastActivityDate=date(answer_id * 60 + 600),
+                        CommentCount=0,
+                    )
+                )
+            for post in posts:
+                for _ in range(count(self.rng, self.comments)):
+                    comment_id += 1
+                    files["Comments"].write(
+                        row(
+                            Id=comment_id,
+                            PostId=post["Id"],
+                            Score=count(self.rng, 1),
+                            Text=self.comment_text(),
+                            CreationDate=date(post["Id"] * 60 + comment_id % 60),
+                            UserId=self.user_id(),
+                        )
+                    )
+                    post["CommentCount"] += 1
+                    counts["comments"] += 1
+                files["Posts"].write(row(**post))
+            if self.question_ids and self.rng.random() < 0.1:
+                link_id += 1
+                files["PostLinks"].write(
+                    row(
+                        Id=link_id,
+                        CreationDate=date(question_id * 60),
+                        PostId=question_id,
+                        RelatedPostId=self.rng.choice(self.question_ids),
+                        LinkTypeId=self.rng.choice((1, 1, 1, 3)),
+                    )
+                )
+                counts["postlinks"] += 1
+            self.question_ids.append(question_id)
+            post_id += nb_answers
+            counts["questions"] += 1
+            counts["answers"] += nb_answers
+
+        badge_id = 0
+        for user_id in [-1] + list(range(1, self.nb_users + 1)):
+            name = (
+                "Community"
+                if user_id == -1
+                else "{} {}".format(self.rng.choice(NAMES), user_id)
+            )
+            files["Users"].write(
+                row(
+                    Id=user_id,
+                    Reputation=count(self.rng, 1000) + 1,
+                    CreationDate=date(user_id * 30),
+                    DisplayName=name,
+                    LastAccessDate=date(user_id * 30 + 86400),
+                    WebsiteUrl="https://example.org" if user_id % 3 == 0 else None,
+                    Location="Somewhere" if user_id % 2 == 0 else None,
+                    AboutMe=f"<p>{self.text(count(self.rng, 30))}</p>",
+                    Views=count(self.rng, 100),
+                    UpVotes=count(self.rng, 50),
+                    DownVotes=count(self.rng, 5),
+                    ProfileImageUrl=f"{self.image_host}/avatars/{user_id}.png"
+                    if user_id > 0 and self.rng.random() < 0.3
+                    else None,
+                    AccountId=user_id + 1000,
+                )
+            )
+            for _ in range(count(self.rng, 1)):
+                badge_id += 1
+                files["Badges"].write(
+                    row(
+                        Id=badge_id,
+                        UserId=user_id,
+                        Name=self.rng.choice(BADGES),
+                        Date=date(user_id * 30 + badge_id),
+                        Class=self.rng.randint(1, 3),
+                        TagBased="False",
+                    )
+                )
+                counts["badges"] += 1
+
+        for tag_id, tag in enumerate(self.tags, 1):
+            files["Tags"].write(
+                row(Id=tag_id, TagName=tag, Count=self.tag_counts.get(tag, 0))
+            )
+
+        for name, fh in files.items():
+            fh.write(f"</{name.lower()}>\r\n")
+            fh.close()
+        counts.update(
+            users=self.nb_users + 1,
+            tags=sum(1 for tag in self.tags if self.tag_counts.get(tag)),
+            images=self.nb_images,
+        )
+        return counts
+
+
+def generate(directory, **params):
+    """write a synthetic dump in directory, returns counts of items"""
+    return Generator(**params).write(directory)
+
+
+def main():
+    arguments = docopt(__doc__)
+    counts = generate(
+        arguments["<directory>"],
+        questions=int(arguments["--questions"]),
+        answers=float(arguments["--answers"]),
+        comments=float(arguments["--comments"]),
+        users=int(arguments["--users"]),
+        tags=int(arguments["--tags"]),
+        tags_per_question=int(arguments["--tags-per-question"]),
+        tag_skew=float(arguments["--tag-skew"]),
+        images=float(arguments["--images"]),
+        links=float(arguments["--links"]),
+        words=int(arguments["--words"]),
+        image_host=arguments["--image-host"],
+        domain=arguments["--domain"],
+        seed=int(arguments["--seed"]),
+    )
+    json.dump(counts, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == "__main__":
+    main()
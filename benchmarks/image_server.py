@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+"""Stand-in HTTP server for synthetic dumps
+
+Usage: python benchmarks/image_server.py [port] [directory] [delay]
+
+Serves generated images at /images/<n>.<png|jpg|gif> and
+/avatars/<n>.png (the content only depends on n and the format, query
+strings are ignored) and the files of directory (if any) at /files/<name>,
+with single Range requests support, e.g. a dump archive. Responses carry
+an ETag and are delayed by delay seconds (default 0) to mimic a remote
+host. Listens on 127.0.0.1:port (default 8765)."""
+
+import io
+import os
+import sys
+import time
+import random
+import hashlib
+import functools
+import threading
+import urllib.parse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from PIL import Image, ImageDraw
+
+PORT = 8765
+FORMATS = {
+    "png": ("PNG", "image/png"),
+    "jpg": ("JPEG", "image/jpeg"),
+    "gif": ("GIF", "image/gif"),
+}
+CHUNK_SIZE = 1024 * 1024
+
+
+@functools.lru_cache(maxsize=4096)
+def make_image(ident, ext):
+    """bytes of the image ident in format ext, always the same"""
+    rng = random.Random(ident)
+    size = (rng.randint(64, 1200), rng.randint(64, 900))
+    image = Image.new("RGB", size, tuple(rng.randint(0, 255) for _ in range(3)))
+    draw = ImageDraw.Draw(image)
+    for _ in range(rng.randint(5, 40)):
+        x, y = rng.randint(0, size[0]), rng.randint(0, size[1])
+        draw.rectangle(
+            (x, y, x + rng.randint(5, 300), y + rng.randint(5, 200)),
+            fill=tuple(rng.randint(0, 255) for _ in range(3)),
+        )
+    out = io.BytesIO()
+    image.save(out, FORMATS[ext][0])
+    return out.getvalue()
+
+
+def parse_range(header, size):
+    """(start, end) included of a single bytes range header, None if invalid"""
+    if not header.startswith("bytes=") or "," in header:
+        return None
+    start, _, end = header[6:].partition("-")
+    if not start:  # last bytes
+        if not end or int(end) == 0:
+            return None
+        return max(size - int(end), 0), size - 1
+    start = int(start)
+    end = min(int(end), size - 1) if end else size - 1
+    if start > end:
+        return None
+    return start, end
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, as image hosts
+
+    def do_HEAD(self):
+        self.handle_request(body=False)
+
+    def do_GET(self):
+        self.handle_request(body=True)
+
+    def handle_request(self, body):
+        if self.server.delay:
+            time.sleep(self.server.delay)
+        path = urllib.parse.urlparse(self.path).path
+        parts = path.strip("/").split("/")
+        if len(parts) == 2 and parts[0] in ("images", "avatars"):
+            ident, _, ext = parts[1].partition(".")
+            if not ident.isdigit() or ext not in FORMATS:
+                return self.send_error(404)
+            data = make_image(int(ident), ext)
+            self.send_data(data, FORMATS[ext][1], body)
+        elif len(parts) == 2 and parts[0] == "files" and self.server.directory:
+            fpath = os.path.join(self.server.directory, os.path.basename(parts[1]))
+            if not os.path.isfile(fpath):
+                return self.send_error(404)
+            self.send_file(fpath, body)
+        else:
+            self.send_error(404)
+
+    def send_data(self, data, mimetype, body):
+        etag = '"{}"'.format(hashlib.sha1(data).hexdigest())
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", mimetype)
+        self.send_header("Content-Length", str(len(data)))
+        self.send_header("ETag", etag)
+        self.end_headers()
+        if body:
+            self.wfile.write(data)
+
+    def send_file(self, fpath, body):
+        size = os.path.getsize(fpath)
+        start, end = 0, size - 1
+        header = self.headers.get("Range")
+        if header:
+            byte_range = parse_range(header, size)
+            if byte_range is None:
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{size}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            start, end = byte_range
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        else:
+            self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("ETag", '"{}-{}"'.format(size, int(os.path.getmtime(fpath))))
+        self.end_headers()
+        if not body:
+            return
+        with open(fpath, "rb") as fh:
+            fh.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                chunk = fh.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                self.wfile.write(chunk)
+                remaining -= len(chunk)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(port=PORT, directory=None, delay=0):
+    """start the server in a thread, returns it (shutdown() to stop)"""
+    server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+    server.daemon_threads = True
+    server.directory = directory
+    server.delay = delay
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else PORT
+    directory = sys.argv[2] if len(sys.argv) > 2 else None
+    delay = float(sys.argv[3]) if len(sys.argv) > 3 else 0
+    server = serve(port, directory, delay)
+    print(f"Serving on http://127.0.0.1:{server.server_address[1]}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+"""Parser to worker processes task channel
+
+A rendering phase calls the same function with the same arguments
+(templates, title, flags…) for every item; only the item changes.
+Those arguments are given once to the workers when they start (inherited
+through fork) and messages only carry items, grouped in batches to reduce
+pickling and queue synchronisation per item.
+
+Batches are numbered and workers publish the one they are processing so
+the channel knows up to which item everything has been processed."""
+
+import time
+import collections
+from multiprocessing import Process, Queue, Array, Value, Lock
+
+from . import memory
+from . import metrics
+from . import profiling
+
+BATCH_SIZE = 16  # items per message
+QUEUE_DEPTH = 4  # batches waiting, per worker
+IDLE = -1
+
+
+class Worker(Process):
+    """Process calling func(*item, **config) for items of received batches"""
+
+    def __init__(self, queue, func, config, index, progress, taken, lock):
+        super(Worker, self).__init__()
+        self.queue = queue
+        self.lock = lock
+        self.func = func
+        self.config = config
+        self.index = index
+        self.progress = progress
+        self.taken = taken
+
+    def run(self):
+        with profiling.profiled(f"{self.func.__name__}-{self.index}"):
+            self._run()
+
+    def _run(self):
+        while True:
+            # taken and published at once: batches before the last taken
+            # one are either in progress or processed
+            with self.lock:
+                message = self.queue.get()
+                if message is None:
+                    break
+                seq, batch = message
+                self.progress[self.index] = seq
+                self.taken.value = seq
+            for item in batch:
+                start = time.perf_counter()
+                try:
+                    self.func(*item, **self.config)
+                except Exception as exc:
+                    print("error while rendering :", item)
+                    print(exc)
+                metrics.observe(
+                    "task_seconds",
+                    time.perf_counter() - start,
+                    task=self.func.__name__,
+                )
+            self.progress[self.index] = IDLE
+
+
+class TaskChannel:
+    """Send items to be processed by func(*item, **config) in nb_workers processes
+
+    With no worker, items are processed when put (in the caller's process).
+    key(*item) identifies items for processed()."""
+
+    def __init__(
+        self,
+        func,
+        config,
+        nb_workers,
+        depth=QUEUE_DEPTH,
+        batch_size=BATCH_SIZE,
+        key=None,
+    ):
+        self.func = func
+        self.config = config
+        self.batch_size = batch_size
+        self.key = key
+        self.batch = []
+        self.seq = 0
+        self.sent_keys = collections.deque()  # (seq, key of last item)
+        self.last_processed = None
+        nb_workers = int(nb_workers)
+        self.queue = Queue(max(nb_workers, 1) * depth)
+        self.progress = Array("q", [IDLE] * nb_workers)
+        self.taken = Value("q", IDLE, lock=False)
+        self.lock = Lock()
+        self.workers = [
+            Worker(
+                self.queue, func, config, index, self.progress, self.taken, self.lock
+            )
+            for index in range(nb_workers)
+        ]
+        for worker in self.workers:
+            worker.start()
+
+    def put(self, *item):
+        if not self.workers:
+            self.func(*item, **self.config)
+            if self.key:
+                self.last_processed = self.key(*item)
+            return
+        self.batch.append(item)
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def put_here(self, *item):
+        """process item in the caller's process, in order with the items put
+
+        spares copying a big item to a worker"""
+        if not self.workers:
+            self.put(*item)
+            return
+        self.flush()
+        self.func(*item, **self.config)
+        if self.key:
+            # processed along with the last batch sent
+            self.sent_keys.append((self.seq - 1, self.key(*item)))
+
+    def flush(self):
+        if self.batch:
+            # under memory pressure, workers first process queued batches
+            while memory.pressure() and self.taken.value < self.seq - 1:
+                time.sleep(0.05)
+            if self.key:
+                self.sent_keys.append((self.seq, self.key(*self.batch[-1])))
+            self.queue.put((self.seq, self.batch))
+            self.seq += 1
+            self.batch = []
+            if self.workers:
+                metrics.gauge(
+                    "queue_depth",
+                    self.seq - 1 - self.taken.value,
+                    task=self.func.__name__,
+                )
+
+    def processed(self):
+        """key of the last item such as it and all previous ones are processed"""
+        if self.workers:
+            # batches are taken in order: all below the first untaken one
+            # and below those in progress are done (taken is read first,
+            # unfinished batches it covers are published already)
+            done_below = self.taken.value + 1
+            busy = [seq for seq in self.progress[:] if seq != IDLE]
+            done_below = min(busy + [done_below])
+            while self.sent_keys and self.sent_keys[0][0] < done_below:
+                self.last_processed = self.sent_keys.popleft()[1]
+        return self.last_processed
+
+    def close(self):
+        """send pending items and wait for workers to process all of them"""
+        self.flush()
+        for worker in self.workers:
+            self.queue.put(None)
+        for worker in self.workers:
+            worker.join()
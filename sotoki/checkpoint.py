@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+"""Build checkpoints for --resume
+
+Records which phases of a build completed and, inside the questions
+phase, the watermark: the last question Id such as it and all previous
+ones are rendered and have their questiontag rows and redirections
+written. A resumed build skips completed phases and questions up to the
+watermark. Shards record their own watermark."""
+
+import os
+import sqlite3
+import threading
+
+PHASES = ["prepare", "users", "questions", "tags", "static", "zim"]
+
+SCHEMA = """CREATE TABLE IF NOT EXISTS checkpoints(
+    name TEXT PRIMARY KEY,
+    value
+)"""
+
+
+class Checkpoint:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+        with self.conn:
+            self.conn.execute(SCHEMA)
+
+    @property
+    def conn(self):
+        # connections can't be shared with forked processes
+        if self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, timeout=60)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._pid = os.getpid()
+        return self._conn
+
+    def _get(self, name):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT value FROM checkpoints WHERE name = ?", (name,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def _set(self, name, value):
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO checkpoints(name, value) VALUES(?, ?)",
+                (name, value),
+            )
+
+    def done(self, phase):
+        return self._get(f"phase:{phase}") is not None
+
+    def complete(self, phase):
+        print(f"Checkpoint: {phase} completed")
+        self._set(f"phase:{phase}", 1)
+
+    def watermark(self, name):
+        """last Id processed in the previous run(s) for name, None if none"""
+        return self._get(f"watermark:{name}")
+
+    def set_watermark(self, name, value):
+        self._set(f"watermark:{name}", value)
+
+    def reset(self, keep=()):
+        """forget all checkpoints but completion of phases in keep"""
+        with self.lock, self.conn:
+            self.conn.execute(
+                "DELETE FROM checkpoints WHERE name NOT IN ({})".format(
+                    ", ".join("?" * len(keep))
+                ),
+                [f"phase:{phase}" for phase in keep],
+            )
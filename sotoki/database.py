@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+"""SQLite helpers for the build database
+
+The database is a disposable build artifact (it is recreated from the dump
+on failure) so durability is traded for insert speed."""
+
+import time
+import sqlite3
+
+from . import metrics
+
+BATCH_SIZE = 50000  # rows per executemany/transaction
+CACHE_SIZE = 512 * 1024  # KiB of page cache
+
+
+def open_db(path):
+    """sqlite3 connection to path tuned for bulk loading"""
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=OFF")
+    conn.execute(f"PRAGMA cache_size=-{CACHE_SIZE}")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    return conn
+
+
+class BulkInserter:
+    """Buffer rows for sql and write them with executemany in large transactions
+
+    keeps track of inserted rows and time spent inserting to report a rate"""
+
+    def __init__(self, conn, sql, name, batch_size=BATCH_SIZE):
+        self.conn = conn
+        self.sql = sql
+        self.name = name
+        self.batch_size = batch_size
+        self.rows = []
+        self.count = 0
+        self.duration = 0.0
+
+    def add(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+        start = time.perf_counter()
+        with self.conn:
+            self.conn.executemany(self.sql, self.rows)
+        duration = time.perf_counter() - start
+        metrics.count("rows_inserted", len(self.rows), table=self.name)
+        metrics.observe("insert_seconds", duration, table=self.name)
+        self.duration += duration
+        self.count += len(self.rows)
+        self.rows = []
+
+    def rate(self):
+        """inserted rows per second spent inserting"""
+        if not self.duration:
+            return 0.0
+        return self.count / self.duration
+
+    def report(self):
+        print(
+            "{}: {} rows inserted in {:.1f}s ({:.0f} rows/s)".format(
+                self.name, self.count, self.duration, self.rate()
+            )
+        )
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+"""Image download service
+
+Renderers only submit (url, path) pairs. A dedicated process fetches them
+with a thread pool, reusing keep-alive connections per host, limiting the
+number of concurrent downloads per host and the global request rate, so
+slow image hosts no longer stall HTML generation."""
+
+import time
+import threading
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Process, Queue
+
+import requests
+
+from . import profiling
+
+TIMEOUT = 30
+CHUNK_SIZE = 1024 * 1024
+
+
+class RateLimiter:
+    """Space out calls to wait() to at most rate per second (0 is unlimited)"""
+
+    def __init__(self, rate=0):
+        self.interval = 1.0 / rate if rate else 0
+        self.lock = threading.Lock()
+        self.next_slot = time.monotonic()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            slot = max(self.next_slot, now)
+            self.next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class HostPool:
+    """Per-host requests sessions (connection pools) and concurrency slots"""
+
+    def __init__(self, per_host=4):
+        self.per_host = per_host
+        self.lock = threading.Lock()
+        self.sessions = {}
+        self.slots = {}
+
+    def session(self, url):
+        host = urllib.parse.urlparse(url).netloc
+        with self.lock:
+            if host not in self.sessions:
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(
+                    pool_connections=1, pool_maxsize=self.per_host
+                )
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                self.sessions[host] = session
+            return self.sessions[host]
+
+    def slot(self, url):
+        host = urllib.parse.urlparse(url).netloc
+        with self.lock:
+            if host not in self.slots:
+                self.slots[host] = threading.BoundedSemaphore(self.per_host)
+            return self.slots[host]
+
+
+HOSTS = HostPool()
+RATE_LIMITER = RateLimiter()
+
+
+def configure(per_host, rate):
+    """set per-host connections and global rate (requests/s) of this process"""
+    global HOSTS, RATE_LIMITER
+    HOSTS = HostPool(per_host)
+    RATE_LIMITER = RateLimiter(rate)
+
+
+def request(method, url, **kwargs):
+    """requests' response to method on url through the host's pooled session"""
+    RATE_LIMITER.wait()
+    kwargs.setdefault("timeout", TIMEOUT)
+    return HOSTS.session(url).request(method, url, **kwargs)
+
+
+def fetch_to_file(url, fpath):
+    """stream url's content to fpath, raising on HTTP errors. returns headers"""
+    with request("GET", url, stream=True) as resp:
+        resp.raise_for_status()
+        with open(fpath, "wb") as fh:
+            for chunk in resp.iter_content(CHUNK_SIZE):
+                fh.write(chunk)
+        return resp.headers
+
+
+class DownloadService(Process):
+    """Process fetching submitted (url, path) pairs with handler
+
+    handler(url, path, **options) is called from a pool of threads,
+    holding the url's host slot. A path is only handled once.
+    initializer and finalizer are called in the service process before
+    the first and after the last download."""
+
+    def __init__(
+        self,
+        handler,
+        threads=16,
+        per_host=4,
+        rate=0,
+        queue_size=10000,
+        initializer=None,
+        finalizer=None,
+    ):
+        super(DownloadService, self).__init__()
+        self.handler = handler
+        self.initializer = initializer
+        self.finalizer = finalizer
+        self.threads = threads
+        self.per_host = per_host
+        self.rate = rate
+        self.queue = Queue(queue_size)
+
+    def submit(self, url, path, **options):
+        self.queue.put((url, path, options))
+
+    def close(self):
+        self.queue.put(None)
+        self.join()
+
+    def _handle(self, url, path, options):
+        try:
+            with HOSTS.slot(url), profiling.thread_profiled():
+                self.handler(url, path, **options)
+        except Exception as exc:
+            print(f"{url} > Failed to download\n{exc}\n")
+
+    def run(self):
+        # spans users and questions phases
+        with profiling.profiled("download-service", phase="images"):
+            self._run()
+
+    def _run(self):
+        configure(self.per_host, self.rate)
+        if self.initializer:
+            self.initializer()
+        seen = set()
+        # don't read the queue faster than we can download
+        pending = threading.BoundedSemaphore(self.threads * 4)
+        with ThreadPoolExecutor(self.threads) as executor:
+            for url, path, options in iter(self.queue.get, None):
+                if path in seen:
+                    continue
+                seen.add(path)
+                pending.acquire()
+                future = executor.submit(self._handle, url, path, options)
+                future.add_done_callback(lambda _: pending.release())
+        if self.finalizer:
+            self.finalizer()
@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+"""Dump archives download
+
+Archives are split in segments fetched with HTTP range requests by a pool
+of connections, all archives at once, into <name>.part files. Completed
+segments are journaled (<name>.segments) so an interrupted download
+resumes with the missing ones. The SHA-1 of an archive is updated as soon
+as segments complete from its start (reading back what was just written,
+still in the page cache), checked against the digest listed in the
+mirror's stackexchange_files.xml (fetched once for all archives) and the
+archive is only renamed to <name> when it matches."""
+
+import os
+import time
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from lxml import etree
+
+from . import metrics
+from .downloader import HostPool
+
+MIRROR = "https://archive.org/download/stackexchange"
+MANIFEST = "stackexchange_files.xml"
+SEGMENT_SIZE = 32 * 1024 * 1024
+CHUNK_SIZE = 1024 * 1024
+TIMEOUT = 60
+RETRIES = 5
+
+
+class DumpDownloadError(Exception):
+    pass
+
+
+def fetch_manifest(mirror=MIRROR):
+    """{file name: (sha1, size)} of the files of mirror"""
+    try:
+        response = requests.get(f"{mirror}/{MANIFEST}", timeout=TIMEOUT)
+        response.raise_for_status()
+    except requests.RequestException as exc:
+        raise DumpDownloadError(f"Unable to fetch {mirror}/{MANIFEST}: {exc}")
+    files = {}
+    for file in etree.fromstring(response.content).xpath("/files/file"):
+        size = file.findtext("size")
+        files[file.get("name")] = (file.findtext("sha1"), int(size) if size else None)
+    return files
+
+
+class Archive:
+    """an archive of the mirror downloaded to path"""
+
+    def __init__(self, url, path, digest, segment_size=SEGMENT_SIZE):
+        self.url = url
+        self.path = path
+        self.name = os.path.basename(path)
+        self.digest = digest
+        self.segment_size = segment_size
+        self.part = path + ".part"
+        self.journal = path + ".segments"
+        self.size = None
+        self.segments = []  # (start, end excluded), end is None without ranges
+        self.done = set()
+        self.lock = threading.Lock()
+        self.sha1 = hashlib.sha1()
+        self.hashed = 0  # segments hashed, from the first one
+        self.downloaded = 0
+        self.started = time.monotonic()
+
+    def prepare(self, session, size=None):
+        """split in segments, keeping the ones of an interrupted download"""
+        response = session.head(self.url, allow_redirects=True, timeout=TIMEOUT)
+        response.raise_for_status()
+        if "Content-Length" in response.headers:
+            size = int(response.headers["Content-Length"])
+        if size is None or response.headers.get("Accept-Ranges") != "bytes":
+            self.segments = [(0, None)]
+        else:
+            self.size = size
+            self.segments = [
+                (start, min(start + self.segment_size, size))
+                for start in range(0, size, self.segment_size)
+            ] or [(0, 0)]
+        header = f"{self.size} {self.segment_size}"
+        if (
+            self.size is not None
+            and os.path.exists(self.part)
+            and os.path.exists(self.journal)
+        ):
+            with open(self.journal) as fh:
+                lines = fh.read().splitlines()
+            if lines and lines[0] == header:
+                # last line may be partially written
+                self.done = {int(line) for line in lines[1:] if line.isdigit()}
+        if not self.done:
+            with open(self.part, "wb") as fh:
+                if self.size is not None:
+                    fh.truncate(self.size)
+            with open(self.journal, "w") as fh:
+                fh.write(header + "\n")
+        else:
+            print(
+                "{}: resuming, {} of {} segments already downloaded".format(
+                    self.name, len(self.done), len(self.segments)
+                )
+            )
+        with self.lock:
+            self._hash()
+
+    def pending(self):
+        return [index for index in range(len(self.segments)) if index not in self.done]
+
+    def fetch(self, index, hosts):
+        """download segment index"""
+        start, end = self.segments[index]
+        written = 0
+        error = None
+        for attempt in range(RETRIES):
+            if end is None:
+                written = 0  # no ranges, start over
+            headers = {}
+            if end is not None:
+                headers["Range"] = f"bytes={start + written}-{end - 1}"
+            try:
+                with hosts.session(self.url).get(
+                    self.url, headers=headers, stream=True, timeout=TIMEOUT
+                ) as response:
+                    response.raise_for_status()
+                    if end is not None and response.status_code != 206:
+                        raise DumpDownloadError("range request not honoured")
+                    with open(self.part, "r+b") as fh:
+                        fh.seek(start + written)
+                        if end is None:
+                            fh.truncate()
+                        for chunk in response.iter_content(CHUNK_SIZE):
+                            fh.write(chunk)
+                            written += len(chunk)
+                            metrics.count("dump_bytes_downloaded", len(chunk))
+                if end is None or written == end - start:
+                    break
+                error = f"{written} of {end - start} bytes received"
+            except (requests.RequestException, OSError, DumpDownloadError) as exc:
+                error = exc
+            time.sleep(2 ** attempt)
+        else:
+            raise DumpDownloadError(
+                "{}: segment {} failed after {} attempts: {}".format(
+                    self.name, index, RETRIES, error
+                )
+            )
+        with self.lock:
+            self.downloaded += written
+            self.done.add(index)
+            with open(self.journal, "a") as fh:
+                fh.write(f"{index}\n")
+            self._hash()
+
+    def _hash(self):
+        # segments complete from the start are added to the digest
+        with open(self.part, "rb") as fh:
+            while self.hashed in self.done:
+                start, end = self.segments[self.hashed]
+                fh.seek(start)
+                remaining = None if end is None else end - start
+                while remaining is None or remaining > 0:
+                    chunk = fh.read(
+                        CHUNK_SIZE if remaining is None else min(CHUNK_SIZE, remaining)
+                    )
+                    if not chunk:
+                        break
+                    self.sha1.update(chunk)
+                    if remaining is not None:
+                        remaining -= len(chunk)
+                self.hashed += 1
+
+    def finish(self):
+        """check the digest, then rename the archive to its final path"""
+        if self.digest is not None and self.sha1.hexdigest() != self.digest:
+            os.remove(self.part)
+            os.remove(self.journal)
+            raise DumpDownloadError(
+                "{}: SHA-1 {} does not match {}".format(
+                    self.name, self.sha1.hexdigest(), self.digest
+                )
+            )
+        os.rename(self.part, self.path)
+        os.remove(self.journal)
+        elapsed = max(time.monotonic() - self.started, 1e-6)
+        print(
+            "{}: {:.1f} MiB downloaded in {:.0f}s ({:.1f} MiB/s), SHA-1 ok".format(
+                self.name,
+                self.downloaded / 2 ** 20,
+                elapsed,
+                self.downloaded / 2 ** 20 / elapsed,
+            )
+        )
+
+
+def download(names, directory, mirror=MIRROR, connections=8, segment_size=SEGMENT_SIZE):
+    """download archives names of mirror to directory, returns their paths
+
+    archives already in directory (renamed once verified) are kept"""
+    paths = [os.path.join(directory, name) for name in names]
+    missing = [
+        (name, path) for name, path in zip(names, paths) if not os.path.exists(path)
+    ]
+    if not missing:
+        return paths
+    manifest = fetch_manifest(mirror)
+    hosts = HostPool(per_host=connections)
+    archives = []
+    for name, path in missing:
+        if name not in manifest:
+            raise DumpDownloadError(f"{name} not found in {mirror}/{MANIFEST}")
+        digest, size = manifest[name]
+        archive = Archive(f"{mirror}/{name}", path, digest, segment_size)
+        try:
+            archive.prepare(hosts.session(archive.url), size)
+        except requests.RequestException as exc:
+            raise DumpDownloadError(f"Unable to download {archive.url}: {exc}")
+        archives.append(archive)
+    # first segments of every archive first, so all digests progress
+    tasks = sorted(
+        (
+            (index, order, archive)
+            for order, archive in enumerate(archives)
+            for index in archive.pending()
+        ),
+        key=lambda task: task[:2],
+    )
+    print(
+        "Downloading {} ({} segments) with {} connections".format(
+            ", ".join(archive.name for archive in archives), len(tasks), connections
+        )
+    )
+    with ThreadPoolExecutor(connections) as executor:
+        futures = [
+            executor.submit(archive.fetch, index, hosts) for index, _, archive in tasks
+        ]
+        try:
+            for future in futures:
+                future.result()
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+    for archive in archives:
+        archive.finish()
+    return paths
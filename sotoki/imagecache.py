@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+"""Local index of image download results, kept across runs
+
+For each image URL: status (ok/failed), validators (etag, last-modified),
+final file type, optimized size, failure count and the path of an
+identical image it is redirected to (if any). Known images are reused
+without checking the filesystem and failed ones are only retried after
+an exponential backoff.
+
+Stored images are also indexed by content hash so an image identical to
+one already stored (under another URL) is redirected to it.
+
+The download service is the only writer; renderers read it to skip
+known URLs. Each process opens its own connection on first use."""
+
+import os
+import time
+import sqlite3
+import threading
+from hashlib import sha256
+
+BACKOFF = 3600  # seconds before retrying a first failure, doubled each time
+MAX_BACKOFF = 30 * 24 * 3600
+
+SCHEMA = """CREATE TABLE IF NOT EXISTS images(
+    url_hash TEXT PRIMARY KEY,
+    url TEXT,
+    status TEXT,
+    etag TEXT,
+    last_modified TEXT,
+    ftype TEXT,
+    size INTEGER,
+    failures INTEGER DEFAULT 0,
+    retry_after REAL DEFAULT 0,
+    updated REAL,
+    target TEXT
+)"""
+
+CONTENTS_SCHEMA = """CREATE TABLE IF NOT EXISTS contents(
+    content_hash TEXT PRIMARY KEY,
+    path TEXT,
+    size INTEGER,
+    duplicates INTEGER DEFAULT 0
+)"""
+
+
+def url_hash(url):
+    return sha256(url.encode("utf-8")).hexdigest()
+
+
+class ImageCache:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+        with self.conn:
+            self.conn.execute(SCHEMA)
+            self.conn.execute(CONTENTS_SCHEMA)
+
+    @property
+    def conn(self):
+        # connections can't be shared with forked processes
+        if self._pid != os.getpid():
+            self._conn = sqlite3.connect(
+                self.path, timeout=60, check_same_thread=False
+            )
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._pid = os.getpid()
+        return self._conn
+
+    def lookup(self, url):
+        """(status, target) of url
+
+        status is ok, failed (still in backoff) or None if unknown/to be
+        retried. target is the path of the image url is redirected to"""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT status, retry_after, target FROM images WHERE url_hash = ?",
+                (url_hash(url),),
+            ).fetchone()
+        if row is None:
+            return None, None
+        status, retry_after, target = row
+        if status == "failed" and retry_after <= time.time():
+            return None, None
+        return status, target
+
+    def status(self, url):
+        return self.lookup(url)[0]
+
+    def record_success(self, url, ftype=None, size=None, etag=None, last_modified=None):
+        # keeps the target possibly recorded while storing the image
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT INTO images(url_hash, url, status, etag, last_modified, "
+                "ftype, size, failures, retry_after, updated) "
+                "VALUES(?, ?, 'ok', ?, ?, ?, ?, 0, 0, ?) "
+                "ON CONFLICT(url_hash) DO UPDATE SET status = 'ok', "
+                "etag = excluded.etag, last_modified = excluded.last_modified, "
+                "ftype = excluded.ftype, size = excluded.size, failures = 0, "
+                "retry_after = 0, updated = excluded.updated",
+                (url_hash(url), url, etag, last_modified, ftype, size, time.time()),
+            )
+
+    def record_target(self, url, target):
+        """url's image is (identical to) the one at target"""
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT INTO images(url_hash, url, status, updated, target) "
+                "VALUES(?, ?, 'ok', ?, ?) "
+                "ON CONFLICT(url_hash) DO UPDATE SET target = excluded.target",
+                (url_hash(url), url, time.time(), target),
+            )
+
+    def claim_content(self, content_hash, path, size):
+        """path of the stored image with content_hash, path if it's the first"""
+        with self.lock, self.conn:
+            row = self.conn.execute(
+                "SELECT path FROM contents WHERE content_hash = ?", (content_hash,)
+            ).fetchone()
+            if row is None or row[0] == path or not os.path.exists(row[0]):
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO contents(content_hash, path, size) "
+                    "VALUES(?, ?, ?)",
+                    (content_hash, path, size),
+                )
+                return path
+            self.conn.execute(
+                "UPDATE contents SET duplicates = duplicates + 1 "
+                "WHERE content_hash = ?",
+                (content_hash,),
+            )
+            return row[0]
+
+    def record_failure(self, url):
+        now = time.time()
+        with self.lock, self.conn:
+            row = self.conn.execute(
+                "SELECT failures FROM images WHERE url_hash = ?", (url_hash(url),)
+            ).fetchone()
+            failures = (row[0] if row else 0) + 1
+            retry_after = now + min(BACKOFF * 2 ** (failures - 1), MAX_BACKOFF)
+            self.conn.execute(
+                "INSERT OR REPLACE INTO images(url_hash, url, status, failures, "
+                "retry_after, updated) VALUES(?, ?, 'failed', ?, ?, ?)",
+                (url_hash(url), url, failures, retry_after, now),
+            )
+
+    def redirections(self):
+        """(url, status, target) of images which are redirected"""
+        with self.lock:
+            return self.conn.execute(
+                "SELECT url, status, target FROM images "
+                "WHERE target IS NOT NULL OR status = 'failed'"
+            ).fetchall()
+
+    def summary(self):
+        """{status: count} of indexed URLs"""
+        with self.lock:
+            return dict(
+                self.conn.execute(
+                    "SELECT status, COUNT(*) FROM images GROUP BY status"
+                ).fetchall()
+            )
+
+    def dedup_summary(self):
+        """(duplicate images, bytes saved) by content deduplication"""
+        with self.lock:
+            duplicates, saved = self.conn.execute(
+                "SELECT SUM(duplicates), SUM(duplicates * size) FROM contents"
+            ).fetchone()
+        return duplicates or 0, saved or 0
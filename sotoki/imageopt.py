@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+"""Image optimization engine
+
+PNG and JPEG images are resized, quantized and re-encoded in-process with
+Pillow (libimagequant when available) in a single decode/encode.
+GIFs still need gifsicle which is run over many files per invocation.
+Time spent is recorded per operation and format."""
+
+import io
+import os
+import time
+import threading
+import subprocess
+import contextlib
+
+from PIL import Image
+
+from . import metrics
+
+try:
+    LIBIMAGEQUANT = Image.Quantize.LIBIMAGEQUANT
+    FASTOCTREE = Image.Quantize.FASTOCTREE
+    NO_DITHER = Image.Dither.NONE
+except AttributeError:  # Pillow < 9.1
+    LIBIMAGEQUANT = Image.LIBIMAGEQUANT
+    FASTOCTREE = Image.FASTOCTREE
+    NO_DITHER = Image.NONE
+
+JPEG_QUALITY = 50
+GIF_BATCH_SIZE = 64
+GIF_TIMEOUT = 20  # seconds per file of a batch
+
+
+class Timings:
+    """count and duration of operations per (operation, format)"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}
+
+    @contextlib.contextmanager
+    def timed(self, operation, ftype, count=1):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start
+            metrics.observe(
+                "image_optimize_seconds", duration, operation=operation, type=ftype
+            )
+            with self.lock:
+                entry = self.entries.setdefault((operation, ftype), [0, 0.0])
+                entry[0] += count
+                entry[1] += duration
+
+    def report(self):
+        with self.lock:
+            for (operation, ftype), (count, duration) in sorted(self.entries.items()):
+                print(
+                    "{} {}: {} images in {:.1f}s ({:.1f} ms/image)".format(
+                        operation, ftype, count, duration, duration / count * 1000
+                    )
+                )
+
+
+TIMINGS = Timings()
+
+
+def quantize(im):
+    """im reduced to a 256 colors palette, as pngquant --nofs did"""
+    if im.mode == "P":
+        return im
+    if im.mode not in ("RGB", "RGBA"):
+        im = im.convert("RGBA")
+    try:
+        return im.quantize(256, method=LIBIMAGEQUANT, dither=NO_DITHER)
+    except ValueError:  # Pillow built without libimagequant
+        return im.quantize(256, method=FASTOCTREE, dither=NO_DITHER)
+
+
+def encode(im, ftype):
+    """optimized bytes of im in ftype (png or jpeg), metadata stripped"""
+    buf = io.BytesIO()
+    if ftype == "jpeg":
+        if im.mode not in ("RGB", "L", "CMYK"):
+            im = im.convert("RGB")
+        im.save(buf, "JPEG", quality=JPEG_QUALITY, optimize=True, progressive=True)
+    else:
+        quantize(im).save(buf, "PNG", optimize=True)
+    return buf.getvalue()
+
+
+def process(path, ftype, resize=None):
+    """resize (to resize px wide) and optimize a png or jpeg in place
+
+    the optimized version is only kept if smaller (or resized).
+    returns the bytes written to path or None if left untouched"""
+    with TIMINGS.timed("optimize", ftype):
+        with Image.open(path) as im:
+            im.load()
+            if resize:
+                ratio = float(resize) / float(im.size[0])
+                im = im.resize((int(resize), int(float(im.size[1]) * ratio)))
+            data = encode(im, ftype)
+        if not resize and len(data) >= os.path.getsize(path):
+            return None
+        with open(path, "wb") as fh:
+            fh.write(data)
+    return data
+
+
+def optimize_gifs(paths):
+    """optimize GIFs in place with a single gifsicle call"""
+    if not paths:
+        return
+    with TIMINGS.timed("optimize", "gif", count=len(paths)):
+        ret = subprocess.run(
+            ["gifsicle", "--batch", "-O3"] + paths, timeout=GIF_TIMEOUT * len(paths)
+        ).returncode
+    if ret != 0:
+        print(f"> gifsicle failed for (some of) {len(paths)} GIFs")
+
+
+class GifBatch:
+    """Collect GIFs to optimize them together, calling each one's callback after"""
+
+    def __init__(self, size=GIF_BATCH_SIZE):
+        self.size = size
+        self.lock = threading.Lock()
+        self.items = []
+
+    def add(self, path, callback):
+        with self.lock:
+            self.items.append((path, callback))
+            if len(self.items) < self.size:
+                return
+            items, self.items = self.items, []
+        self._run(items)
+
+    def flush(self):
+        with self.lock:
+            items, self.items = self.items, []
+        self._run(items)
+
+    @staticmethod
+    def _run(items):
+        try:
+            optimize_gifs([path for path, _ in items])
+        except Exception as exc:
+            print(f"> GIF batch optimization failed\n{exc}")
+        for _, callback in items:
+            callback()
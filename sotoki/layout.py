@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+"""On-disk layout of the output tree
+
+Files are stored at their ZIM path by default (flat layout). With the
+sharded layout, files of the directories holding one entry per question,
+user or image are spread in two levels of sub-directories named after
+their id (last digits) or hash (first characters):
+
+    question/12345678.html      question/78/56/12345678.html
+    static/images/ab12….png     static/images/ab/12/ab12….png
+
+so no directory holds more than a few thousand entries. ZIM paths are
+unchanged: they are mapped to disk paths when files are written and back
+when the tree is added to the ZIM."""
+
+import os
+
+SHARDED_DIRS = (
+    "question",
+    "user",
+    os.path.join("static", "images"),
+    os.path.join("static", "identicon"),
+)
+SHARDED = False  # layout of this run, set by setup()
+
+_created = set()  # shard directories known to exist
+
+
+def setup(sharded):
+    global SHARDED
+    SHARDED = sharded
+
+
+def shard(name):
+    """sub-directories of file name"""
+    stem = name.split(".", 1)[0]
+    if stem.lstrip("-").isdigit():  # ids, -1 is the community user
+        stem = stem.lstrip("-").zfill(4)
+        return stem[-2:], stem[-4:-2]
+    stem = stem.ljust(4, "_")
+    return stem[:2], stem[2:4]
+
+
+def disk_path(path, sharded=None):
+    """relative on-disk path of ZIM path (in this run's layout by default)"""
+    if not (SHARDED if sharded is None else sharded):
+        return path
+    directory, name = os.path.split(path)
+    if directory not in SHARDED_DIRS:
+        return path
+    return os.path.join(directory, *shard(name), name)
+
+
+def zim_path(path, sharded=None):
+    """ZIM path of relative on-disk path (in this run's layout by default)"""
+    if not (SHARDED if sharded is None else sharded):
+        return path
+    parts = path.split(os.sep)
+    if (
+        len(parts) > 3
+        and os.path.join(*parts[:-3]) in SHARDED_DIRS
+        and tuple(parts[-3:-1]) == shard(parts[-1])
+    ):
+        return os.path.join(*parts[:-3], parts[-1])
+    return path
+
+
+def ensure_dir(fpath):
+    """create the shard directory of on-disk path fpath if needed"""
+    if not SHARDED:
+        return
+    directory = os.path.dirname(fpath)
+    if directory not in _created:
+        os.makedirs(directory, exist_ok=True)
+        _created.add(directory)
@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+"""Manifest of rendered pages for incremental rebuilds
+
+For each page (question, user, tag page) the hash of its inputs is kept
+from one run to the next. A page whose inputs didn't change since the
+previous run is not rendered again and pages not seen during a run
+(question or user gone from the dump) are removed at the end.
+
+A change of configuration (sotoki version, templates, options) makes
+every page change, as does a missing page file. Each process keeps its
+own connection and buffers its updates, written in large transactions.
+
+The hash of a changed page is only kept as pending when the parser sees
+it: it becomes the page's hash once the page file has been written
+(rendered(), from the process rendering it), whichever of the two is
+written first. A page whose rendering failed or was interrupted keeps
+the hash of its file on disk and is rendered again by the next run."""
+
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+import multiprocessing.util
+
+from . import layout
+
+BATCH_SIZE = 50000
+KINDS = ("question", "tag", "user")  # first part of the paths of tracked pages
+
+SCHEMA = """CREATE TABLE IF NOT EXISTS pages(
+    path TEXT PRIMARY KEY,
+    kind TEXT,
+    hash TEXT,
+    run INTEGER,
+    changed_run INTEGER,
+    pending TEXT,
+    rendered INTEGER
+)"""
+# manifests of previous versions
+COLUMNS = {"pending": "TEXT", "rendered": "INTEGER"}
+RUNS_SCHEMA = """CREATE TABLE IF NOT EXISTS runs(
+    run INTEGER PRIMARY KEY,
+    config TEXT,
+    started REAL
+)"""
+
+
+def digest(data):
+    """hash of JSON-serializable data"""
+    return hashlib.sha1(
+        json.dumps(data, sort_keys=True, default=str).encode("utf-8")
+    ).hexdigest()
+
+
+class Manifest:
+    def __init__(self, path, config, root, resume=False):
+        self.path = path
+        self.root = root
+        self.lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+        self._updates = []
+        self._rendered = []
+        config = digest(config)
+        with self.conn:
+            self.conn.execute(SCHEMA)
+            self.conn.execute(RUNS_SCHEMA)
+            existing = {row[1] for row in self.conn.execute("PRAGMA table_info(pages)")}
+            for column, column_type in COLUMNS.items():
+                if column not in existing:
+                    self.conn.execute(
+                        f"ALTER TABLE pages ADD COLUMN {column} {column_type}"
+                    )
+            previous = self.conn.execute(
+                "SELECT run, config FROM runs ORDER BY run DESC LIMIT 1"
+            ).fetchone()
+            if resume and previous and previous[1] == config:
+                # pages seen by the interrupted run still belong to this one
+                self.run = previous[0]
+                return
+            self.run = previous[0] + 1 if previous else 1
+            if previous and previous[1] != config:
+                print("Configuration changed since previous run, rendering all pages")
+                self.conn.execute("UPDATE pages SET hash = NULL")
+            self.conn.execute(
+                "INSERT INTO runs(run, config, started) VALUES(?, ?, ?)",
+                (self.run, config, time.time()),
+            )
+
+    @property
+    def conn(self):
+        # connections can't be shared with forked processes
+        if self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, timeout=60)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._pid = os.getpid()
+            self._updates = []
+            self._rendered = []
+            multiprocessing.util.Finalize(self, self.flush, exitpriority=10)
+        return self._conn
+
+    def changed(self, kind, path, data):
+        """whether page at path must be rendered from data (marked as seen)
+
+        the new hash of a changed page is pending until rendered(path)"""
+        data_hash = digest(data)
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT hash FROM pages WHERE path = ?", (path,)
+            ).fetchone()
+            fpath = os.path.join(self.root, layout.disk_path(path))
+            changed = row is None or row[0] != data_hash or not os.path.exists(fpath)
+            self._updates.append(
+                (path, kind, data_hash if changed else None, self.run)
+            )
+            if len(self._updates) >= BATCH_SIZE:
+                self._flush()
+        return changed
+
+    def rendered(self, path):
+        """page at path has been written (from its pending data)"""
+        if path.split("/", 1)[0] not in KINDS:
+            return
+        with self.lock:
+            self.conn  # buffers of this process
+            self._rendered.append((path, path.split("/", 1)[0], self.run))
+            if len(self._rendered) >= BATCH_SIZE:
+                self._flush()
+
+    def _flush(self):
+        if not self._updates and not self._rendered:
+            return
+        with self.conn:
+            # pending hash of a changed page is its hash once rendered in
+            # this run, whichever of the parser and the renderer comes first
+            self.conn.executemany(
+                "INSERT INTO pages(path, kind, pending, run, changed_run) "
+                "VALUES(?1, ?2, ?3, ?4, CASE WHEN ?3 IS NULL THEN NULL ELSE ?4 END) "
+                "ON CONFLICT(path) DO UPDATE SET "
+                "kind = excluded.kind, run = excluded.run, "
+                "changed_run = COALESCE(excluded.changed_run, changed_run), "
+                "hash = CASE WHEN excluded.pending IS NOT NULL "
+                "AND rendered = excluded.run THEN excluded.pending ELSE hash END, "
+                "pending = CASE WHEN rendered = excluded.run THEN NULL "
+                "ELSE excluded.pending END",
+                self._updates,
+            )
+            self.conn.executemany(
+                "INSERT INTO pages(path, kind, rendered) VALUES(?, ?, ?) "
+                "ON CONFLICT(path) DO UPDATE SET rendered = excluded.rendered, "
+                "hash = CASE WHEN changed_run = excluded.rendered "
+                "THEN COALESCE(pending, hash) ELSE hash END, "
+                "pending = CASE WHEN changed_run = excluded.rendered "
+                "THEN NULL ELSE pending END",
+                self._rendered,
+            )
+        self._updates = []
+        self._rendered = []
+
+    def flush(self):
+        """write this process' pending updates"""
+        with self.lock:
+            if self._pid == os.getpid():
+                self._flush()
+
+    def remove_vanished(self):
+        """delete pages not seen during this run
+
+        (or only rendered, by a run interrupted before they were seen)"""
+        self.flush()
+        removed = {}
+        with self.lock:
+            vanished = self.conn.execute(
+                "SELECT path, kind FROM pages WHERE run < ? OR run IS NULL",
+                (self.run,),
+            ).fetchall()
+            for path, kind in vanished:
+                fpath = os.path.join(self.root, layout.disk_path(path))
+                if os.path.exists(fpath):
+                    os.remove(fpath)
+                removed[kind] = removed.get(kind, 0) + 1
+            with self.conn:
+                self.conn.execute(
+                    "DELETE FROM pages WHERE run < ? OR run IS NULL", (self.run,)
+                )
+        return removed
+
+    def report(self, removed):
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT kind, COUNT(*), SUM(changed_run = ?) FROM pages "
+                "WHERE run = ? GROUP BY kind",
+                (self.run, self.run),
+            ).fetchall()
+        for kind, total, changed in rows:
+            print(
+                "Incremental {}: {} pages, {} rendered, {} unchanged, {} removed".format(
+                    kind, total, changed, total - changed, removed.get(kind, 0)
+                )
+            )
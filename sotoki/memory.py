@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+"""Memory budget of a build (--memory-budget)
+
+A thread of the main process measures the memory of the build every few
+seconds: proportional set size (PSS, so pages shared by forked workers
+count once) of the main process and all its descendants, plus what the
+build added to /dev/shm. Above HIGH of the budget, the build is under
+pressure until it goes back below LOW. The pressure flag is shared with
+every process forked after setup(), which reacts by:
+
+- not sending more batches to rendering workers until they processed
+  the ones already queued (see channel)
+- rendering posts with a lot of answers and comments in the parser
+  instead of copying them to a worker (see oversized())
+- writing temporary images to disk instead of /dev/shm (see temp_dir())
+
+The peak of each phase is reported. Does nothing until setup() is
+called, measures require Linux /proc."""
+
+import os
+import threading
+from multiprocessing import Value
+
+from . import metrics
+
+HIGH = 0.85  # pressure above this fraction of the budget
+LOW = 0.75  # until back below this one
+INTERVAL = 2  # seconds between two measures
+MAX_POST_ITEMS = 500  # answers and comments rendered in a worker, under pressure
+SHM_DIR = "/dev/shm"
+
+BUDGET = None  # bytes, set by setup()
+DISK_TMP = None  # temporary directory on disk, used under pressure
+
+_pressure = None  # shared flag
+_thread = None
+_stopped = threading.Event()
+_peak = 0
+_phase = None
+
+
+def parse_size(value):
+    """bytes of a size in MiB or with a K, M, G or T suffix"""
+    value = value.strip().upper().rstrip("B").rstrip("I")
+    units = {"K": 2 ** 10, "M": 2 ** 20, "G": 2 ** 30, "T": 2 ** 40}
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(float(value) * units["M"])
+
+
+def setup(budget, disk_tmp):
+    """watch memory of this process and its future children"""
+    global BUDGET, DISK_TMP, _pressure, _thread
+    BUDGET = budget
+    DISK_TMP = disk_tmp
+    os.makedirs(disk_tmp, exist_ok=True)
+    _pressure = Value("b", 0, lock=False)
+    _thread = threading.Thread(target=_watch, args=(shm_used(),), daemon=True)
+    _thread.start()
+    print("Memory budget: {:.0f} MiB".format(budget / 2 ** 20))
+
+
+def pressure():
+    """whether the build uses more memory than it should"""
+    return bool(_pressure is not None and _pressure.value)
+
+
+def oversized(post):
+    """whether post should not be copied to a worker (under pressure)"""
+    if not pressure():
+        return False
+    items = len(post.get("comments", ()))
+    for answer in post.get("answers", ()):
+        items += 1 + len(answer.get("comments", ()))
+    return items > MAX_POST_ITEMS
+
+
+def temp_dir(default):
+    """directory for temporary files otherwise in default (tmpfs)"""
+    return DISK_TMP if pressure() else default
+
+
+def descendants(pid):
+    """pids of the processes started by pid, recursively"""
+    children = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as fh:
+                stat = fh.read()
+        except OSError:
+            continue
+        # comm (2nd field) may hold spaces, ppid is the 2nd after it
+        ppid = int(stat[stat.rindex(")") + 2 :].split()[1])
+        children.setdefault(ppid, []).append(int(entry))
+    found = []
+    pending = [pid]
+    while pending:
+        for child in children.get(pending.pop(), ()):
+            found.append(child)
+            pending.append(child)
+    return found
+
+
+def process_memory(pid):
+    """PSS of pid in bytes (RSS if not available), 0 if gone"""
+    for path, field in (
+        (f"/proc/{pid}/smaps_rollup", "Pss:"),
+        (f"/proc/{pid}/status", "VmRSS:"),
+    ):
+        try:
+            with open(path) as fh:
+                for line in fh:
+                    if line.startswith(field):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            continue
+    return 0
+
+
+def shm_used():
+    if not os.path.isdir(SHM_DIR):
+        return 0
+    stat = os.statvfs(SHM_DIR)
+    return (stat.f_blocks - stat.f_bfree) * stat.f_frsize
+
+
+def used(shm_baseline=0):
+    """memory of this process and its descendants, and of our /dev/shm files"""
+    pid = os.getpid()
+    total = sum(process_memory(child) for child in [pid] + descendants(pid))
+    return total + max(shm_used() - shm_baseline, 0)
+
+
+def _watch(shm_baseline):
+    global _peak
+    while not _stopped.wait(INTERVAL):
+        try:
+            current = used(shm_baseline)
+        except OSError:
+            continue
+        _peak = max(_peak, current)
+        metrics.gauge("memory_bytes", current)
+        if not _pressure.value and current > HIGH * BUDGET:
+            _pressure.value = 1
+            print(
+                "Memory pressure: {:.0f} of {:.0f} MiB used, throttling".format(
+                    current / 2 ** 20, BUDGET / 2 ** 20
+                )
+            )
+        elif _pressure.value and current < LOW * BUDGET:
+            _pressure.value = 0
+            print("Memory pressure over: {:.0f} MiB used".format(current / 2 ** 20))
+        metrics.gauge("memory_pressure", _pressure.value)
+
+
+def phase(name):
+    """report the peak of the previous phase"""
+    global _peak, _phase
+    if BUDGET is None:
+        return
+    if _phase is not None:
+        print(
+            "Memory peak of {}: {:.0f} MiB ({:.0f}% of the budget)".format(
+                _phase, _peak / 2 ** 20, 100 * _peak / BUDGET
+            )
+        )
+    _phase = name
+    _peak = 0
+
+
+def close():
+    if BUDGET is None:
+        return
+    _stopped.set()
+    _thread.join()
+    phase(None)
@@ -0,0 +1,355 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+"""Build metrics
+
+Counters, gauges and histograms are recorded by every process of a build
+(parser, rendering workers, shards, download service) in a buffer of the
+process, sent to the main process every few seconds and when it exits.
+The main process aggregates them and periodically appends a snapshot
+(totals, rates over the interval and since the start of the current
+phase, histogram quantiles) to a JSON-lines file. The same figures can be
+served in Prometheus text format on a local HTTP port.
+
+Recording functions do nothing until setup() is called."""
+
+import os
+import json
+import time
+import queue
+import bisect
+import threading
+import contextlib
+import multiprocessing
+import multiprocessing.util
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+PREFIX = "sotoki_"
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+SEND_INTERVAL = 5  # seconds between two sends of a process' buffer
+MAX_SERIES = 200  # label sets per metric, others are counted as "other"
+
+REGISTRY = None  # Metrics of the build, set by setup()
+
+
+def series(name, labels):
+    return (name, tuple(sorted((key, str(value)) for key, value in labels.items())))
+
+
+def series_name(key):
+    name, labels = key
+    if not labels:
+        return name
+    return "{}{{{}}}".format(
+        name, ",".join('{}="{}"'.format(label, value) for label, value in labels)
+    )
+
+
+def quantile(buckets, count, fraction):
+    """upper bound of the bucket holding the fraction-th observation
+
+    None if beyond the last bound"""
+    rank = fraction * count
+    seen = 0
+    for bound, nb in zip(BUCKETS, buckets):
+        seen += nb
+        if seen >= rank:
+            return bound
+    return None
+
+
+class Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = self.server.metrics.exposition().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class Metrics:
+    def __init__(self, path, interval=30, port=None, append=False):
+        self.path = path
+        self.interval = interval
+        self.port = port
+        self.pid = os.getpid()
+        self.queue = multiprocessing.Queue()
+        # aggregated by the main process
+        self.agg_lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.started = time.time()
+        self.phase = None
+        self.phase_started = self.started
+        self.phase_counters = {}
+        self.phases = {}  # duration of completed phases
+        self.last_counters = {}
+        self.last_time = self.started
+        self.fh = open(path, "a" if append else "w")
+        self.stopped = threading.Event()
+        self.thread = None
+        self.server = None
+        self._reset()
+        multiprocessing.util.register_after_fork(self, Metrics._forked)
+
+    def _reset(self):
+        self.lock = threading.Lock()
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+        self._sent = time.monotonic()
+
+    def _forked(self):
+        # in a new process: buffer of the parent (and a lock maybe held by
+        # one of its threads) are not ours
+        self._reset()
+        multiprocessing.util.Finalize(self, self.send, exitpriority=5)
+
+    def start(self):
+        self.thread = threading.Thread(target=self._collect, daemon=True)
+        self.thread.start()
+        if self.port:
+            self.server = ThreadingHTTPServer(("127.0.0.1", self.port), Handler)
+            self.server.daemon_threads = True
+            self.server.metrics = self
+            threading.Thread(target=self.server.serve_forever, daemon=True).start()
+            print(f"Metrics served on http://127.0.0.1:{self.port}/metrics")
+
+    # recording, from any process
+
+    def count(self, name, value=1, **labels):
+        key = series(name, labels)
+        with self.lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+        self._maybe_send()
+
+    def gauge(self, name, value, **labels):
+        with self.lock:
+            self._gauges[series(name, labels)] = value
+        self._maybe_send()
+
+    def observe(self, name, value, **labels):
+        key = series(name, labels)
+        with self.lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [0] * (len(BUCKETS) + 1) + [0.0]
+            histogram[bisect.bisect_left(BUCKETS, value)] += 1
+            histogram[-1] += value
+        self._maybe_send()
+
+    def _maybe_send(self):
+        if os.getpid() != self.pid and time.monotonic() - self._sent > SEND_INTERVAL:
+            self.send()
+
+    def _take(self):
+        with self.lock:
+            data = (self._counters, self._gauges, self._histograms)
+            self._counters, self._gauges, self._histograms = {}, {}, {}
+            self._sent = time.monotonic()
+        return data
+
+    def send(self):
+        """send this process' buffer to the main process"""
+        data = self._take()
+        if any(data):
+            self.queue.put(data)
+
+    # aggregation, in the main process
+
+    def _fold(self, table, key):
+        # bounded number of series per metric (hosts…)
+        if key in table:
+            return key
+        name = key[0]
+        if sum(1 for other in table if other[0] == name) >= MAX_SERIES:
+            return (name, tuple((label, "other") for label, _ in key[1]))
+        return key
+
+    def _merge(self, data):
+        counters, gauges, histograms = data
+        with self.agg_lock:
+            for key, value in counters.items():
+                key = self._fold(self.counters, key)
+                self.counters[key] = self.counters.get(key, 0) + value
+            for key, value in gauges.items():
+                self.gauges[self._fold(self.gauges, key)] = value
+            for key, values in histograms.items():
+                key = self._fold(self.histograms, key)
+                histogram = self.histograms.get(key)
+                if histogram is None:
+                    self.histograms[key] = list(values)
+                else:
+                    for index, value in enumerate(values):
+                        histogram[index] += value
+
+    def _drain(self):
+        self._merge(self._take())
+        while True:
+            try:
+                self._merge(self.queue.get_nowait())
+            except queue.Empty:
+                return
+
+    def _collect(self):
+        next_snapshot = time.monotonic() + self.interval
+        while not self.stopped.wait(1):
+            self._drain()
+            if time.monotonic() >= next_snapshot:
+                self.write_snapshot()
+                next_snapshot += self.interval
+
+    def set_phase(self, phase):
+        """figures of following snapshots are for phase"""
+        self._drain()
+        now = time.time()
+        with self.agg_lock:
+            if self.phase is not None:
+                self.phases[self.phase] = round(now - self.phase_started, 3)
+            self.phase = phase
+            self.phase_started = now
+            self.phase_counters = dict(self.counters)
+        print(f"Phase: {phase}")
+
+    def snapshot(self):
+        now = time.time()
+        with self.agg_lock:
+            interval = max(now - self.last_time, 1e-6)
+            phase_elapsed = max(now - self.phase_started, 1e-6)
+            snapshot = {
+                "time": round(now, 3),
+                "elapsed": round(now - self.started, 3),
+                "phase": self.phase,
+                "phase_elapsed": round(phase_elapsed, 3),
+                "phases": dict(self.phases),
+                "counters": {},
+                "rates": {},
+                "phase_rates": {},
+                "gauges": {
+                    series_name(key): value for key, value in self.gauges.items()
+                },
+                "histograms": {},
+            }
+            for key, value in sorted(self.counters.items()):
+                name = series_name(key)
+                snapshot["counters"][name] = value
+                snapshot["rates"][name] = round(
+                    (value - self.last_counters.get(key, 0)) / interval, 3
+                )
+                snapshot["phase_rates"][name] = round(
+                    (value - self.phase_counters.get(key, 0)) / phase_elapsed, 3
+                )
+            for key, histogram in sorted(self.histograms.items()):
+                count = sum(histogram[:-1])
+                snapshot["histograms"][series_name(key)] = {
+                    "count": count,
+                    "sum": round(histogram[-1], 6),
+                    "mean": round(histogram[-1] / count, 6) if count else None,
+                    "p50": quantile(histogram, count, 0.5),
+                    "p95": quantile(histogram, count, 0.95),
+                    "p99": quantile(histogram, count, 0.99),
+                }
+            self.last_counters = dict(self.counters)
+            self.last_time = now
+        return snapshot
+
+    def write_snapshot(self):
+        self.fh.write(json.dumps(self.snapshot()) + "\n")
+        self.fh.flush()
+
+    def exposition(self):
+        """aggregated metrics in Prometheus text format"""
+        lines = []
+
+        def labels(key, extra=()):
+            pairs = list(key[1]) + list(extra)
+            if not pairs:
+                return ""
+            return "{{{}}}".format(
+                ",".join('{}="{}"'.format(label, value) for label, value in pairs)
+            )
+
+        with self.agg_lock:
+            if self.phase is not None:
+                lines.append(f'{PREFIX}phase{{phase="{self.phase}"}} 1')
+            for key, value in sorted(self.counters.items()):
+                lines.append(f"{PREFIX}{key[0]}_total{labels(key)} {value}")
+            for key, value in sorted(self.gauges.items()):
+                lines.append(f"{PREFIX}{key[0]}{labels(key)} {value}")
+            for key, histogram in sorted(self.histograms.items()):
+                cumulated = 0
+                for bound, count in zip(BUCKETS + ("+Inf",), histogram[:-1]):
+                    cumulated += count
+                    lines.append(
+                        "{}{}_bucket{} {}".format(
+                            PREFIX, key[0], labels(key, [("le", bound)]), cumulated
+                        )
+                    )
+                lines.append(f"{PREFIX}{key[0]}_sum{labels(key)} {histogram[-1]}")
+                lines.append(f"{PREFIX}{key[0]}_count{labels(key)} {cumulated}")
+        return "\n".join(lines) + "\n"
+
+    def close(self):
+        """write a last snapshot and stop collecting"""
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        self._drain()
+        with self.agg_lock:
+            if self.phase is not None:
+                self.phases[self.phase] = round(time.time() - self.phase_started, 3)
+        self.write_snapshot()
+        self.fh.close()
+        if self.server is not None:
+            self.server.shutdown()
+
+
+def setup(path, interval=30, port=None, append=False):
+    """start collecting metrics of all processes forked from now on"""
+    global REGISTRY
+    REGISTRY = Metrics(path, interval, port, append)
+    REGISTRY.start()
+    return REGISTRY
+
+
+def count(name, value=1, **labels):
+    if REGISTRY is not None:
+        REGISTRY.count(name, value, **labels)
+
+
+def gauge(name, value, **labels):
+    if REGISTRY is not None:
+        REGISTRY.gauge(name, value, **labels)
+
+
+def observe(name, value, **labels):
+    if REGISTRY is not None:
+        REGISTRY.observe(name, value, **labels)
+
+
+@contextlib.contextmanager
+def timed(name, **labels):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+def phase(name):
+    if REGISTRY is not None:
+        REGISTRY.set_phase(name)
+
+
+def close():
+    if REGISTRY is not None:
+        REGISTRY.close()
@@ -0,0 +1,545 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+"""Prepare stage: join the raw dump files into prepare.xml and usersbadges.xml
+
+Every dump file is read exactly once, line by line with a byte-level
+attribute scanner (or an incremental lxml iterparse if not one row per line).
+Rows which are not already in the order we need are spilled into sorted runs
+(external sort) and merged back while joining, so no full-size intermediate
+copy of the dump is ever written.
+
+Dump files are read from <name>.xml when extracted, otherwise streamed from
+the .7z archives of the dump directory (7z e -so, decompressing while we
+parse). Streamed files can be kept on disk as they are read (keep_xml).
+
+prepare.xml holds one <post> per question with its <comments>, its <answers>
+(each answer with its own <comments>) and its <link>s.
+usersbadges.xml holds one <row> per user with its <badges>."""
+
+import io
+import os
+import glob
+import heapq
+import shutil
+import tempfile
+import contextlib
+import subprocess
+
+from lxml import etree
+
+XML_HEADER = b'<?xml version="1.0" encoding="utf-8"?>\n'
+RUN_SIZE = 500000  # rows kept in memory before spilling a sorted run
+RUN_BYTES = None  # bytes of rows kept in memory before spilling, if limited
+BUFFER_SIZE = 16 * 1024 * 1024
+# files of the dump read by prepare (Tags.xml only extracted for tags phase)
+DUMP_FILES = (
+    "Badges.xml",
+    "Comments.xml",
+    "PostLinks.xml",
+    "Posts.xml",
+    "Tags.xml",
+    "Users.xml",
+)
+
+
+def attr_scanner(name):
+    """function extracting attribute name's raw (still escaped) value from a row
+
+    No regex nor split: a single bytes.find for ' name="' then one for the
+    closing quote. Quotes are always escaped inside values so the needle
+    can only match the attribute itself. Returns None if not present."""
+    needle = b' %s="' % name.encode("utf-8")
+    offset = len(needle)
+
+    def scan(line):
+        start = line.find(needle)
+        if start == -1:
+            return None
+        start += offset
+        return line[start : line.find(b'"', start)]
+
+    return scan
+
+
+ID = attr_scanner("Id")
+POST_ID = attr_scanner("PostId")
+PARENT_ID = attr_scanner("ParentId")
+POST_TYPE_ID = attr_scanner("PostTypeId")
+RELATED_POST_ID = attr_scanner("RelatedPostId")
+USER_ID = attr_scanner("UserId")
+TITLE = attr_scanner("Title")
+
+
+def iter_parsed_rows(source):
+    """yield each <row> of a dump file serialized on its own, using iterparse"""
+    for _, elem in etree.iterparse(
+        source, events=("end",), tag="row", huge_tree=True
+    ):
+        yield etree.tostring(elem, with_tail=False)
+        elem.clear()
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
+
+
+class ReplayReader:
+    """file-like: head bytes already read from fh, then the rest of fh"""
+
+    def __init__(self, head, fh):
+        self.head = head
+        self.fh = fh
+
+    def read(self, size=-1):
+        if size == 0:
+            return b""
+        if self.head:
+            data, self.head = self.head, b""
+            return data
+        return self.fh.read(size)
+
+
+def iter_rows(source):
+    """yield each <row .../> of a dump file (path or binary file) as bytes
+
+    Dumps are published with one row per line: those lines are used as is
+    (fast path). Any other layout goes through the (slower) iterparse."""
+    if isinstance(source, str):
+        with open(source, "rb", buffering=BUFFER_SIZE) as fh:
+            yield from iter_rows(fh)
+        return
+    head = []
+    for raw in source:
+        head.append(raw)
+        if b"<row" in raw:
+            break
+    else:
+        return
+    line = raw.strip()
+    if not line.startswith(b"<row") or not line.endswith(b"/>"):
+        yield from iter_parsed_rows(ReplayReader(b"".join(head), source))
+        return
+    yield line
+    for raw in source:
+        line = raw.strip()
+        if line.startswith(b"<row"):
+            yield line
+
+
+def archive_members(archive):
+    """names of the files of a 7z archive"""
+    listing = subprocess.run(
+        ["7z", "l", "-slt", archive], capture_output=True, check=True
+    ).stdout.decode("utf-8", "replace")
+    # properties of the archive itself come before the separator
+    _, _, files = listing.partition("\n----------\n")
+    return [
+        line[len("Path = ") :].strip()
+        for line in files.splitlines()
+        if line.startswith("Path = ")
+    ]
+
+
+class TeeReader(io.RawIOBase):
+    """raw reader writing what it reads from fh to out"""
+
+    def __init__(self, fh, out):
+        self.fh = fh
+        self.out = out
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self.fh.read(len(buffer))
+        buffer[: len(data)] = data
+        self.out.write(data)
+        return len(data)
+
+
+class DumpFiles:
+    """files of a dump directory, extracted or still in its .7z archives
+
+    A file alone in its archive (stackoverflow.com-Posts.7z…) is piped
+    from 7z as it is read. Archives are solid: reading a file decompresses
+    the archive up to it, so when an archive holds several DUMP_FILES (all
+    of them for most sites) they are extracted at once, in a single pass,
+    and removed once read unless kept."""
+
+    def __init__(self, dump_path, keep_xml=False):
+        self.dump_path = dump_path
+        self.keep_xml = keep_xml
+        self.archives = {}  # file name: archive holding it
+        self.members = {}  # archive: DUMP_FILES it holds
+        self.extracted = set()  # files extracted here, to be removed once read
+        for archive in sorted(glob.glob(os.path.join(dump_path, "*.7z"))):
+            for name in archive_members(archive):
+                name = os.path.basename(name)
+                self.archives.setdefault(name, archive)
+                if name in DUMP_FILES:
+                    self.members.setdefault(archive, []).append(name)
+
+    def path(self, name):
+        return os.path.join(self.dump_path, name)
+
+    def exists(self, name):
+        return os.path.exists(self.path(name)) or name in self.archives
+
+    def mtime(self, name):
+        """modification time of the file or of its archive"""
+        if os.path.exists(self.path(name)):
+            return os.path.getmtime(self.path(name))
+        return os.path.getmtime(self.archives[name])
+
+    @contextlib.contextmanager
+    def open(self, name, keep=None):
+        """binary reader of file name, decompressed on the fly if archived
+
+        with keep (default keep_xml), an archived file is also written to
+        the dump directory as it is read"""
+        keep = self.keep_xml if keep is None else keep
+        if not os.path.exists(self.path(name)) and self.shared(name):
+            self.extract_archive(self.archives[name])
+        if os.path.exists(self.path(name)) or name not in self.archives:
+            with open(self.path(name), "rb", buffering=BUFFER_SIZE) as fh:
+                yield fh
+            if name in self.extracted and not keep:
+                os.remove(self.path(name))
+                self.extracted.discard(name)
+            return
+        process = subprocess.Popen(
+            ["7z", "e", "-so", self.archives[name], name],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            bufsize=BUFFER_SIZE,
+        )
+        out = None
+        fh = process.stdout
+        try:
+            if keep:
+                out = open(self.path(name) + ".tmp", "wb", buffering=BUFFER_SIZE)
+                fh = io.BufferedReader(TeeReader(fh, out), BUFFER_SIZE)
+            yield fh
+            if out is not None:
+                while fh.read(BUFFER_SIZE):  # rest of the file, for out
+                    pass
+        except BaseException:
+            if out is not None:
+                out.close()
+                os.remove(self.path(name) + ".tmp")
+            raise
+        finally:
+            process.stdout.close()
+            returncode = process.wait()
+            if out is not None:
+                out.close()
+        if returncode != 0:
+            raise RuntimeError(
+                "7z failed ({}) extracting {} from {}".format(
+                    returncode, name, self.archives[name]
+                )
+            )
+        if out is not None:
+            os.replace(self.path(name) + ".tmp", self.path(name))
+
+    def shared(self, name):
+        """whether file name is archived with other DUMP_FILES"""
+        archive = self.archives.get(name)
+        return archive is not None and len(self.members.get(archive, ())) > 1
+
+    def extract_archive(self, archive):
+        """extract the DUMP_FILES of archive missing from the dump directory
+
+        in a single decompression of the archive"""
+        names = [
+            name
+            for name in self.members[archive]
+            if not os.path.exists(self.path(name))
+        ]
+        # files only appear once complete
+        tmp_dir = tempfile.mkdtemp(prefix=".extract-", dir=self.dump_path)
+        try:
+            print("Extracting {} from {}".format(", ".join(names), archive))
+            subprocess.run(
+                ["7z", "e", "-y", f"-o{tmp_dir}", archive] + names,
+                stdout=subprocess.DEVNULL,
+                check=True,
+            )
+            for name in names:
+                os.replace(os.path.join(tmp_dir, name), self.path(name))
+                if not self.keep_xml:
+                    self.extracted.add(name)
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def extract(self, name):
+        """write file name to the dump directory if only archived"""
+        if os.path.exists(self.path(name)):
+            return
+        if self.shared(name):
+            self.extract_archive(self.archives[name])
+            self.extracted.discard(name)
+            return
+        with self.open(name, keep=True):
+            pass
+
+
+def row_xml(line, tag, closed=True):
+    """row line renamed to tag, left open if not closed"""
+    line = b"<" + tag + line[4:]
+    if not closed:
+        line = line[:-2].rstrip() + b">"
+    return line
+
+
+class ExternalSorter:
+    """Sort (key, line) pairs which don't fit in memory
+
+    keys are tuples of ints, lines are bytes without newline.
+    Pairs are sorted in runs of run_size (or run_bytes of lines) kept on
+    disk in workdir and merged back when iterated (only once)."""
+
+    def __init__(self, workdir, run_size=RUN_SIZE, run_bytes=None):
+        self.workdir = workdir
+        self.run_size = run_size
+        self.run_bytes = run_bytes if run_bytes is not None else RUN_BYTES
+        self.rows = []
+        self.size = 0
+        self.runs = []
+
+    def add(self, key, line):
+        self.rows.append((key, line))
+        self.size += len(line)
+        if len(self.rows) >= self.run_size or (
+            self.run_bytes and self.size >= self.run_bytes
+        ):
+            self._spill()
+
+    def _spill(self):
+        self.rows.sort()
+        fd, path = tempfile.mkstemp(suffix=".run", dir=self.workdir)
+        with open(fd, "wb", buffering=BUFFER_SIZE) as fh:
+            for key, line in self.rows:
+                fh.write(b",".join(b"%d" % k for k in key) + b"\t" + line + b"\n")
+        self.runs.append(path)
+        self.rows = []
+        self.size = 0
+
+    @staticmethod
+    def _read_run(path):
+        with open(path, "rb", buffering=BUFFER_SIZE) as fh:
+            for raw in fh:
+                key, line = raw[:-1].split(b"\t", 1)
+                yield tuple(int(k) for k in key.split(b",")), line
+        os.remove(path)
+
+    def __iter__(self):
+        if not self.runs:
+            rows, self.rows = sorted(self.rows), []
+            return iter(rows)
+        if self.rows:
+            self._spill()
+        return heapq.merge(*[self._read_run(path) for path in self.runs])
+
+
+class Matcher:
+    """Pull pairs whose first key matches increasing ids out of a sorted stream
+
+    pairs with an id never asked for (orphans) are dropped"""
+
+    def __init__(self, pairs):
+        self.pairs = iter(pairs)
+        self.current = next(self.pairs, None)
+
+    def take(self, ident):
+        matches = []
+        while self.current is not None and self.current[0][0] <= ident:
+            if self.current[0][0] == ident:
+                matches.append(self.current)
+            self.current = next(self.pairs, None)
+        return matches
+
+
+def sort_rows(files, name, tag, key, workdir):
+    """ExternalSorter of a dump file's rows renamed to tag, sorted by key(line)"""
+    sorter = ExternalSorter(workdir)
+    with files.open(name) as fh:
+        for line in iter_rows(fh):
+            sorter.add(key(line), row_xml(line, tag))
+    return sorter
+
+
+def prepare_posts(files, dump_path, workdir):
+    """write prepare.xml from Posts.xml, Comments.xml and PostLinks.xml
+
+    Posts.xml is expected in Id order, as published in the dumps"""
+    comments = Matcher(
+        sort_rows(
+            files,
+            "Comments.xml",
+            b"comment",
+            lambda line: (int(POST_ID(line)), int(ID(line))),
+            workdir,
+        )
+    )
+    links = Matcher(
+        sort_rows(
+            files,
+            "PostLinks.xml",
+            b"link",
+            lambda line: (
+                int(POST_ID(line)),
+                int(RELATED_POST_ID(line)),
+                int(ID(line)),
+            ),
+            workdir,
+        )
+    )
+
+    # links are displayed on their RelatedPostId with the title of their PostId
+    linked = ExternalSorter(workdir)
+    answers = ExternalSorter(workdir)
+    questions_path = os.path.join(workdir, "questions.tmp")
+    with open(questions_path, "wb", buffering=BUFFER_SIZE) as questions, files.open(
+        "Posts.xml"
+    ) as posts:
+        for post in iter_rows(posts):
+            post_type = POST_TYPE_ID(post)
+            if post_type not in (b"1", b"2"):
+                continue
+            post_id = int(ID(post))
+            post_comments = [line for _, line in comments.take(post_id)]
+            if post_comments:
+                post_comments = (
+                    b"<comments>" + b"".join(post_comments) + b"</comments>"
+                )
+            else:
+                post_comments = b""
+
+            if post_type == b"1":
+                post_name = b' PostName="%s"/>' % (TITLE(post) or b"")
+                for (_, related_id, link_id), line in links.take(post_id):
+                    linked.add((related_id, link_id), line[:-2] + post_name)
+                questions.write(
+                    b"%d\t" % post_id
+                    + row_xml(post, b"post", closed=False)
+                    + post_comments
+                    + b"\n"
+                )
+            else:
+                answers.add(
+                    (int(PARENT_ID(post)), post_id),
+                    row_xml(post, b"row", closed=False) + post_comments + b"</row>",
+                )
+
+    answers = Matcher(answers)
+    linked = Matcher(linked)
+    output = os.path.join(dump_path, "prepare.xml")
+    with open(output + ".tmp", "wb", buffering=BUFFER_SIZE) as out, open(
+        questions_path, "rb", buffering=BUFFER_SIZE
+    ) as questions:
+        out.write(XML_HEADER + b"<root>\n")
+        for raw in questions:
+            post_id, line = raw[:-1].split(b"\t", 1)
+            post_id = int(post_id)
+            out.write(
+                line
+                + b"<answers>"
+                + b"".join(line for _, line in answers.take(post_id))
+                + b"</answers>"
+                + b"".join(line for _, line in linked.take(post_id))
+                + b"</post>\n"
+            )
+        out.write(b"</root>\n")
+    os.remove(questions_path)
+    os.replace(output + ".tmp", output)
+
+
+def prepare_users(files, dump_path, workdir):
+    """write usersbadges.xml from Users.xml and Badges.xml
+
+    Users.xml is expected in Id order, as published in the dumps"""
+    badges = Matcher(
+        sort_rows(
+            files,
+            "Badges.xml",
+            b"badge",
+            lambda line: (int(USER_ID(line)), int(ID(line))),
+            workdir,
+        )
+    )
+    output = os.path.join(dump_path, "usersbadges.xml")
+    with open(output + ".tmp", "wb", buffering=BUFFER_SIZE) as out, files.open(
+        "Users.xml"
+    ) as users:
+        out.write(XML_HEADER + b"<root>\n")
+        for user in iter_rows(users):
+            user_id = int(ID(user))
+            line = row_xml(user, b"row", closed=False)
+            user_badges = [line for _, line in badges.take(user_id)]
+            if user_badges:
+                line += b"<badges>" + b"".join(user_badges) + b"</badges>"
+            out.write(line + b"</row>\n")
+        out.write(b"</root>\n")
+    os.replace(output + ".tmp", output)
+
+
+def prepare_dump(dump_path, workdir=None, keep_xml=False):
+    """build usersbadges.xml then prepare.xml in dump_path
+
+    Tags.xml, read by the tags phase, is always extracted.
+    prepare.xml is written last as its presence marks a complete prepare"""
+    workdir = workdir or dump_path
+    files = DumpFiles(dump_path, keep_xml)
+    files.extract("Tags.xml")
+    prepare_users(files, dump_path, workdir)
+    prepare_posts(files, dump_path, workdir)
+
+
+def post_shards(path, count):
+    """up to count (start, end) byte ranges of prepare.xml made of whole <post>s
+
+    prepare.xml holds one <post> per line so ranges are aligned on lines"""
+    size = os.path.getsize(path)
+    with open(path, "rb") as fh:
+        fh.readline()  # XML header
+        fh.readline()  # <root>
+        first = fh.tell()
+        last = size - len(b"</root>\n")
+        bounds = [first]
+        for index in range(1, count):
+            fh.seek(max(first, size * index // count))
+            fh.readline()
+            bounds.append(min(fh.tell(), last))
+        bounds.append(last)
+    return [(start, end) for start, end in zip(bounds, bounds[1:]) if end > start]
+
+
+class PostShard:
+    """Read-only file-like view of a post_shards range, as a standalone document"""
+
+    def __init__(self, path, start, end):
+        self.fh = open(path, "rb")
+        self.fh.seek(start)
+        self.remaining = end - start
+        self.prefix = XML_HEADER + b"<root>\n"
+        self.suffix = b"</root>\n"
+
+    def read(self, size=-1):
+        if size == 0:  # probed by xml.sax for the stream type
+            return b""
+        if self.prefix:
+            data, self.prefix = self.prefix, b""
+            return data
+        if self.remaining > 0:
+            if size is None or size < 0 or size > self.remaining:
+                size = self.remaining
+            data = self.fh.read(size)
+            self.remaining = self.remaining - len(data) if data else 0
+            if data:
+                return data
+        data, self.suffix = self.suffix, b""
+        return data
+
+    def close(self):
+        self.fh.close()
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+"""Profiling of build processes (--profile)
+
+cProfile runs around the parse loop of each phase in the main process
+and in every process doing the work: rendering workers, question shards,
+the download service (and its download threads). Each one dumps its
+stats to <dir>/<phase>/<name>-<pid>.prof and report() merges them into
+<dir>/<phase>.prof (for pstats, snakeviz…) and a text report
+<dir>/<phase>.txt.
+
+With memory profiling, tracemalloc runs in the same processes: allocations
+still alive at the end of each process are dumped next to its stats and
+the biggest allocation sites of the phase, with the peak of each process,
+are added to the report. Tracing allocations makes the build much slower."""
+
+import os
+import io
+import glob
+import pstats
+import cProfile
+import threading
+import contextlib
+import tracemalloc
+
+DIRECTORY = None  # where stats are dumped, profiling is off if None
+MEMORY = False  # trace allocations as well
+PHASE = "build"  # phase of the processes started from now on
+TOP = 40  # functions and allocation sites in reports
+
+_active = None  # profile of the running profiled() block
+_local = threading.local()
+_thread_profiles = []  # (pid, profile) of threads of this process
+
+
+def setup(directory, memory=False):
+    """enable profiling of processes started from now on"""
+    global DIRECTORY, MEMORY
+    DIRECTORY = directory
+    MEMORY = memory
+    os.makedirs(directory, exist_ok=True)
+    # stats of a previous run would be merged with ours
+    for ext in ("prof", "tracemalloc", "peak"):
+        for path in glob.glob(os.path.join(directory, "*", f"*.{ext}")):
+            os.remove(path)
+
+
+def phase(name):
+    global PHASE
+    PHASE = name
+
+
+@contextlib.contextmanager
+def profiled(name, phase=None):
+    """profile this thread during the block, dumped as name in phase"""
+    global _active
+    if DIRECTORY is None:
+        yield
+        return
+    if _active is not None:
+        # profile of the parent, still hooked in a forked process
+        _active.disable()
+    directory = os.path.join(DIRECTORY, phase or PHASE)
+    os.makedirs(directory, exist_ok=True)
+    base = os.path.join(directory, f"{name}-{os.getpid()}")
+    if MEMORY:
+        if tracemalloc.is_tracing():  # traces of the parent
+            tracemalloc.stop()
+        tracemalloc.start()
+    profile = _active = cProfile.Profile()
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        _active = None
+        stats = pstats.Stats(profile)
+        for pid, thread_profile in _thread_profiles:
+            if pid == os.getpid():
+                stats.add(thread_profile)
+        stats.dump_stats(base + ".prof")
+        if MEMORY:
+            tracemalloc.take_snapshot().dump(base + ".tracemalloc")
+            with open(base + ".peak", "w") as fh:
+                fh.write(str(tracemalloc.get_traced_memory()[1]))
+            tracemalloc.stop()
+
+
+@contextlib.contextmanager
+def thread_profiled():
+    """profile the block in a pool thread of a profiled() process"""
+    if DIRECTORY is None:
+        yield
+        return
+    profile = getattr(_local, "profile", None)
+    if profile is None:
+        profile = _local.profile = cProfile.Profile()
+        _thread_profiles.append((os.getpid(), profile))
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+
+
+def memory_report(directory):
+    """biggest allocation sites of the snapshots of directory"""
+    sites = {}
+    peaks = []
+    ignored = (
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap*>"),
+    )
+    for path in sorted(glob.glob(os.path.join(directory, "*.tracemalloc"))):
+        snapshot = tracemalloc.Snapshot.load(path).filter_traces(ignored)
+        for stat in snapshot.statistics("lineno"):
+            frame = stat.traceback[0]
+            site = sites.setdefault((frame.filename, frame.lineno), [0, 0])
+            site[0] += stat.size
+            site[1] += stat.count
+        base = path[: -len(".tracemalloc")]
+        with open(base + ".peak") as fh:
+            peaks.append((int(fh.read()), os.path.basename(base)))
+    out = io.StringIO()
+    out.write("\nMemory: peak of traced allocations per process\n")
+    for peak, name in sorted(peaks, reverse=True):
+        out.write("{:10.1f} MiB  {}\n".format(peak / 2 ** 20, name))
+    out.write("\nMemory: allocations alive at the end, by line (all processes)\n")
+    for (filename, lineno), (size, count) in sorted(
+        sites.items(), key=lambda item: item[1][0], reverse=True
+    )[:TOP]:
+        out.write(
+            "{:10.1f} KiB {:10} blocks  {}:{}\n".format(
+                size / 1024, count, filename, lineno
+            )
+        )
+    return out.getvalue()
+
+
+def report():
+    """merge stats of the processes of each phase"""
+    if DIRECTORY is None:
+        return
+    for directory in sorted(glob.glob(os.path.join(DIRECTORY, "*", ""))):
+        name = os.path.basename(os.path.dirname(directory))
+        paths = sorted(glob.glob(os.path.join(directory, "*.prof")))
+        if not paths:
+            continue
+        out = io.StringIO()
+        out.write(f"Phase {name}: {len(paths)} processes\n")
+        stats = pstats.Stats(*paths, stream=out)
+        stats.dump_stats(os.path.join(DIRECTORY, f"{name}.prof"))
+        stats.sort_stats("cumulative").print_stats(TOP)
+        stats.sort_stats("tottime").print_stats(TOP)
+        if glob.glob(os.path.join(directory, "*.tracemalloc")):
+            out.write(memory_report(directory))
+        with open(os.path.join(DIRECTORY, f"{name}.txt"), "w") as fh:
+            fh.write(out.getvalue())
+        print("Profile of {} written to {}".format(name, fh.name))
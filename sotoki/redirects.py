@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+"""Redirection entries collected from all processes
+
+Each process (renderers, shards, download service threads) buffers its
+entries and writes them as sorted runs in its own segment files so there
+is no per-entry open/close nor concurrent appends to a shared file.
+merge() combines all runs into a sorted, deduplicated redirection.csv."""
+
+import os
+import glob
+import uuid
+import heapq
+import shutil
+import threading
+import multiprocessing.util
+
+RUN_SIZE = 200000  # entries buffered (then sorted and written) per process
+BUFFER_SIZE = 1024 * 1024
+
+
+def entry_path(line):
+    """(namespace, path) of a redirection line"""
+    namespace, path, _ = line.split("\t", 2)
+    return namespace, path
+
+
+class RedirectSink:
+    def __init__(self, path, run_size=RUN_SIZE):
+        self.path = path
+        self.segments_dir = os.path.join(os.path.dirname(path), "redirection.d")
+        self.run_size = run_size
+        self.lock = threading.Lock()
+        self._pid = None
+        self._entries = []
+        self._runs = 0
+
+    def _own(self):
+        # entries buffered before a fork belong to the parent
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            # pids are reused by the processes of resumed runs
+            self._prefix = f"{self._pid}-{uuid.uuid4().hex[:8]}"
+            self._entries = []
+            self._runs = 0
+            os.makedirs(self.segments_dir, exist_ok=True)
+            # written when the process exits (multiprocessing children included)
+            multiprocessing.util.Finalize(self, self.flush, exitpriority=10)
+
+    def add(self, path, title, target, namespace="A"):
+        with self.lock:
+            self._own()
+            self._entries.append(f"{namespace}\t{path}\t{title}\t{target}\n")
+            if len(self._entries) >= self.run_size:
+                self._write_run()
+
+    def _write_run(self):
+        if not self._entries:
+            return
+        self._entries.sort()
+        run_path = os.path.join(self.segments_dir, f"{self._prefix}-{self._runs}.csv")
+        # renamed once complete: an interrupted run leaves no partial segment
+        with open(run_path + ".tmp", "w", buffering=BUFFER_SIZE) as fh:
+            fh.writelines(self._entries)
+        os.rename(run_path + ".tmp", run_path)
+        self._runs += 1
+        self._entries = []
+
+    def flush(self):
+        """write this process' buffered entries to its segment"""
+        with self.lock:
+            if self._pid == os.getpid():
+                self._write_run()
+
+    @staticmethod
+    def _read_run(path):
+        with open(path, "r", buffering=BUFFER_SIZE) as fh:
+            yield from fh
+
+    def merge(self):
+        """write sorted segments of all processes into path, one entry per url
+
+        returns (entries, duplicates) counts"""
+        self.flush()
+        runs = sorted(glob.glob(os.path.join(self.segments_dir, "*.csv")))
+        entries = duplicates = conflicts = 0
+        previous = last_line = None
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", buffering=BUFFER_SIZE) as fh:
+            for line in heapq.merge(*[self._read_run(run) for run in runs]):
+                key = entry_path(line)
+                if key == previous:
+                    duplicates += 1
+                    if line != last_line:
+                        conflicts += 1
+                        print(f"Conflicting redirection for {key[1]}: {line[:-1]}")
+                    continue
+                fh.write(line)
+                entries += 1
+                previous, last_line = key, line
+        os.replace(tmp_path, self.path)
+        shutil.rmtree(self.segments_dir, ignore_errors=True)
+        print(
+            "Redirections: {} entries written to {}, {} duplicates dropped "
+            "({} conflicting)".format(entries, self.path, duplicates, conflicts)
+        )
+        return entries, duplicates
+
+    def carry_over(self, prefixes):
+        """keep entries of the previous merged file for paths with prefixes
+
+        used by incremental runs for pages which are not rendered again"""
+        shutil.rmtree(self.segments_dir, ignore_errors=True)
+        if not os.path.exists(self.path):
+            return
+        os.makedirs(self.segments_dir, exist_ok=True)
+        kept = 0
+        with open(self.path, "r", buffering=BUFFER_SIZE) as fh, open(
+            os.path.join(self.segments_dir, "previous.csv"), "w", buffering=BUFFER_SIZE
+        ) as previous:
+            for line in fh:
+                if entry_path(line)[1].startswith(prefixes):
+                    previous.write(line)
+                    kept += 1
+        os.remove(self.path)
+        print(f"Redirections: {kept} entries kept from previous run")
+
+    def remove(self):
+        """remove segments and merged file of a previous run"""
+        shutil.rmtree(self.segments_dir, ignore_errors=True)
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def exists(self):
+        return os.path.exists(self.path) or os.path.exists(self.segments_dir)
@@ -5,7 +5,7 @@
 """sotoki.
 
 Usage:
-  sotoki <domain> <publisher> [--directory=<dir>] [--nozim] [--tag-depth=<tag_depth>] [--threads=<threads>] [--zimpath=<zimpath>] [--optimization-cache=<optimization-cache>] [--reset] [--reset-images] [--clean-previous] [--nofulltextindex] [--ignoreoldsite] [--nopic] [--no-userprofile] [--no-identicons] [--no-externallink] [--no-unansweredquestion]
+  sotoki <domain> <publisher> [--directory=<dir>] [--nozim] [--tag-depth=<tag_depth>] [--threads=<threads>] [--zimpath=<zimpath>] [--optimization-cache=<optimization-cache>] [--reset] [--reset-images] [--clean-previous] [--incremental] [--resume] [--nofulltextindex] [--ignoreoldsite] [--nopic] [--no-userprofile] [--no-identicons] [--no-externallink] [--no-unansweredquestion] [--shards=<shards>] [--queue-depth=<queue-depth>] [--image-threads=<image-threads>] [--image-host-connections=<image-host-connections>] [--image-rate=<image-rate>] [--zim-workers=<zim-workers>] [--zim-cluster-size=<zim-cluster-size>] [--metrics-interval=<metrics-interval>] [--metrics-port=<metrics-port>] [--profile=<profile-dir>] [--profile-memory] [--dump-mirror=<dump-mirror>] [--download-connections=<download-connections>] [--keep-xml] [--sharded-layout] [--shared-images=<shared-images>] [--reuse-images=<previous-dump>] [--memory-budget=<memory-budget>]
   sotoki (-h | --help)
   sotoki --version
 
@@ -14,12 +14,18 @@ Options:
   --version                                     Display the version of Sotoki
   --directory=<dir>                             Configure directory in which XML files will be stored [default: download]
   --nozim                                       Doesn't build a ZIM file, output will be in 'work/output/' in flat HTML files
+  --zim-workers=<zim-workers>                   Number of ZIM compression threads [default: 4]
+  --zim-cluster-size=<zim-cluster-size>         Size in bytes of ZIM clusters (compression unit) [default: 2097152]
   --tag-depth=<tag_depth>                       Configure the number of questions, ordered by Score, to display in tags pages (should be a multiple of 100, default all question are in tags pages) [default: -1]
   --threads=<threads>                           Number of threads to use, default is number_of_cores/2
+  --shards=<shards>                             Number of processes each parsing and rendering a part of the questions. Above 1, questions are rendered by these processes instead of --threads workers [default: 1]
+  --queue-depth=<queue-depth>                   Number of batches of pages waiting to be rendered, per thread [default: 4]
   --zimpath=<zimpath>                           Final path of the zim file
   --reset                                       Reset dump
   --reset-images                                Remove images in cache
   --clean-previous                              Delete only data from a previous run with '--nozim' or which failed
+  --incremental                                 Keep pages of the previous run (in output/) and only render the ones whose content changed, remove the ones gone from the dump
+  --resume                                      Continue an interrupted run from its last checkpoint instead of starting over (rendered pages are only reused when kept on disk: --nozim or --incremental)
   --nofulltextindex                             Doesn't index content
   --ignoreoldsite                               Ignore Stack Exchange closed sites
   --nopic                                       Doesn't download images
@@ -27,6 +33,20 @@ Options:
   --no-identicons                               Use generated profile picture only (user images won't be downloaded)
   --no-externallink                             Remove external link
   --no-unansweredquestion                       Doesn't include questions with no answers
+  --image-threads=<image-threads>               Number of concurrent image downloads [default: 16]
+  --image-host-connections=<image-host-connections>  Maximum concurrent downloads from a single host [default: 4]
+  --image-rate=<image-rate>                     Maximum image requests per second, 0 for unlimited [default: 0]
+  --metrics-interval=<metrics-interval>         Seconds between two snapshots of build metrics written to metrics.jsonl in the dump directory [default: 30]
+  --metrics-port=<metrics-port>                 Serve build metrics in Prometheus text format on http://127.0.0.1:<port>/metrics
+  --profile=<profile-dir>                       Profile the parser and every worker process with cProfile, one merged report per phase in the given directory
+  --profile-memory                              With --profile, also trace memory allocations with tracemalloc (much slower)
+  --dump-mirror=<dump-mirror>                   URL of the directory holding the dump archives and their stackexchange_files.xml [default: https://archive.org/download/stackexchange]
+  --download-connections=<download-connections>  Number of concurrent connections downloading segments of the dump archives [default: 8]
+  --keep-xml                                    Write the XML files of the dump archives to the dump directory while they are decompressed for the prepare stage (by default they are only streamed, or removed once read when extracted from an archive holding several of them)
+  --sharded-layout                              Store question and user pages and images of the output tree in two levels of sub-directories (question/78/56/12345678.html) so no directory holds millions of files, their ZIM paths are unchanged
+  --shared-images=<shared-images>               Directory where common images (default avatars…) are kept for all builds and linked from, instead of being downloaded by each
+  --reuse-images=<previous-dump>                Link the images of the output tree of another dump directory (e.g. of a previous dump of the site) into this one before rendering, they are not downloaded again
+  --memory-budget=<memory-budget>               Memory the build should stay within, in MiB or with a G suffix (e.g. 12G): under pressure, rendering workers are fed more slowly, posts with a lot of answers and comments are rendered by the parser, temporary images are written to disk instead of /dev/shm and the prepare stage spills to disk earlier
   --optimization-cache=<optimization-cache>     Use optimization cache with given URL and credentials. The argument needs to be of the form <endpoint-url>?keyId=<key-id>&secretAccessKey=<secret-access-key>&bucketName=<bucket-name>
 """
 import re
@@ -34,9 +54,11 @@ import sys
 import os
 import html
 import shlex
+import time
 import shutil
+import itertools
+import functools
 import requests
-import sqlite3
 import os.path
 import pathlib
 import tempfile
@@ -45,8 +67,7 @@ import subprocess
 from hashlib import sha256
 from string import punctuation
 from docopt import docopt, DocoptExit
-from distutils.dir_util import copy_tree
-from multiprocessing import cpu_count, Queue, Process
+from multiprocessing import cpu_count, Process
 from xml.sax import make_parser, handler
 import urllib.request
 import urllib.parse
@@ -58,15 +79,33 @@ from slugify import slugify
 import bs4 as BeautifulSoup
 from jinja2 import Environment
 from jinja2 import FileSystemLoader
-from lxml import etree
+from jinja2 import FileSystemBytecodeCache
 from lxml.html import fromstring as string2html
 from lxml.html import tostring as html2string
 from kiwixstorage import KiwixStorage
 from pif import get_public_ip
-from zimscraperlib.download import save_large_file
-from zimscraperlib.zim import make_zim_file
 from zimscraperlib.filesystem import get_file_mimetype
 
+from . import downloader
+from . import dumpdownload
+from .database import open_db, BulkInserter
+from .downloader import DownloadService
+from . import imageopt
+from . import layout
+from . import memory
+from . import metrics
+from . import prepare_xml
+from . import profiling
+from . import storage
+from .imagecache import ImageCache
+from .manifest import Manifest
+from .channel import TaskChannel, QUEUE_DEPTH
+from .checkpoint import Checkpoint
+from .prepare_xml import prepare_dump, post_shards, PostShard, DumpFiles
+from .redirects import RedirectSink
+from .userdir import UserDirectory
+from .zimsink import ZimSink
+
 ROOT_DIR = pathlib.Path(__file__).parent
 NAME = ROOT_DIR.name
 
@@ -79,10 +118,19 @@ MARKDOWN = None
 TMPFS_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else None
 
 CACHE_STORAGE_URL = None
-
-redirect_file = None
+SHARED_IMAGES = None  # directory of common images shared by builds (if any)
+IMAGE_SERVICE = None  # DownloadService fetching images in the background
+IMAGE_CACHE = None  # ImageCache of download results from this and previous runs
+GIF_BATCH = None  # GifBatch of the download service
+REDIRECTS = None  # RedirectSink collecting redirection.csv entries
+ZIM = None  # ZimSink rendered pages are added to (None with --nozim)
+MANIFEST = None  # Manifest of pages of previous runs (--incremental)
+CHECKPOINT = None  # Checkpoint of completed phases (continued with --resume)
+CHECKPOINT_INTERVAL = 200000  # questions between two question watermarks
 output_dir = None
 
+QUESTIONTAG_SCHEMA = "CREATE TABLE IF NOT EXISTS questiontag(id INTEGER PRIMARY KEY AUTOINCREMENT UNIQUE, Score INTEGER, Title TEXT, QId INTEGER, CreationDate TEXT, Tag TEXT)"
+
 
 #########################
 #        Question       #
@@ -97,6 +145,7 @@ class QuestionRender(handler.ContentHandler):
         cores,
         cursor,
         conn,
+        users,
         site_url,
         domain,
         mathjax,
@@ -104,6 +153,8 @@ class QuestionRender(handler.ContentHandler):
         nouserprofile,
         noexternallink,
         no_unansweredquestion,
+        queue_depth=QUEUE_DEPTH,
+        checkpoint_name="questions",
     ):
         self.templates = templates
         self.title = title
@@ -112,6 +163,7 @@ class QuestionRender(handler.ContentHandler):
         self.cores = cores
         self.cursor = cursor
         self.conn = conn
+        self.users = users
         self.site_url = site_url
         self.domain = domain
         self.post = {}
@@ -119,19 +171,54 @@ class QuestionRender(handler.ContentHandler):
         self.answers = []
         self.whatwedo = "post"
         self.nb = 0  # Nomber of post generate
-        os.makedirs(os.path.join(output_dir, "question"))
-        self.request_queue = Queue(cores * 2)
-        self.workers = []
+        os.makedirs(os.path.join(output_dir, "question"), exist_ok=True)
         self.conn = conn
         self.mathjax = mathjax
         self.nopic = nopic
         self.nouserprofile = nouserprofile
         self.noexternallink = noexternallink
         self.no_unansweredquestion = no_unansweredquestion
-        for i in range(self.cores):
-            self.workers.append(Worker(self.request_queue))
-        for i in self.workers:
-            i.start()
+        self.questiontags = BulkInserter(
+            conn,
+            "INSERT INTO QuestionTag(Score, Title, QId, CreationDate, Tag) VALUES(?, ?, ?, ?, ?)",
+            "questiontag",
+        )
+        # questions up to the watermark were rendered by an interrupted run,
+        # rows of the following ones are written again
+        self.checkpoint_name = checkpoint_name
+        self.watermark = CHECKPOINT.watermark(checkpoint_name) if CHECKPOINT else None
+        with conn:
+            conn.execute(
+                "DELETE FROM questiontag WHERE QId > ?", (self.watermark or 0,)
+            )
+        if self.watermark is not None:
+            print(f"Resuming {checkpoint_name} after question {self.watermark}")
+        # rendered in the parser process without cores (sharded run)
+        self.channel = TaskChannel(
+            some_questions,
+            dict(
+                templates=templates,
+                title=title,
+                publisher=publisher,
+                template_name="question.html",
+                site_url=site_url,
+                domain=domain,
+                mathjax=mathjax,
+                nopic=nopic,
+                nouserprofile=nouserprofile,
+                noexternallink=noexternallink,
+            ),
+            cores,
+            depth=queue_depth,
+            key=lambda post: int(post["Id"]),
+        )
+
+    def get_user(self, user_id):
+        """users row of user_id from the in-memory directory, None if unknown"""
+        user = self.users.get(int(user_id))
+        if user is None:
+            return None
+        return {"id": int(user_id), "DisplayName": user[0], "Reputation": user[1]}
 
     def startElement(self, name, attrs):  # For each element
         if (
@@ -165,9 +252,7 @@ class QuestionRender(handler.ContentHandler):
             if (
                 "OwnerUserId" in tmp
             ):  # We put the good name of the user how made the post
-                user = self.cursor.execute(
-                    "SELECT * FROM users WHERE id = ?", (int(tmp["OwnerUserId"]),)
-                ).fetchone()
+                user = self.get_user(tmp["OwnerUserId"])
                 oid = tmp["OwnerUserId"]
                 if user is not None:
                     tmp["OwnerUserId"] = dict_to_unicodedict(user)
@@ -197,9 +282,7 @@ class QuestionRender(handler.ContentHandler):
                 tmp[k] = attrs[k]
             # print "                 new comments"
             if "UserId" in tmp:  # We put the good name of the user how made the comment
-                user = self.cursor.execute(
-                    "SELECT * FROM users WHERE id = ?", (int(tmp["UserId"]),)
-                ).fetchone()
+                user = self.get_user(tmp["UserId"])
                 if "UserId" in tmp and user is not None:
                     tmp["UserDisplayName"] = dict_to_unicodedict(user)["DisplayName"]
                     if self.nouserprofile:
@@ -251,9 +334,7 @@ class QuestionRender(handler.ContentHandler):
             if (
                 "OwnerUserId" in self.post
             ):  # We put the good name of the user how made the post
-                user = self.cursor.execute(
-                    "SELECT * FROM users WHERE id = ?", (int(self.post["OwnerUserId"]),)
-                ).fetchone()
+                user = self.get_user(self.post["OwnerUserId"])
                 oid = self.post["OwnerUserId"]
                 if user is not None:
                     self.post["OwnerUserId"] = dict_to_unicodedict(user)
@@ -293,6 +374,12 @@ class QuestionRender(handler.ContentHandler):
             self.post["comments"] = self.comments
 
         if name == "post":
+            if self.watermark is not None and int(self.post["Id"]) <= self.watermark:
+                # rendered before the interruption
+                self.post = {}
+                self.comments = []
+                self.answers = []
+                return
             if self.no_unansweredquestion and self.answers == [] :
                 # Reset element
                 self.post = {}
@@ -301,83 +388,164 @@ class QuestionRender(handler.ContentHandler):
                 return
             # print self.post
             self.nb += 1
+            metrics.count("questions_parsed")
             if self.nb % 1000 == 0:
                 print("Already " + str(self.nb) + " questions done!")
-                self.conn.commit()
             self.post["Tags"] = self.post["Tags"][1:-1].split("><")
             for t in self.post["Tags"]:  # We put tags into db
-                sql = "INSERT INTO QuestionTag(Score, Title, QId, CreationDate, Tag) VALUES(?, ?, ?, ?, ?)"
-                self.cursor.execute(
-                    sql,
+                self.questiontags.add(
                     (
                         self.post["Score"],
                         self.post["Title"],
                         self.post["Id"],
                         self.post["CreationDate"],
                         t,
-                    ),
+                    )
                 )
             # Make redirection
             for ans in self.answers:
-                with open(redirect_file, "a") as f_redirect:
-                    f_redirect.write(
-                        "A\telement/"
-                        + str(ans["Id"])
-                        + "\tAnswer "
-                        + str(ans["Id"])
-                        + "\tA/question/"
-                        + self.post["Id"]
-                        + ".html"
-                        + "\n"
-                    )
-            with open(redirect_file, "a") as f_redirect:
-                f_redirect.write(
-                    "A\telement/"
-                    + str(self.post["Id"])
-                    + "\tQuestion "
-                    + str(self.post["Id"])
-                    + "\tA/question/"
-                    + self.post["Id"]
-                    + ".html"
-                    + "\n"
+                REDIRECTS.add(
+                    "element/" + str(ans["Id"]),
+                    "Answer " + str(ans["Id"]),
+                    "A/question/" + self.post["Id"] + ".html",
                 )
+            REDIRECTS.add(
+                "element/" + str(self.post["Id"]),
+                "Question " + str(self.post["Id"]),
+                "A/question/" + self.post["Id"] + ".html",
+            )
 
-            data_send = [
-                some_questions,
-                self.templates,
-                self.title,
-                self.publisher,
-                self.post,
-                "question.html",
-                self.site_url,
-                self.domain,
-                self.mathjax,
-                self.nopic,
-                self.nouserprofile,
-                self.noexternallink,
-            ]
-            self.request_queue.put(data_send)
-            # some_questions(self.templates, self.title, self.publisher, self.post, "question.html", self.site_url, self.domain, self.mathjax, self.nopic)
+            if MANIFEST is None or MANIFEST.changed(
+                "question", "question/" + self.post["filename"], self.post
+            ):
+                if memory.oversized(self.post):
+                    metrics.count("posts_rendered_in_parser")
+                    self.channel.put_here(self.post)
+                else:
+                    self.channel.put(self.post)
+            if CHECKPOINT is not None and self.nb % CHECKPOINT_INTERVAL == 0:
+                self.save_watermark()
             # Reset element
             self.post = {}
             self.comments = []
             self.answers = []
 
+    def save_watermark(self):
+        """record the last question rendered with all previous ones"""
+        self.questiontags.flush()
+        # manifest entries of questions queued beyond the watermark only
+        # hold pending hashes: a resumed run still finds them changed
+        # unless their page was written (see Manifest.rendered)
+        persist_progress()
+        processed = self.channel.processed()
+        if processed is not None:
+            CHECKPOINT.set_watermark(self.checkpoint_name, processed)
+
     def endDocument(self):
-        self.conn.commit()
+        self.questiontags.flush()
+        self.questiontags.report()
         # closing thread
-        for i in range(self.cores):
-            self.request_queue.put(None)
-        for i in self.workers:
-            i.join()
+        self.channel.close()
+        persist_progress()
         print("---END--")
 
 
+class QuestionShard(Process):
+    """Parse and render one range of prepare.xml in its own process
+
+    Questions are rendered inline (no Worker) and questiontag rows go to
+    a shard-specific database, merged by merge_question_shards"""
+
+    def __init__(self, index, nb_shards, start, end, dump, render_args):
+        super(QuestionShard, self).__init__()
+        self.index = index
+        self.checkpoint_name = f"questions-{index}-of-{nb_shards}"
+        self.start_offset = start
+        self.end_offset = end
+        self.dump = dump
+        self.render_args = render_args
+        self.db = os.path.join(dump, f"questiontag-{index}.db")
+
+    def run(self):
+        conn = open_db(self.db)
+        conn.row_factory = dict_factory
+        cursor = conn.cursor()
+        cursor.execute(QUESTIONTAG_SCHEMA)
+        parser = make_parser()
+        parser.setContentHandler(
+            QuestionRender(
+                dump=self.dump,
+                cores=0,
+                cursor=cursor,
+                conn=conn,
+                checkpoint_name=self.checkpoint_name,
+                **self.render_args,
+            )
+        )
+        source = PostShard(
+            os.path.join(self.dump, "prepare.xml"), self.start_offset, self.end_offset
+        )
+        try:
+            with profiling.profiled(f"shard-{self.index}"):
+                parser.parse(source)
+            CHECKPOINT.complete(self.checkpoint_name)
+        finally:
+            source.close()
+            conn.close()
+
+
+def render_question_shards(dump, conn, nb_shards, render_args):
+    """render prepare.xml with nb_shards parser+renderer processes"""
+    os.makedirs(os.path.join(output_dir, "question"), exist_ok=True)
+    shards = [
+        QuestionShard(index, nb_shards, start, end, dump, render_args)
+        for index, (start, end) in enumerate(
+            post_shards(os.path.join(dump, "prepare.xml"), nb_shards)
+        )
+    ]
+    conn.execute("CREATE TABLE IF NOT EXISTS merged_shards(shard INTEGER PRIMARY KEY)")
+    pending = [
+        shard for shard in shards if not CHECKPOINT.done(shard.checkpoint_name)
+    ]
+    if len(pending) == len(shards):
+        # shards are only merged once all are rendered
+        with conn:
+            conn.execute("DELETE FROM questiontag")
+            conn.execute("DELETE FROM merged_shards")
+    for shard in pending:
+        shard.start()
+    for shard in pending:
+        shard.join()
+    if any(shard.exitcode != 0 for shard in pending):
+        sys.exit("A question shard failed :(")
+    merge_question_shards(conn, shards)
+
+
+def merge_question_shards(conn, shards):
+    """append each shard's questiontag rows to the main table
+
+    a shard is recorded as merged along with its rows"""
+    for shard in shards:
+        if conn.execute(
+            "SELECT 1 FROM merged_shards WHERE shard = ?", (shard.index,)
+        ).fetchone():
+            continue
+        conn.execute("ATTACH DATABASE ? AS shard", (shard.db,))
+        with conn:
+            conn.execute(
+                "INSERT INTO questiontag(Score, Title, QId, CreationDate, Tag) "
+                "SELECT Score, Title, QId, CreationDate, Tag FROM shard.questiontag"
+            )
+            conn.execute("INSERT INTO merged_shards(shard) VALUES(?)", (shard.index,))
+        conn.execute("DETACH DATABASE shard")
+        os.remove(shard.db)
+
+
 def some_questions(
+    question,
     templates,
     title,
     publisher,
-    question,
     template_name,
     site_url,
     domain,
@@ -396,25 +564,28 @@ def some_questions(
                 question["answers"], key=lambda k: k["Accepted"], reverse=True
             )  # sorted is stable so accepted will be always first, then other question will be sort in ascending order
             for ans in question["answers"]:
-                ans["Body"] = interne_link(ans["Body"], domain, nouserprofile, noexternallink)
-                ans["Body"] = image(ans["Body"], nopic)
+                ans["Body"] = rewrite_html(
+                    ans["Body"], domain, nouserprofile, noexternallink, nopic
+                )
                 if "comments" in ans:
                     for comment in ans["comments"]:
-                        comment["Text"] = interne_link(
+                        comment["Text"] = rewrite_html(
                             comment["Text"],
                             domain,
                             nouserprofile,
                             noexternallink,
+                            nopic,
                         )
-                        comment["Text"] = image(comment["Text"], nopic)
 
-        filepath = os.path.join(output_dir, "question", question["filename"])
-        question["Body"] = interne_link(question["Body"], domain, nouserprofile, noexternallink)
-        question["Body"] = image(question["Body"], nopic)
+        filepath = output_path(os.path.join("question", question["filename"]))
+        question["Body"] = rewrite_html(
+            question["Body"], domain, nouserprofile, noexternallink, nopic
+        )
         if "comments" in question:
             for comment in question["comments"]:
-                comment["Text"] = interne_link(comment["Text"], domain, nouserprofile, noexternallink)
-                comment["Text"] = image(comment["Text"], nopic)
+                comment["Text"] = rewrite_html(
+                    comment["Text"], domain, nouserprofile, noexternallink, nopic
+                )
         question["Title"] = html.escape(question["Title"], quote=False)
         try:
             jinja(
@@ -456,6 +627,7 @@ class TagsRender(handler.ContentHandler):
         tag_depth,
         description,
         mathjax,
+        queue_depth=QUEUE_DEPTH,
     ):
         # index page
         self.templates = templates
@@ -468,8 +640,9 @@ class TagsRender(handler.ContentHandler):
         self.description = description
         self.tag_depth = tag_depth
         self.mathjax = mathjax
+        self.queue_depth = queue_depth
         self.tags = []
-        sql = "CREATE INDEX index_tag ON questiontag (Tag)"
+        sql = "CREATE INDEX IF NOT EXISTS index_tag ON questiontag (Tag, Score DESC, QId, Title, CreationDate)"
         self.cursor.execute(sql)
 
     def startElement(self, name, attrs):  # For each element
@@ -521,59 +694,87 @@ class TagsRender(handler.ContentHandler):
         )
         # tag page
         print("Render tag page")
-        list_tag = [d["TagName"] for d in self.tags]
-        os.makedirs(os.path.join(output_dir, "tag"))
-        for tag in list(set(list_tag)):
-            dirpath = os.path.join(output_dir, "tag")
-            tagpath = os.path.join(dirpath, "%s" % tag)
-            os.makedirs(tagpath)
-            # build page using pagination
-            offset = 0
-            page = 1
-            if self.tag_depth == -1:
-                questions = self.cursor.execute(
-                    "SELECT * FROM questiontag WHERE Tag = ? ORDER BY Score DESC",
-                    (str(tag),),
-                )
-            else:
-                questions = self.cursor.execute(
-                    "SELECT * FROM questiontag WHERE Tag = ? ORDER BY Score DESC LIMIT ?",
-                    (
-                        str(tag),
-                        self.tag_depth,
-                    ),
+        tags = set(d["TagName"] for d in self.tags)
+        dirpath = os.path.join(output_dir, "tag")
+        os.makedirs(dirpath, exist_ok=True)
+        channel = TaskChannel(
+            some_tag_page,
+            dict(
+                templates=self.templates,
+                title=self.title,
+                publisher=self.publisher,
+                mathjax=self.mathjax,
+            ),
+            self.cores,
+            depth=self.queue_depth,
+        )
+        # a single scan of the (Tag, Score DESC) covering index gives every
+        # tag's questions already sorted, paginated as they come
+        questions = self.cursor.execute(
+            "SELECT Tag, QId, Title, Score, CreationDate FROM questiontag ORDER BY Tag, Score DESC"
+        )
+        rendered = set()
+        for tag, tag_questions in itertools.groupby(questions, key=lambda k: k["Tag"]):
+            if tag not in tags:
+                continue
+            rendered.add(tag)
+            if self.tag_depth != -1:
+                tag_questions = itertools.islice(tag_questions, self.tag_depth)
+            self.render_tag(channel, dirpath, tag, tag_questions)
+        for tag in tags - rendered:
+            self.render_tag(channel, dirpath, tag, [])
+        # closing thread
+        channel.close()
+
+    def render_tag(self, channel, dirpath, tag, tag_questions):
+        """queue rendering of tag's pages from its sorted questions"""
+        tagpath = os.path.join(dirpath, "%s" % tag)
+        os.makedirs(tagpath, exist_ok=True)
+        tag_questions = iter(tag_questions)
+        # build page using pagination
+        page = 1
+        hasnext = True
+        while hasnext:
+            some_questions = list(itertools.islice(tag_questions, 100))
+            hasnext = len(some_questions) == 100
+            if MANIFEST is None or MANIFEST.changed(
+                "tag",
+                "tag/%s/%s.html" % (tag, page),
+                [some_questions[:99], hasnext],
+            ):
+                channel.put(
+                    os.path.join(tagpath, "%s.html" % page),
+                    tag,
+                    page,
+                    some_questions[:99],
+                    hasnext,
                 )
+            page += 1
 
-            while offset is not None:
-                fullpath = os.path.join(tagpath, "%s.html" % page)
-                some_questions = questions.fetchmany(100)
-                if len(some_questions) != 100:
-                    offset = None
-                else:
-                    offset += len(some_questions)
-                some_questions = some_questions[:99]
-                for question in some_questions:
-                    question["filepath"] = str(question["QId"]) + ".html"
-                    question["Title"] = html.escape(question["Title"], quote=False)
-                hasprevious = page != 1
-                jinja(
-                    fullpath,
-                    "tag.html",
-                    self.templates,
-                    False,
-                    tag=tag,
-                    index=page,
-                    questions=some_questions,
-                    rooturl="../..",
-                    hasnext=bool(offset),
-                    next=page + 1,
-                    hasprevious=hasprevious,
-                    previous=page - 1,
-                    title=self.title,
-                    publisher=self.publisher,
-                    mathjax=self.mathjax,
-                )
-                page += 1
+
+def some_tag_page(
+    fullpath, tag, page, questions, hasnext, templates, title, publisher, mathjax
+):
+    for question in questions:
+        question["filepath"] = str(question["QId"]) + ".html"
+        question["Title"] = html.escape(question["Title"], quote=False)
+    jinja(
+        fullpath,
+        "tag.html",
+        templates,
+        False,
+        tag=tag,
+        index=page,
+        questions=questions,
+        rooturl="../..",
+        hasnext=hasnext,
+        next=page + 1,
+        hasprevious=page != 1,
+        previous=page - 1,
+        title=title,
+        publisher=publisher,
+        mathjax=mathjax,
+    )
 
 
 #########################
@@ -589,6 +790,7 @@ class UsersRender(handler.ContentHandler):
         cores,
         cursor,
         conn,
+        users,
         site_url,
         mathjax,
         nopic,
@@ -596,6 +798,7 @@ class UsersRender(handler.ContentHandler):
         nouserprofile,
         noexternallink,
         domain,
+        queue_depth=QUEUE_DEPTH,
     ):
         self.identicon_path = os.path.join(output_dir, "static", "identicon")
         self.templates = templates
@@ -605,6 +808,7 @@ class UsersRender(handler.ContentHandler):
         self.cores = cores
         self.cursor = cursor
         self.conn = conn
+        self.users = users
         self.site_url = site_url
         self.mathjax = mathjax
         self.nopic = nopic
@@ -615,7 +819,7 @@ class UsersRender(handler.ContentHandler):
         self.id = 0
         if not os.path.exists(self.identicon_path):
             os.makedirs(self.identicon_path)
-        os.makedirs(os.path.join(output_dir, "user"))
+        os.makedirs(os.path.join(output_dir, "user"), exist_ok=True)
         # Set-up a list of foreground colours (taken from Sigil).
         self.foreground = [
             "rgb(45,79,255)",
@@ -629,13 +833,30 @@ class UsersRender(handler.ContentHandler):
         # Set-up a background colour (taken from Sigil).
         self.background = "rgb(224,224,224)"
 
-        self.request_queue = Queue(cores * 2)
-        self.workers = []
+        self.db_users = BulkInserter(
+            conn,
+            "INSERT INTO users(id, DisplayName, Reputation) VALUES(?, ?, ?)",
+            "users",
+        )
+
         self.user = {}
-        for i in range(self.cores):
-            self.workers.append(Worker(self.request_queue))
-        for i in self.workers:
-            i.start()
+        self.channel = TaskChannel(
+            some_user,
+            dict(
+                templates=templates,
+                publisher=publisher,
+                site_url=site_url,
+                title=title,
+                mathjax=mathjax,
+                nopic=nopic,
+                no_identicons=no_identicons,
+                nouserprofile=nouserprofile,
+                noexternallink=noexternallink,
+                domain=domain,
+            ),
+            cores,
+            depth=queue_depth,
+        )
 
     def startElement(self, name, attrs):  # For each element
         if name == "badges":
@@ -650,9 +871,9 @@ class UsersRender(handler.ContentHandler):
                 self.user["badges"][tmp["Name"]] = 1
         if name == "row":
             self.id += 1
+            metrics.count("users_parsed")
             if self.id % 1000 == 0:
                 print("Already " + str(self.id) + " Users done !")
-                self.conn.commit()
             self.user = {}
             for k in list(attrs.keys()):  # get all item
                 self.user[k] = attrs[k]
@@ -660,45 +881,34 @@ class UsersRender(handler.ContentHandler):
     def endElement(self, name):
         if name == "row":
             user = self.user
-            sql = "INSERT INTO users(id, DisplayName, Reputation) VALUES(?, ?, ?)"
-            self.cursor.execute(
-                sql, (int(user["Id"]), user["DisplayName"], user["Reputation"])
+            self.db_users.add(
+                (int(user["Id"]), user["DisplayName"], user["Reputation"])
             )
+            self.users.add(user["Id"], user["DisplayName"], user["Reputation"])
             if not self.nouserprofile:
-                with open(redirect_file, "a") as f_redirect:
-                    f_redirect.write(
-                        "A\tuser/"
-                        + page_url(user["Id"], user["DisplayName"])
-                        + "\tUser "
-                        + slugify(user["DisplayName"])
-                        + "\tA/user/"
-                        + user["Id"]
-                        + "\n"
-                    )
-            data_send = [
-                some_user,
-                user,
-                self.templates,
-                self.publisher,
-                self.site_url,
-                self.title,
-                self.mathjax,
-                self.nopic,
-                self.no_identicons,
-                self.nouserprofile,
-                self.noexternallink,
-                self.domain,
-            ]
-            self.request_queue.put(data_send)
-            # some_user(user, self.generator, self.templates, self.publisher, self.site_url, self.title, self.mathjax, self.nopic, self.nouserprofile, self.domain)
+                REDIRECTS.add(
+                    "user/" + page_url(user["Id"], user["DisplayName"]),
+                    "User " + slugify(user["DisplayName"]),
+                    "A/user/" + user["Id"],
+                )
+            # without profile pages, only the identicon is to be fetched
+            if (
+                MANIFEST is None
+                or self.nouserprofile
+                or MANIFEST.changed("user", "user/" + user["Id"], user)
+            ):
+                self.channel.put(user)
 
     def endDocument(self):
-        self.conn.commit()
+        self.db_users.flush()
+        self.db_users.report()
+        print(
+            "User directory: {} users in {:.1f} MiB".format(
+                len(self.users), self.users.memory_usage() / 2 ** 20
+            )
+        )
         # closing thread
-        for i in range(self.cores):
-            self.request_queue.put(None)
-        for i in self.workers:
-            i.join()
+        self.channel.close()
         print("---END--")
 
 
@@ -716,33 +926,54 @@ def some_user(
     domain,
 ):
     filename = user["Id"] + ".png"
-    fullpath = os.path.join(output_dir, "static", "identicon", filename)
-    if (
+    fullpath = output_path(os.path.join("static", "identicon", filename))
+    status, target = None, None
+    if IMAGE_CACHE is not None and "ProfileImageUrl" in user:
+        status, target = IMAGE_CACHE.lookup(user["ProfileImageUrl"])
+    # several users can share a ProfileImageUrl, redirected to the first copy
+    if target and target != zim_path(fullpath):
+        REDIRECTS.add(zim_path(fullpath), "Image Redirection", f"A/{target}")
+    elif (
         not nopic
         and "ProfileImageUrl" in user
-        and not os.path.exists(fullpath)
         and not no_identicons
+        and status != "failed"
+        and not os.path.exists(fullpath)
     ):
-        try:
-            download_image(
-                user["ProfileImageUrl"],
-                fullpath,
-                convert_png=True,
-                resize=128,
+        layout.ensure_dir(fullpath)
+        if IMAGE_SERVICE is not None:
+            IMAGE_SERVICE.submit(
+                user["ProfileImageUrl"], fullpath, convert_png=True, resize=128
             )
-        except Exception as exc:
-            print(user["ProfileImageUrl"] + " > Failed to download\n" + str(exc) + "\n")
+        else:
+            try:
+                download_image(
+                    user["ProfileImageUrl"],
+                    fullpath,
+                    convert_png=True,
+                    resize=128,
+                )
+            except Exception as exc:
+                print(
+                    user["ProfileImageUrl"]
+                    + " > Failed to download\n"
+                    + str(exc)
+                    + "\n"
+                )
 
     #
     if not nouserprofile:
         if "AboutMe" in user:
-            user["AboutMe"] = interne_link(
-                "<p>" + user["AboutMe"] + "</p>", domain, nouserprofile, noexternallink
+            user["AboutMe"] = rewrite_html(
+                "<p>" + user["AboutMe"] + "</p>",
+                domain,
+                nouserprofile,
+                noexternallink,
+                nopic,
             )
-            user["AboutMe"] = image(user["AboutMe"], nopic)
         # generate user profile page
         filename = user["Id"]
-        fullpath = os.path.join(output_dir, "user", filename)
+        fullpath = output_path(os.path.join("user", filename))
         jinja(
             fullpath,
             "user.html",
@@ -763,21 +994,6 @@ def some_user(
 #########################
 
 
-class Worker(Process):
-    def __init__(self, queue):
-        super(Worker, self).__init__()
-        self.queue = queue
-
-    def run(self):
-        for data in iter(self.queue.get, None):
-            try:
-                data[0](*data[1:])
-                # some_questions(*data)
-            except Exception as exc:
-                print("error while rendering :", data)
-                print(exc)
-
-
 def intspace(value):
     orig = str(value)
     new = re.sub(r"^(-?\d+)(\d{3})", r"\g<1> \g<2>", orig)
@@ -815,26 +1031,64 @@ def scale(number):
     return "verygood"
 
 
+def output_path(path):
+    """on-disk path of ZIM path in the output tree (see layout)"""
+    return os.path.join(output_dir, layout.disk_path(path))
+
+
+def zim_path(fpath):
+    """ZIM path of file fpath of the output tree"""
+    return layout.zim_path(os.path.relpath(fpath, output_dir))
+
+
 def page_url(ident, name):
     return str(ident) + "/" + slugify(name)
 
 
 ENV = None  # Jinja environment singleton
+TEMPLATES = {}  # compiled templates by name, loaded once by jinja_init
 
 
 def jinja(output, template, templates, raw, **context):
-    template = ENV.get_template(template)
-    page = template.render(**context)
-    if raw:
-        page = "{% raw %}" + page + "{% endraw %}"
+    name = template
+    template = TEMPLATES[template]
+    metrics.count("pages_rendered", template=name)
+    if ZIM is not None and MANIFEST is None:
+        page = template.render(**context)
+        if raw:
+            page = "{% raw %}" + page + "{% endraw %}"
+        metrics.count("bytes_written", len(page.encode("utf-8")), template=name)
+        ZIM.add_page(zim_path(output), page)
+        return
+    layout.ensure_dir(output)
+    # streamed to the file instead of building the whole page first
     with open(output, "w") as f:
-        f.write(page)
+        if raw:
+            f.write("{% raw %}")
+        f.writelines(template.generate(**context))
+        if raw:
+            f.write("{% endraw %}")
+        metrics.count("bytes_written", f.tell(), template=name)
+    if MANIFEST is not None:
+        # only now the page matches the data it was changed() with
+        MANIFEST.rendered(zim_path(output))
+
 
+def jinja_init(templates, cache_dir=None):
+    """set up ENV and compile all templates (before workers are forked)
 
-def jinja_init(templates):
+    compiled templates are kept in cache_dir (if any) for the next runs"""
     global ENV
     templates = os.path.abspath(templates)
-    ENV = Environment(loader=FileSystemLoader((templates,)))
+    bytecode_cache = None
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+        bytecode_cache = FileSystemBytecodeCache(cache_dir)
+    ENV = Environment(
+        loader=FileSystemLoader((templates,)),
+        bytecode_cache=bytecode_cache,
+        auto_reload=False,
+    )
     filters = dict(
         markdown=markdown,
         intspace=intspace,
@@ -843,10 +1097,14 @@ def jinja_init(templates):
         slugify=slugify,
     )
     ENV.filters.update(filters)
+    for name in ENV.list_templates():
+        TEMPLATES[name] = ENV.get_template(name)
 
 
 def get_tempfile(suffix):
-    return tempfile.NamedTemporaryFile(suffix=suffix, dir=TMPFS_DIR, delete=False).name
+    return tempfile.NamedTemporaryFile(
+        suffix=suffix, dir=memory.temp_dir(TMPFS_DIR), delete=False
+    ).name
 
 
 def get_filetype(path):
@@ -903,7 +1161,7 @@ def upload_to_cache(fpath, key, meta_tag, meta_val):
 def get_response_headers(url):
     for attempt in range(5):
         try:
-            return requests.head(url=url, allow_redirects=True, timeout=30).headers
+            return downloader.request("HEAD", url, allow_redirects=True).headers
         except requests.exceptions.Timeout:
             print(f"{url} > HEAD request timed out ({attempt})")
     raise Exception("Max retries exceeded")
@@ -943,7 +1201,20 @@ def get_image_shortcuts(url, convert_png, resize, ext):
             .joinpath(f"{source}_{convertion}_{size}{ext}")
         )
 
-        # download the duplicate file only once
+        # download the duplicate file only once (for all builds if shared)
+        if not image_path.exists() and SHARED_IMAGES:
+            shared_path = os.path.join(SHARED_IMAGES, image_path.name)
+            if not os.path.exists(shared_path):
+                download_image(
+                    url=url,
+                    fullpath=shared_path,
+                    convert_png=convert_png,
+                    resize=resize,
+                    skip_duplicate_check=True,
+                )
+            # not there yet if stored later (GIF batch)
+            if os.path.exists(shared_path):
+                storage.link_file(shared_path, str(image_path))
         if not image_path.exists():
             download_image(
                 url=url,
@@ -1057,14 +1328,11 @@ def handle_duplicate_images(url, fullpath, convert_png, resize):
         return True
     if redirection:
         # got a redirection to a common image
-        src_path = str(org_path.relative_to(pathlib.Path(output_dir)))
+        src_path = zim_path(fullpath)
         dst_path = f"A/common_images/{redirection}"
-        print("before redirect write")
-        print("redirection")
-        with open(redirect_file, "a") as f_redirect:
-            f_redirect.write(
-                "A\t" + f"{src_path}\t" + "Image Redirection\t" + f"{dst_path}\n"
-            )
+        REDIRECTS.add(src_path, "Image Redirection", dst_path)
+        if IMAGE_CACHE is not None:
+            IMAGE_CACHE.record_target(url, dst_path[2:])
         print(f"Successfully wrote redirection from {src_path} to {dst_path}")
         return True
     return False
@@ -1073,6 +1341,10 @@ def handle_duplicate_images(url, fullpath, convert_png, resize):
 def download_image(
     url, fullpath, convert_png=False, resize=False, skip_duplicate_check=False
 ):
+    """download, convert and optimize url into fullpath
+
+    returns a dict of the final file type and the response validators
+    (etag, last_modified) or None if not downloaded (duplicate)"""
     downloaded = False
     key = None
     meta_tag = None
@@ -1083,7 +1355,7 @@ def download_image(
         url, fullpath, convert_png, resize
     ):
         # processed as a potential duplicate
-        return
+        return None
     print(url + " > To be saved as " + os.path.basename(fullpath))
     if CACHE_STORAGE_URL:
         meta_tag, meta_val = get_meta_from_url(url)
@@ -1093,14 +1365,19 @@ def download_image(
             key = f"{src_url.netloc}/{urllib.parse.quote_plus(src_url.geturl()[len(prefix):])}"
             # Key looks similar to ww2.someplace.state.gov/data%2F%C3%A9t%C3%A9%2Fsome+chars%2Fimage.jpeg%3Fv%3D122%26from%3Dxxx%23yes
             downloaded = download_from_cache(key, fullpath, meta_tag, meta_val)
+            if downloaded and not skip_duplicate_check:
+                dedup_image(url, fullpath, fullpath)
+    info = {"ftype": None, "etag": None, "last_modified": None}
     if not downloaded:
         tmp_img = None
         print(os.path.basename(fullpath) + " > Downloading from URL")
         try:
             tmp_img = get_tempfile(os.path.basename(fullpath))
-            save_large_file(url, tmp_img)
+            headers = downloader.fetch_to_file(url, tmp_img)
+            info["etag"] = headers.get("etag")
+            info["last_modified"] = headers.get("last-modified")
             print(os.path.basename(fullpath) + " > Successfully downloaded from URL")
-        except subprocess.CalledProcessError as e:
+        except Exception as e:
             os.unlink(tmp_img)
             print(
                 os.path.basename(fullpath)
@@ -1114,25 +1391,155 @@ def download_image(
             if ext == "none":
                 os.unlink(tmp_img)
                 raise Exception(f"{os.path.basename(fullpath)} > Not an image")
+            store = functools.partial(
+                store_image,
+                url,
+                tmp_img,
+                fullpath,
+                key,
+                meta_tag,
+                meta_val,
+                dedup=not skip_duplicate_check,
+            )
             try:
                 if convert_png and ext != "png":
                     convert_to_png(tmp_img, ext)
                     ext = "png"
-                if resize and ext != "gif":
-                    resize_one(tmp_img, ext, str(resize))
-                check_and_optimize(tmp_img, ext)
-                if CACHE_STORAGE_URL and meta_tag and meta_val:
-                    print(os.path.basename(fullpath) + " > Uploading to cache")
-                    upload_to_cache(tmp_img, key, meta_tag, meta_val)
+                info["ftype"] = ext
+                if ext == "gif" and GIF_BATCH is not None:
+                    # optimized along with other GIFs, stored afterwards
+                    GIF_BATCH.add(tmp_img, store)
+                    return info
+                if ext == "gif":
+                    imageopt.optimize_gifs([tmp_img])
+                elif ext in ("png", "jpeg"):
+                    store = functools.partial(
+                        store, data=imageopt.process(tmp_img, ext, resize)
+                    )
             except Exception as exc:
                 print(f"{os.path.basename(fullpath)} {exc}")
-            finally:
-                shutil.move(tmp_img, fullpath)
-                print(f"Moved {tmp_img} to {fullpath}")
+            store()
+    return info
+
+
+def store_image(
+    url,
+    tmp_img,
+    fullpath,
+    key=None,
+    meta_tag=None,
+    meta_val=None,
+    dedup=True,
+    data=None,
+):
+    """upload optimized tmp_img to the optimization cache (if any), move to fullpath
+
+    unless an identical image is already stored (dedup). data is the
+    content of tmp_img if known"""
+    try:
+        if CACHE_STORAGE_URL and meta_tag and meta_val:
+            print(os.path.basename(fullpath) + " > Uploading to cache")
+            upload_to_cache(tmp_img, key, meta_tag, meta_val)
+    except Exception as exc:
+        print(f"{os.path.basename(fullpath)} {exc}")
+    finally:
+        if not dedup or not dedup_image(url, tmp_img, fullpath, data):
+            shutil.move(tmp_img, fullpath)
+            print(f"Moved {tmp_img} to {fullpath}")
+
+
+def dedup_image(url, fpath, fullpath, data=None):
+    """redirect fullpath to an identical image already stored (if any)
+
+    fpath holds the final image for fullpath and is removed if a duplicate.
+    returns whether it was a duplicate"""
+    if IMAGE_CACHE is None:
+        return False
+    if data is None:
+        with open(fpath, "rb") as fh:
+            data = fh.read()
+    owner = IMAGE_CACHE.claim_content(sha256(data).hexdigest(), fullpath, len(data))
+    if owner == fullpath:
+        return False
+    os.unlink(fpath)
+    src_path = zim_path(fullpath)
+    dst_path = zim_path(owner)
+    REDIRECTS.add(src_path, "Image Redirection", f"A/{dst_path}")
+    IMAGE_CACHE.record_target(url, dst_path)
+    print(f"{os.path.basename(fullpath)} > Same content as {dst_path}")
+    return True
+
+
+def image_service_init():
+    """set up the download service process"""
+    global GIF_BATCH
+    GIF_BATCH = imageopt.GifBatch()
+
 
+def image_service_done():
+    """complete pending work of the download service process"""
+    GIF_BATCH.flush()
+    imageopt.TIMINGS.report()
 
-def interne_link(text_post, domain, nouserprofile, noexternallink):
+
+def rewrite_html(text_post, domain, nouserprofile, noexternallink, nopic):
+    """text_post with its links and images rewritten for offline use
+
+    text_post is parsed and serialized at most once for both rewrites
+    and not at all if it holds neither link nor image (most comments)"""
+    has_links = "<a" in text_post or "<A" in text_post
+    has_imgs = "<img" in text_post or "<IMG" in text_post
+    if not has_links and not has_imgs:
+        return text_post
     body = string2html(text_post)
+    modified = False
+    if has_links:
+        modified |= interne_link(body, domain, nouserprofile, noexternallink)
+    if has_imgs:
+        modified |= image(body, nopic)
+    # does the post contain links or images? if so, we surely modified
+    # its content so save it.
+    if modified:
+        text_post = html2string(body, method="html", encoding="unicode")
+    return text_post
+
+
+def fetch_image(url, fullpath, fallback=None, **options):
+    """download_image run by the download service
+
+    On failure, fullpath is redirected to fallback (if any) as pages
+    were rendered pointing to fullpath already"""
+    host = urllib.parse.urlparse(url).netloc
+    start = time.perf_counter()
+    try:
+        info = download_image(url, fullpath, **options)
+    except Exception as exc:
+        metrics.count("image_fetch_failures", host=host)
+        print(f"{url} > Failed to download\n{exc}\n")
+        if IMAGE_CACHE is not None:
+            IMAGE_CACHE.record_failure(url)
+        if fallback:
+            REDIRECTS.add(zim_path(fullpath), "Image Redirection", f"A/{fallback}")
+    else:
+        info = info or {}
+        metrics.observe(
+            "image_fetch_seconds",
+            time.perf_counter() - start,
+            host=host,
+            type=info.get("ftype") or "none",
+        )
+        if IMAGE_CACHE is not None:
+            IMAGE_CACHE.record_success(
+                url,
+                ftype=info.get("ftype"),
+                size=os.path.getsize(fullpath) if os.path.exists(fullpath) else 0,
+                etag=info.get("etag"),
+                last_modified=info.get("last_modified"),
+            )
+
+
+def interne_link(body, domain, nouserprofile, noexternallink):
+    """rewrite links of parsed body in place, returns whether it has any"""
     links = body.xpath("//a")
     for a in links:
         if "href" in a.attrib:
@@ -1194,15 +1601,11 @@ def interne_link(text_post, domain, nouserprofile, noexternallink):
                     a.attrib.pop("href")
                 else:
                     a.attrib["href"] = f"http://{domain}/{link}"
+    return bool(links)
 
-    if links:
-        text_post = html2string(body, method="html", encoding="unicode")
-    return text_post
 
-
-def image(text_post, nopic):
-    images = os.path.join(output_dir, "static", "images")
-    body = string2html(text_post)
+def image(body, nopic):
+    """rewrite (and fetch) images of parsed body in place, returns whether it has any"""
     imgs = body.xpath("//img")
     for img in imgs:
         if nopic:
@@ -1211,28 +1614,51 @@ def image(text_post, nopic):
             src = img.attrib["src"]
             ext = os.path.splitext(src.split("?")[0])[1]
             filename = sha256(src.encode("utf-8")).hexdigest() + ext
-            out = os.path.join(images, filename)
+            out = output_path(os.path.join("static", "images", filename))
+            # known results from the image cache spare a filesystem check
+            status, target = (
+                IMAGE_CACHE.lookup(src) if IMAGE_CACHE is not None else (None, None)
+            )
+            if status == "failed":
+                img.attrib["src"] = "../static/images/../../favicon.png"
+                continue
+            if target:
+                # identical to another image, see dedup_image
+                REDIRECTS.add(zim_path(out), "Image Redirection", f"A/{target}")
             # download the image only if it's not already downloaded and if it's not a html
-            if not os.path.exists(out) and ext != ".html":
-                try:
-                    download_image(src, out, resize=540)
-                except Exception as e:
-                    # do nothing
-                    img.attrib["src"] = "../static/images/../../favicon.png"
-                    print(e)
+            if status != "ok" and not os.path.exists(out) and ext != ".html":
+                layout.ensure_dir(out)
+                if IMAGE_SERVICE is not None:
+                    # fetched in background, redirected to favicon if it fails
+                    IMAGE_SERVICE.submit(
+                        src, out, fallback="favicon.png", resize=540
+                    )
                 else:
-                    src = "../static/images/" + filename
-                    img.attrib["src"] = src
-                    img.attrib["style"] = "max-width:100%"
-            else:
-                src = "../static/images/" + filename
-                img.attrib["src"] = src
-                img.attrib["style"] = "max-width:100%"
-    # does the post contain images? if so, we surely modified
-    # its content so save it.
-    if imgs:
-        text_post = html2string(body, method="html", encoding="unicode")
-    return text_post
+                    try:
+                        download_image(src, out, resize=540)
+                    except Exception as e:
+                        # do nothing
+                        img.attrib["src"] = "../static/images/../../favicon.png"
+                        print(e)
+                        continue
+            src = "../static/images/" + filename
+            img.attrib["src"] = src
+            img.attrib["style"] = "max-width:100%"
+    return bool(imgs)
+
+
+def restore_image_redirections():
+    """redirections of post images known to the image cache
+
+    written by the processes of an interrupted run as downloads completed,
+    those still buffered were lost with it"""
+    for url, status, target in IMAGE_CACHE.redirections():
+        ext = os.path.splitext(url.split("?")[0])[1]
+        REDIRECTS.add(
+            "static/images/" + sha256(url.encode("utf-8")).hexdigest() + ext,
+            "Image Redirection",
+            f"A/{target}" if target else "A/favicon.png",
+        )
 
 
 def grab_title_description_favicon_lang(url, do_old):
@@ -1331,63 +1757,13 @@ def dict_to_unicodedict(dictionnary):
     return dict_
 
 
-def prepare(dump_path, bin_dir):
-    cmd = "bash " + bin_dir + "prepare_xml.sh " + dump_path + " " + bin_dir
-    if exec_cmd(cmd) == 0:
-        print("Prepare xml ok")
-    else:
+def prepare(dump_path, keep_xml):
+    try:
+        prepare_dump(dump_path, keep_xml=keep_xml)
+    except Exception as exc:
+        print(exc)
         sys.exit("Unable to prepare xml :(")
-
-
-def check_and_optimize(path, ftype):
-    if not (path.endswith(f".{ftype}") or (path.endswith(".jpg") and ftype == "jpeg")):
-        print(
-            f"{os.path.basename(path)} > Extension doesn't match detected file type. Creating temp copy with proper extension to optimize"
-        )
-        tmp_path = create_temporary_copy(path, suffix=f".{ftype}")
-        optimize_one(tmp_path, ftype)
-        print(
-            f"{os.path.basename(path)} > Copying data from temporary copy to original filepath"
-        )
-        shutil.copy2(tmp_path, path)
-        os.unlink(tmp_path)
-    else:
-        optimize_one(path, ftype)
-
-
-def optimize_one(path, ftype):
-    if ftype == "jpeg":
-        ret = exec_cmd("jpegoptim --strip-all -m50 " + path, timeout=20)
-        if ret != 0:
-            raise Exception("> jpegoptim failed for " + str(path))
-    elif ftype == "png":
-        ret = exec_cmd(
-            "pngquant --verbose --nofs --force --ext=.png " + path, timeout=20
-        )
-        if ret != 0:
-            raise Exception("> pngquant failed for " + str(path))
-        ret = exec_cmd("advdef -q -z -4 -i 5  " + path, timeout=60)
-        if ret != 0:
-            raise Exception("> advdef failed for " + str(path))
-    elif ftype == "gif":
-        ret = exec_cmd("gifsicle --batch -O3 -i " + path, timeout=20)
-        if ret != 0:
-            raise Exception("> gifscale failed for " + str(path))
-
-
-def resize_one(path, ftype, nb_pix):
-    if ftype == "gif":
-        ret = exec_cmd("mogrify -resize " + nb_pix + r"x\> " + path, timeout=20)
-        if ret != 0:
-            raise Exception("> mogrify -resize failed for GIF " + str(path))
-    elif ftype in ["png", "jpeg"]:
-        try:
-            im = Image.open(path)
-            ratio = float(nb_pix) / float(im.size[0])
-            hsize = int(float(im.size[1]) * ratio)
-            im.resize((int(nb_pix), hsize)).save(path, ftype)
-        except (KeyError, IOError) as e:
-            raise Exception("> Pillow failed to resize\n" + e)
+    print("Prepare xml ok")
 
 
 def create_temporary_copy(path, suffix=None):
@@ -1415,41 +1791,15 @@ def convert_to_png(path, ext):
             raise Exception("> Pillow failed to convert to PNG\n" + e)
 
 
-def get_hash(site_name):
-    digest = None
-    sha1hash_url = "https://archive.org/download/stackexchange/stackexchange_files.xml"
-    output = urlopen(sha1hash_url).read()
-    tree = etree.fromstring(output)
-    for file in tree.xpath("/files/file"):
-        if file.get("name") == site_name + ".7z":
-            print("found")
-            digest = file.xpath("sha1")[0].text
-    if digest is None:
-        print("File :" + site_name + ".7z no found")
-        sys.exit(1)
-    return digest
-
-
-def download_dump(domain, dump_path):
-    url_dump = "https://archive.org/download/stackexchange/" + domain + ".7z"
-    digest = get_hash(domain)
-    f = open(domain + ".hash", "w")
-    f.write(digest + " " + domain + ".7z")
-    f.close()
-    exec_cmd("wget " + url_dump)
-    if exec_cmd("sha1sum -c " + domain + ".hash") == 0:
-        print("Ok we have get dump")
-    else:
-        print("KO, error will downloading the dump")
-        os.remove(domain + ".hash")
-        os.remove(domain + ".7z")
-        sys.exit(1)
-    print(
-        "Starting to decompress dump, may take a very long time depending on dump size"
-    )
-    exec_cmd("7z e " + domain + ".7z -o" + dump_path)
-    os.remove(domain + ".hash")
-    os.remove(domain + ".7z")
+def download_dump(names, dump_path, mirror, connections):
+    """download archives names of mirror into dump_path
+
+    archives are kept as is, their files are decompressed while prepared"""
+    try:
+        dumpdownload.download(names, dump_path, mirror=mirror, connections=connections)
+    except dumpdownload.DumpDownloadError as exc:
+        print(exc)
+        sys.exit("Unable to download the dump :(")
 
 
 def languageToAlpha3(lang):
@@ -1457,6 +1807,27 @@ def languageToAlpha3(lang):
     return tab[lang]
 
 
+def start_phase(name):
+    """metrics, profiles and memory peaks from now on are for phase name"""
+    metrics.phase(name)
+    profiling.phase(name)
+    memory.phase(name)
+
+
+def end_phases():
+    """write the last metrics, merged profiles and last memory peak"""
+    metrics.close()
+    profiling.report()
+    memory.close()
+
+
+def persist_progress():
+    """write redirections and manifest entries buffered by this process"""
+    REDIRECTS.flush()
+    if MANIFEST is not None:
+        MANIFEST.flush()
+
+
 def clean(db):
     for elem in ["question", "tag", "user"]:
         elem_path = os.path.join(output_dir, elem)
@@ -1470,9 +1841,71 @@ def clean(db):
     if os.path.exists(db):
         print("remove " + db)
         os.remove(db)
-    if os.path.exists(redirect_file):
-        print("remove " + redirect_file)
-        os.remove(redirect_file)
+    if REDIRECTS.exists():
+        print("remove " + REDIRECTS.path)
+        REDIRECTS.remove()
+    manifest = os.path.join(os.path.dirname(db), "manifest.db")
+    if os.path.exists(manifest):
+        print("remove " + manifest)
+        os.remove(manifest)
+    checkpoint = os.path.join(os.path.dirname(db), "checkpoint.db")
+    if os.path.exists(checkpoint):
+        print("remove " + checkpoint)
+        os.remove(checkpoint)
+
+
+def read_layout(dump):
+    """layout of the output tree of dump directory (flat if not recorded)"""
+    fpath = os.path.join(dump, "layout")
+    if not os.path.exists(fpath):
+        return "flat"
+    with open(fpath) as fh:
+        return fh.read().strip()
+
+
+def check_layout(dump, sharded):
+    """record the layout of the output tree
+
+    exits if files kept from a previous run use another layout"""
+    layout.setup(sharded)
+    fpath = os.path.join(dump, "layout")
+    previous = read_layout(dump)
+    current = "sharded" if sharded else "flat"
+    if previous != current:
+        for directory in layout.SHARDED_DIRS:
+            path = os.path.join(output_dir, directory)
+            if os.path.isdir(path):
+                with os.scandir(path) as entries:
+                    if next(entries, None) is not None:
+                        sys.exit(
+                            f"Files of the output tree use the {previous} layout, "
+                            "use the same layout or remove them with --reset-images"
+                        )
+    with open(fpath, "w") as fh:
+        fh.write(current)
+
+
+def reuse_images(previous_dump):
+    """link the images of the output tree of another dump directory into ours
+
+    so they are not downloaded again"""
+    sharded = read_layout(previous_dump) == "sharded"
+    for directory in (
+        os.path.join("static", "images"),
+        os.path.join("static", "identicon"),
+    ):
+        source = os.path.join(previous_dump, "output", directory)
+        if not os.path.isdir(source):
+            continue
+
+        def path_func(path, directory=directory):
+            zim = layout.zim_path(os.path.join(directory, path), sharded)
+            return os.path.relpath(layout.disk_path(zim), directory)
+
+        counts = storage.link_tree(
+            source, os.path.join(output_dir, directory), path_func
+        )
+        print(f"Images reused from {source}: {storage.summary(counts)}")
 
 
 def data_from_previous_run(db):
@@ -1484,7 +1917,7 @@ def data_from_previous_run(db):
         os.path.exists(os.path.join(output_dir, "favicon.png"))
         or os.path.exists(os.path.join(output_dir, "index"))
         or os.path.exists(db)
-        or os.path.exists(redirect_file)
+        or REDIRECTS.exists()
     ):
         return True
     return False
@@ -1524,18 +1957,10 @@ def cache_credentials_ok(cache_storage_url):
 #########################
 
 
-def create_zims(
-    title,
-    publisher,
-    description,
-    domain,
-    lang_input,
-    zim_path,
-    noindex,
-    nopic,
-    scraper_version,
-):
-    print("Creating ZIM files")
+def start_zim(domain, lang_input, zim_path, noindex, nopic, nb_workers, cluster_size):
+    """start the ZimSink process rendered pages are sent to, returns the ZIM's name
+
+    forked before any renderer, from a process without libzim threads"""
     if zim_path is None:
         zim_path = dict(
             title=domain.lower(),
@@ -1555,95 +1980,57 @@ def create_zims(
         name = "kiwix." + domain.lower() + ".nopic"
     else:
         name = "kiwix." + domain.lower()
-    creator = title
-    return create_zim(
+
+    global ZIM
+    ZIM = ZimSink(
         zim_path,
-        title,
-        description,
         languageToAlpha3(lang_input),
-        publisher,
-        creator,
-        noindex,
-        name,
-        nopic,
-        scraper_version,
-        domain,
+        indexing=not noindex,
+        nb_workers=nb_workers,
+        cluster_size=cluster_size,
     )
+    ZIM.start()
+    return name
 
 
 def create_zim(
-    zim_path,
-    title,
-    description,
-    lang_input,
-    publisher,
-    creator,
-    noindex,
-    name,
-    nopic,
-    scraper_version,
-    domain,
+    title, description, lang_input, publisher, name, nopic, scraper_version, domain,
 ):
+    """add files, redirections and metadata to the started ZIM and write it"""
     print("\tWriting ZIM for {}".format(title))
-
-    if nopic:
-        tmpfile = tempfile.mkdtemp()
-        shutil.move(
-            os.path.join(output_dir, "static", "images"),
-            os.path.join(tmpfile, "images"),
-        )
-        shutil.move(
-            os.path.join(output_dir, "static", "identicon"),
-            os.path.join(tmpfile, "identicon"),
-        )
-
+    tags = ["_category:stack_exchange", "stackexchange"] + (["nopic"] if nopic else [])
     try:
-        make_zim_file(
-            build_dir=pathlib.Path(output_dir),
-            fpath=pathlib.Path(zim_path),
-            name=name,
-            main_page="index",
-            favicon="favicon.png",
-            title=title,
-            description=description,
-            language=lang_input,
-            creator=creator,
-            publisher=publisher,
-            tags=["_category:stack_exchange", "stackexchange"]
-            + (["nopic"] if nopic else []),
-            scraper=scraper_version,
-            source=f"https://{domain}",
-            redirects_file=pathlib.Path(redirect_file),
-            without_fulltext_index=True if noindex else False,
-            flavour="nopic" if nopic else None,
+        ZIM.finish(
+            output_dir,
+            REDIRECTS.path,
+            main_path="index.html",
+            favicon=os.path.join(output_dir, "favicon.png"),
+            metadata={
+                "Name": name,
+                "Title": title,
+                "Description": description,
+                "Language": languageToAlpha3(lang_input),
+                "Creator": title,
+                "Publisher": publisher,
+                "Tags": ";".join(tags),
+                "Scraper": scraper_version,
+                "Source": f"https://{domain}",
+                "Flavour": "nopic" if nopic else None,
+            },
+            # nopic ZIMs don't include (previously) downloaded images
+            exclude=(
+                os.path.join("static", "images"),
+                os.path.join("static", "identicon"),
+            )
+            if nopic
+            else (),
         )
     except Exception as exc:
         print("Unable to create ZIM file :(")
         print(exc)
-        if nopic:
-            shutil.move(
-                os.path.join(tmpfile, "images"),
-                os.path.join(output_dir, "static", "images"),
-            )
-            shutil.move(
-                os.path.join(tmpfile, "identicon"),
-                os.path.join(output_dir, "static", "identicon"),
-            )
-            shutil.rmtree(tmpfile)
         return False
-    else:
-        print("Successfuly created ZIM file at {}".format(zim_path))
-        if nopic:
-            shutil.move(
-                os.path.join(tmpfile, "images"),
-                os.path.join(output_dir, "static", "images"),
-            )
-            shutil.move(
-                os.path.join(tmpfile, "identicon"),
-                os.path.join(output_dir, "static", "identicon"),
-            )
-            shutil.rmtree(tmpfile)
-        return True
+    print("Successfuly created ZIM file at {}".format(ZIM.fpath))
+    return True
 
 
 def run():
@@ -1666,23 +2053,16 @@ def run():
         CACHE_STORAGE_URL = arguments["--optimization-cache"]
     else:
         print("No cache credentials provided. Continuing without optimization cache")
+    if arguments["--shared-images"]:
+        global SHARED_IMAGES
+        SHARED_IMAGES = os.path.abspath(arguments["--shared-images"])
+        os.makedirs(SHARED_IMAGES, exist_ok=True)
 
     # Check binary
     for binary in [
-        "bash",
-        "jpegoptim",
-        "pngquant",
-        "advdef",
         "gifsicle",
-        "mogrify",
         "gif2apng",
-        "wget",
-        "sha1sum",
         "7z",
-        "sed",
-        "sort",
-        "rm",
-        "grep",
     ]:
         if not bin_is_present(binary):
             sys.exit(binary + " is not available, please install it.")
@@ -1707,8 +2087,8 @@ def run():
     global output_dir
     output_dir = os.path.join(dump, "output")
     db = os.path.join(dump, "se-dump.db")
-    global redirect_file
-    redirect_file = os.path.join(dump, "redirection.csv")
+    global REDIRECTS
+    REDIRECTS = RedirectSink(os.path.join(dump, "redirection.csv"))
 
     # set ImageMagick's temp folder via env
     magick_tmp = os.path.join(dump, "magick")
@@ -1722,6 +2102,17 @@ def run():
     else:
         cores = cpu_count() / 2 or 1
 
+    shards = int(arguments["--shards"])
+    if shards <= 0:
+        sys.exit("--shards should be a positive integer")
+
+    queue_depth = int(arguments["--queue-depth"])
+    if queue_depth <= 0:
+        sys.exit("--queue-depth should be a positive integer")
+
+    if int(arguments["--download-connections"]) <= 0:
+        sys.exit("--download-connections should be a positive integer")
+
     if arguments["--reset"]:
         if os.path.exists(dump):
             for elem in [
@@ -1739,16 +2130,32 @@ def run():
                 elem_path = os.path.join(dump, elem)
                 if os.path.exists(elem_path):
                     os.remove(elem_path)
+            for elem in os.listdir(dump):
+                if elem.endswith(".7z"):
+                    os.remove(os.path.join(dump, elem))
         arguments["--directory"] = "download"
 
     if arguments["--reset-images"]:
         if os.path.exists(os.path.join(dump, "output")):
             shutil.rmtree(os.path.join(dump, "output"))
+        if os.path.exists(os.path.join(dump, "images.db")):
+            os.remove(os.path.join(dump, "images.db"))
 
     if arguments["--clean-previous"]:
         clean(db)
 
-    if data_from_previous_run(db):
+    incremental = arguments["--incremental"]
+    resume = arguments["--resume"]
+    if resume:
+        # database, pages and redirections of the interrupted run are reused
+        pass
+    elif incremental:
+        # pages of the previous run are kept, the database is rebuilt
+        if os.path.exists(db):
+            os.remove(db)
+        # image redirections are only written when pages are rendered
+        REDIRECTS.carry_over(("static/",))
+    elif data_from_previous_run(db):
         sys.exit(
             "There is still data from a previous run, you can trash them by adding --clean-previous as argument"
         )
@@ -1761,49 +2168,62 @@ def run():
         os.makedirs(os.path.join(output_dir, "common_images"))
     if not os.path.exists(os.path.join(output_dir, "static", "images")):
         os.makedirs(os.path.join(output_dir, "static", "images"))
+    check_layout(dump, arguments["--sharded-layout"])
+    if arguments["--reuse-images"]:
+        reuse_images(arguments["--reuse-images"])
+
+    global CHECKPOINT
+    CHECKPOINT = Checkpoint(os.path.join(dump, "checkpoint.db"))
+    if not resume:
+        CHECKPOINT.reset()
+    elif CHECKPOINT.done("static" if arguments["--nozim"] else "zim"):
+        print("Previous run completed, nothing to resume")
+        return 0
+    elif not arguments["--nozim"] and not incremental:
+        print("Pages of the interrupted run were in its unfinished ZIM, rendering all")
+        CHECKPOINT.reset(keep=("prepare",))
+    metrics.setup(
+        os.path.join(dump, "metrics.jsonl"),
+        interval=int(arguments["--metrics-interval"]),
+        port=int(arguments["--metrics-port"]) if arguments["--metrics-port"] else None,
+        append=resume,
+    )
+    if arguments["--profile"]:
+        profiling.setup(arguments["--profile"], memory=arguments["--profile-memory"])
+    if arguments["--memory-budget"]:
+        budget = memory.parse_size(arguments["--memory-budget"])
+        memory.setup(budget, os.path.join(dump, "tmp"))
+        # a few sorters fill up at once while preparing
+        prepare_xml.RUN_BYTES = budget // 16
 
     title, description, lang_input = grab_title_description_favicon_lang(
         url, not arguments["--ignoreoldsite"]
     )
 
-    if not os.path.exists(
-        os.path.join(dump, "Posts.xml")
-    ):  # If dump is not here, download it
+    if not DumpFiles(dump).exists("Posts.xml"):  # If dump is not here, download it
+        start_phase("download")
         if domain == "stackoverflow.com":
-            for part in [
-                "stackoverflow.com-Badges",
-                "stackoverflow.com-Comments",
-                "stackoverflow.com-PostLinks",
-                "stackoverflow.com-Posts",
-                "stackoverflow.com-Tags",
-                "stackoverflow.com-Users",
-            ]:
-                dump_tmp = os.path.join("work", re.sub(r"\.", "_", part))
-                os.makedirs(dump_tmp)
-                download_dump(part, dump_tmp)
-            for path in [
-                os.path.join("work", "stackoverflow_com-Badges", "Badges.xml"),
-                os.path.join("work", "stackoverflow_com-Comments", "Comments.xml"),
-                os.path.join("work", "stackoverflow_com-PostLinks", "PostLinks.xml"),
-                os.path.join("work", "stackoverflow_com-Posts", "Posts.xml"),
-                os.path.join("work", "stackoverflow_com-Tags", "Tags.xml"),
-                os.path.join("work", "stackoverflow_com-Users", "Users.xml"),
-            ]:
-                filename = os.path.basename(path)
-                os.rename(path, os.path.join(dump, filename))
-                shutil.rmtree(os.path.dirname(path))
+            names = [
+                "stackoverflow.com-" + part + ".7z"
+                for part in ["Badges", "Comments", "PostLinks", "Posts", "Tags", "Users"]
+            ]
         else:
-            download_dump(domain, dump)
+            names = [domain + ".7z"]
+        download_dump(
+            names,
+            dump,
+            arguments["--dump-mirror"].rstrip("/"),
+            int(arguments["--download-connections"]),
+        )
 
     templates = os.path.join(os.path.abspath(os.path.dirname(__file__)), "templates")
 
     # prepare db
-    conn = sqlite3.connect(db)  # can be :memory: for small dump
+    conn = open_db(db)
     conn.row_factory = dict_factory
     cursor = conn.cursor()
     # create table tags-questions
-    sql = "CREATE TABLE IF NOT EXISTS questiontag(id INTEGER PRIMARY KEY AUTOINCREMENT UNIQUE, Score INTEGER, Title TEXT, QId INTEGER, CreationDate TEXT, Tag TEXT)"
-    cursor.execute(sql)
+    cursor.execute(QUESTIONTAG_SCHEMA)
     # creater user table
     sql = "CREATE TABLE IF NOT EXISTS users(id INTEGER PRIMARY KEY UNIQUE, DisplayName TEXT, Reputation TEXT)"
     cursor.execute(sql)
@@ -1812,109 +2232,232 @@ def run():
     cursor.execute(sql)
     conn.commit()
 
-    jinja_init(templates)
+    jinja_init(templates, os.path.join(dump, "templates_cache"))
     global MARKDOWN
     renderer = mistune.HTMLRenderer()
     MARKDOWN = mistune.Markdown(renderer, plugins=[plugin_url])
+    start_phase("prepare")
+    if (
+        incremental
+        and os.path.exists(os.path.join(dump, "prepare.xml"))
+        and os.path.getmtime(os.path.join(dump, "prepare.xml"))
+        < DumpFiles(dump).mtime("Posts.xml")
+    ):  # prepared from a previous dump
+        os.remove(os.path.join(dump, "prepare.xml"))
+    if (
+        resume
+        and os.path.exists(os.path.join(dump, "prepare.xml"))
+        and not CHECKPOINT.done("prepare")
+    ):  # interrupted while preparing
+        os.remove(os.path.join(dump, "prepare.xml"))
     if not os.path.exists(
         os.path.join(dump, "prepare.xml")
     ):  # If we haven't already prepare
-        prepare(dump, os.path.abspath(os.path.dirname(__file__)) + "/")
+        with profiling.profiled("prepare"):
+            prepare(dump, arguments["--keep-xml"])
+    if not CHECKPOINT.done("prepare"):
+        CHECKPOINT.complete("prepare")
+
+    if incremental:
+        global MANIFEST
+        MANIFEST = Manifest(
+            os.path.join(dump, "manifest.db"),
+            config=dict(
+                version=scraper_version,
+                templates={
+                    name: open(os.path.join(templates, name)).read()
+                    for name in sorted(os.listdir(templates))
+                },
+                site=[url, title, publisher],
+                options={
+                    option: arguments[option]
+                    for option in [
+                        "--tag-depth",
+                        "--nopic",
+                        "--no-userprofile",
+                        "--no-identicons",
+                        "--no-externallink",
+                        "--no-unansweredquestion",
+                        "--sharded-layout",
+                    ]
+                },
+            ),
+            root=output_dir,
+            resume=resume,
+        )
 
-    # Generate users !
-    parser = make_parser()
-    parser.setContentHandler(
-        UsersRender(
-            templates,
-            title,
-            publisher,
-            dump,
-            cores,
-            cursor,
-            conn,
-            url,
-            use_mathjax(domain),
-            arguments["--nopic"],
-            arguments["--no-identicons"],
-            arguments["--no-userprofile"],
-            arguments["--no-externallink"],
+    # pages are added to the ZIM as they are rendered
+    # (or to the kept output tree with --incremental)
+    if not arguments["--nozim"]:
+        zim_name = start_zim(
             domain,
+            lang_input,
+            arguments["--zimpath"],
+            arguments["--nofulltextindex"],
+            arguments["--nopic"],
+            int(arguments["--zim-workers"]),
+            int(arguments["--zim-cluster-size"]),
         )
-    )
-    parser.parse(os.path.join(dump, "usersbadges.xml"))
-    conn.commit()
+
+    # images are fetched in background while pages are rendered
+    if not arguments["--nopic"]:
+        global IMAGE_CACHE
+        IMAGE_CACHE = ImageCache(os.path.join(dump, "images.db"))
+        global IMAGE_SERVICE
+        IMAGE_SERVICE = DownloadService(
+            fetch_image,
+            initializer=image_service_init,
+            finalizer=image_service_done,
+            threads=int(arguments["--image-threads"]),
+            per_host=int(arguments["--image-host-connections"]),
+            rate=float(arguments["--image-rate"]),
+        )
+        IMAGE_SERVICE.start()
+        if resume and not CHECKPOINT.done("questions"):
+            restore_image_redirections()
+
+    # Generate users !
+    start_phase("users")
+    if CHECKPOINT.done("users"):
+        users = UserDirectory.from_db(cursor)
+        print("Users already rendered, {} loaded".format(len(users)))
+    else:
+        cursor.execute("DELETE FROM users")
+        conn.commit()
+        users = UserDirectory()
+        parser = make_parser()
+        parser.setContentHandler(
+            UsersRender(
+                templates,
+                title,
+                publisher,
+                dump,
+                cores,
+                cursor,
+                conn,
+                users,
+                url,
+                use_mathjax(domain),
+                arguments["--nopic"],
+                arguments["--no-identicons"],
+                arguments["--no-userprofile"],
+                arguments["--no-externallink"],
+                domain,
+                queue_depth=queue_depth,
+            )
+        )
+        with profiling.profiled("parser"):
+            parser.parse(os.path.join(dump, "usersbadges.xml"))
+        conn.commit()
+        persist_progress()
+        CHECKPOINT.complete("users")
 
     # Generate question !
-    parser = make_parser()
-    parser.setContentHandler(
-        QuestionRender(
-            templates,
-            title,
-            publisher,
-            dump,
-            cores,
-            cursor,
-            conn,
-            url,
-            domain,
-            use_mathjax(domain),
-            arguments["--nopic"],
-            arguments["--no-userprofile"],
-            arguments["--no-externallink"],
-            arguments["--no-unansweredquestion"],
+    start_phase("questions")
+    if not CHECKPOINT.done("questions"):
+        question_args = dict(
+            templates=templates,
+            title=title,
+            publisher=publisher,
+            users=users,
+            site_url=url,
+            domain=domain,
+            mathjax=use_mathjax(domain),
+            nopic=arguments["--nopic"],
+            nouserprofile=arguments["--no-userprofile"],
+            noexternallink=arguments["--no-externallink"],
+            no_unansweredquestion=arguments["--no-unansweredquestion"],
+            queue_depth=queue_depth,
+        )
+        if shards > 1:
+            render_question_shards(dump, conn, shards, question_args)
+        else:
+            parser = make_parser()
+            parser.setContentHandler(
+                QuestionRender(
+                    dump=dump, cores=cores, cursor=cursor, conn=conn, **question_args
+                )
+            )
+            with profiling.profiled("parser"):
+                parser.parse(os.path.join(dump, "prepare.xml"))
+            conn.commit()
+        CHECKPOINT.complete("questions")
+
+    if IMAGE_SERVICE is not None:
+        start_phase("images")
+        print("Waiting for image downloads to complete")
+        IMAGE_SERVICE.close()
+        IMAGE_SERVICE = None
+        print("Image cache: {}".format(IMAGE_CACHE.summary()))
+        duplicates, saved = IMAGE_CACHE.dedup_summary()
+        print(
+            "Image deduplication: {} duplicates, {:.1f} MiB saved".format(
+                duplicates, saved / 2 ** 20
+            )
         )
-    )
-    parser.parse(os.path.join(dump, "prepare.xml"))
-    conn.commit()
 
     # Generate tags !
-    parser = make_parser()
-    parser.setContentHandler(
-        TagsRender(
-            templates,
-            title,
-            publisher,
-            dump,
-            cores,
-            cursor,
-            conn,
-            tag_depth,
-            description,
-            use_mathjax(domain),
+    start_phase("tags")
+    if not CHECKPOINT.done("tags"):
+        parser = make_parser()
+        parser.setContentHandler(
+            TagsRender(
+                templates,
+                title,
+                publisher,
+                dump,
+                cores,
+                cursor,
+                conn,
+                tag_depth,
+                description,
+                use_mathjax(domain),
+                queue_depth=queue_depth,
+            )
         )
-    )
-    parser.parse(os.path.join(dump, "Tags.xml"))
+        with profiling.profiled("parser"):
+            parser.parse(os.path.join(dump, "Tags.xml"))
+        persist_progress()
+        CHECKPOINT.complete("tags")
     conn.close()
 
     # remove magick tmp folder (not reusable)
     shutil.rmtree(magick_tmp, ignore_errors=True)
 
-    # copy static
-    if use_mathjax(domain):
-        copy_tree(
-            os.path.join(os.path.abspath(os.path.dirname(__file__)), "static_mathjax"),
-            os.path.join(output_dir, "static"),
-        )
-    copy_tree(
-        os.path.join(os.path.abspath(os.path.dirname(__file__)), "static"),
-        os.path.join(output_dir, "static"),
-    )
-    if not arguments["--nozim"]:
-        done = create_zims(
+    start_phase("static")
+    if not CHECKPOINT.done("static"):
+        # link static (files of static override the ones of static_mathjax)
+        statics = ["static_mathjax", "static"] if use_mathjax(domain) else ["static"]
+        for static in statics:
+            counts = storage.link_tree(
+                os.path.join(os.path.abspath(os.path.dirname(__file__)), static),
+                os.path.join(output_dir, "static"),
+            )
+            print(f"{static}: {storage.summary(counts)}")
+        if MANIFEST is not None:
+            MANIFEST.report(MANIFEST.remove_vanished())
+        REDIRECTS.merge()
+        CHECKPOINT.complete("static")
+    if ZIM is not None:
+        start_phase("zim")
+        done = create_zim(
             title,
-            publisher,
             description,
-            domain,
             lang_input,
-            arguments["--zimpath"],
-            arguments["--nofulltextindex"],
+            publisher,
+            zim_name,
             arguments["--nopic"],
             scraper_version,
+            domain,
         )
         if done:
+            CHECKPOINT.complete("zim")
+        if done and not incremental:
             clean(db)
         if not done:
+            end_phases()
             return 1
+    end_phases()
     return 0
 
 
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+"""Copies sharing the bytes of their source
+
+Files of the output tree which are identical to files elsewhere (static
+assets of the package, common images shared by builds, images of a
+previous run) are reflinked (copy-on-write clone, FICLONE on btrfs, XFS…)
+when the filesystem supports it, hard linked if not (same filesystem) and
+only copied as a last resort. Symbolic links are not used: the output tree
+must stay valid once its sources are gone.
+
+Linked files are never written in place: images are replaced by a rename
+and static assets not at all."""
+
+import os
+import errno
+import shutil
+import threading
+
+try:
+    import fcntl
+except ImportError:  # not on Windows
+    fcntl = None
+
+FICLONE = 0x40049409  # linux/fs.h _IOW(0x94, 9, int)
+METHODS = ("reflink", "hardlink", "copy")
+
+_unsupported = set()  # (source device, destination device) without reflinks
+_lock = threading.Lock()
+
+
+def reflink(src, dst):
+    """clone src to dst, False if not supported between their filesystems"""
+    if fcntl is None:
+        return False
+    devices = (os.stat(src).st_dev, os.stat(os.path.dirname(dst) or ".").st_dev)
+    if devices in _unsupported:
+        return False
+    with open(src, "rb") as source, open(dst, "wb") as target:
+        try:
+            fcntl.ioctl(target.fileno(), FICLONE, source.fileno())
+        except OSError as exc:
+            if exc.errno not in (
+                errno.EOPNOTSUPP,
+                errno.ENOTTY,
+                errno.EXDEV,
+                errno.EINVAL,
+                errno.ENOSYS,
+                errno.EPERM,
+            ):
+                raise
+            failed = True
+        else:
+            failed = False
+    if failed:
+        os.unlink(dst)
+        with _lock:
+            _unsupported.add(devices)
+        return False
+    shutil.copystat(src, dst)
+    return True
+
+
+def same_file(src, dst):
+    """whether dst already holds src (link or copy with the same size and time)"""
+    try:
+        dst_stat = os.stat(dst)
+    except FileNotFoundError:
+        return False
+    src_stat = os.stat(src)
+    return (src_stat.st_dev, src_stat.st_ino) == (dst_stat.st_dev, dst_stat.st_ino) or (
+        src_stat.st_size == dst_stat.st_size
+        and src_stat.st_mtime_ns == dst_stat.st_mtime_ns
+    )
+
+
+def link_file(src, dst):
+    """put a copy of src at dst, sharing its bytes if possible
+
+    returns the method used (see METHODS) or None if dst already held it"""
+    if same_file(src, dst):
+        return None
+    if os.path.lexists(dst):
+        os.unlink(dst)
+    if reflink(src, dst):
+        return "reflink"
+    try:
+        os.link(src, dst)
+        return "hardlink"
+    except OSError:
+        pass
+    shutil.copy2(src, dst)
+    return "copy"
+
+
+def link_tree(src, dst, path_func=None):
+    """link_file all files of src into dst, returns number of files by method
+
+    path_func maps relative paths in src to relative paths in dst"""
+    counts = dict.fromkeys(METHODS + ("unchanged",), 0)
+    created = set()
+    for dirpath, _, filenames in os.walk(src):
+        for filename in filenames:
+            source = os.path.join(dirpath, filename)
+            path = os.path.relpath(source, src)
+            target = os.path.join(dst, path_func(path) if path_func else path)
+            directory = os.path.dirname(target)
+            if directory not in created:
+                os.makedirs(directory, exist_ok=True)
+                created.add(directory)
+            counts[link_file(source, target) or "unchanged"] += 1
+    return counts
+
+
+def summary(counts):
+    return ", ".join(
+        f"{number} {method}" for method, number in counts.items() if number
+    )
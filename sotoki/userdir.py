@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+"""In-memory directory of users' DisplayName and Reputation
+
+Filled while rendering users so that questions, answers and comments
+can resolve their owner without a database round trip."""
+
+import sys
+from array import array
+
+MISSING = -1
+
+
+class UserDirectory:
+    """Compact user id -> (DisplayName, Reputation) lookup table
+
+    slots is a dense array indexed by user id holding the position of the
+    user in names/reputations (MISSING if unknown). Ids are sequential in
+    the dumps so this is both O(1) and small. Names are interned as many
+    users share the same DisplayName. Negative ids (Community is -1) are
+    kept aside."""
+
+    def __init__(self):
+        self.slots = array("i")
+        self.names = []
+        self.reputations = array("i")
+        self.negatives = {}
+
+    def __len__(self):
+        return len(self.names) + len(self.negatives)
+
+    def add(self, user_id, display_name, reputation):
+        user_id = int(user_id)
+        if user_id < 0:
+            self.negatives[user_id] = (sys.intern(display_name), int(reputation))
+            return
+        if user_id >= len(self.slots):
+            grow = max(user_id + 1, len(self.slots) * 2) - len(self.slots)
+            self.slots.extend(array("i", [MISSING]) * grow)
+        self.slots[user_id] = len(self.names)
+        self.names.append(sys.intern(display_name))
+        self.reputations.append(int(reputation))
+
+    def get(self, user_id):
+        """(DisplayName, Reputation) of user_id or None"""
+        if user_id < 0:
+            return self.negatives.get(user_id)
+        if user_id >= len(self.slots):
+            return None
+        slot = self.slots[user_id]
+        if slot == MISSING:
+            return None
+        return self.names[slot], self.reputations[slot]
+
+    @classmethod
+    def from_db(cls, cursor):
+        """directory of the users table (users phase of a resumed build)"""
+        users = cls()
+        for row in cursor.execute("SELECT id, DisplayName, Reputation FROM users"):
+            users.add(row["id"], row["DisplayName"], row["Reputation"])
+        return users
+
+    def memory_usage(self):
+        """approximate size in bytes of the directory"""
+        size = sys.getsizeof(self.slots) + sys.getsizeof(self.reputations)
+        size += sys.getsizeof(self.names) + sys.getsizeof(self.negatives)
+        size += sum(sys.getsizeof(name) for name in set(self.names))
+        return size
+
@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+"""Direct-to-ZIM output
+
+Rendered pages are sent (from any process) through a bounded queue to a
+process feeding a libzim Creator, instead of being written to an output
+tree that is crawled back at the end. Files which only exist on disk
+(images, static assets) and redirections are added when finishing."""
+
+import io
+import os
+import re
+import html
+import queue
+import pathlib
+import datetime
+from multiprocessing import Process, Queue
+
+from libzim.writer import Creator, Item, StringProvider, FileProvider, Hint
+from PIL import Image
+from zimscraperlib.filesystem import get_file_mimetype
+
+from . import layout
+from . import metrics
+from . import profiling
+
+QUEUE_SIZE = 1000  # rendered pages waiting to be added
+NB_WORKERS = 4
+CLUSTER_SIZE = 2 * 1024 * 1024
+
+TITLE_LOOKUP_SIZE = 64 * 1024  # <title> is expected in the first bytes
+TITLE_RE = re.compile(r"<title>(.*?)</title>", re.S | re.I)
+
+
+def page_title(page):
+    """content of page's <title>, as zimwriterfs used"""
+    match = TITLE_RE.search(page)
+    if not match:
+        return ""
+    return html.unescape(match.group(1)).strip()
+
+
+class PageItem(Item):
+    def __init__(self, path, page):
+        super().__init__()
+        self.path = path
+        self.page = page
+
+    def get_path(self):
+        return self.path
+
+    def get_title(self):
+        return page_title(self.page)
+
+    def get_mimetype(self):
+        return "text/html"
+
+    def get_contentprovider(self):
+        return StringProvider(self.page)
+
+    def get_hints(self):
+        return {Hint.FRONT_ARTICLE: True}
+
+
+class FileItem(Item):
+    def __init__(self, path, fpath):
+        super().__init__()
+        self.path = path
+        self.fpath = fpath
+        self.mimetype = get_file_mimetype(pathlib.Path(fpath))
+
+    def get_path(self):
+        return self.path
+
+    def get_title(self):
+        # pages kept on disk (incremental runs)
+        if self.mimetype != "text/html":
+            return ""
+        with open(self.fpath, "r", errors="replace") as fh:
+            return page_title(fh.read(TITLE_LOOKUP_SIZE))
+
+    def get_mimetype(self):
+        return self.mimetype
+
+    def get_contentprovider(self):
+        return FileProvider(str(self.fpath))
+
+    def get_hints(self):
+        return {Hint.FRONT_ARTICLE: self.mimetype == "text/html"}
+
+
+class ZimSink(Process):
+    """Process feeding a libzim Creator with pages from all renderer processes
+
+    start() before forking renderers (they inherit the queue), add_page()
+    from anywhere, then finish() once renderers are done. The Creator, its
+    compression threads and the feeding loop only exist in this process,
+    which never forks: renderers are forked from a main process without
+    libzim threads, whatever the phase."""
+
+    def __init__(
+        self,
+        fpath,
+        language,
+        indexing=True,
+        nb_workers=NB_WORKERS,
+        cluster_size=CLUSTER_SIZE,
+        queue_size=QUEUE_SIZE,
+    ):
+        super(ZimSink, self).__init__()
+        self.daemon = True  # not left behind if the build stops early
+        self.fpath = fpath
+        self.language = language
+        self.indexing = indexing
+        self.nb_workers = nb_workers
+        self.cluster_size = cluster_size
+        self.queue = Queue(queue_size)
+        self.results = Queue()
+        self.creator = None
+        self.nb_pages = 0
+        self.nb_failed = 0
+
+    def add_page(self, path, page):
+        self.queue.put((path, page))
+
+    def run(self):
+        # spans rendering phases, written in the zim phase
+        with profiling.profiled("creator", phase="zim"):
+            self._run()
+
+    def _run(self):
+        try:
+            self.creator = (
+                Creator(self.fpath)
+                .config_indexing(self.indexing, self.language)
+                .config_nbworkers(self.nb_workers)
+                .config_clustersize(self.cluster_size)
+            )
+            self.creator.__enter__()
+        except Exception as exc:
+            self.creator = None
+            error = f"Unable to start ZIM creator: {exc}"
+        # pages are consumed even without creator so renderers don't block
+        for path, page in iter(self.queue.get, None):
+            if path is None:  # finish(), page holds its arguments
+                if self.creator is not None:
+                    error = self._finish(**page)
+                self.results.put(error)
+                return
+            if self.creator is not None:
+                self._add(PageItem(path, page))
+                self.nb_pages += 1
+                metrics.count("zim_pages")
+
+    def _add(self, item):
+        try:
+            self.creator.add_item(item)
+        except Exception as exc:
+            self.nb_failed += 1
+            print(f"Unable to add {item.get_path()} to ZIM: {exc}")
+
+    def add_tree(self, root, exclude=()):
+        """add all files under root (but exclude, relative paths) to the ZIM
+
+        at the ZIM path of their on-disk path (see layout)"""
+        for dirpath, dirnames, filenames in os.walk(root):
+            reldir = os.path.relpath(dirpath, root)
+            dirnames[:] = [
+                name
+                for name in dirnames
+                if os.path.normpath(os.path.join(reldir, name)) not in exclude
+            ]
+            for filename in filenames:
+                fpath = os.path.join(dirpath, filename)
+                path = layout.zim_path(os.path.relpath(fpath, root))
+                self._add(FileItem(path, fpath))
+
+    def add_redirects(self, redirects_path):
+        """add entries of a redirection.csv (namespace, path, title, target)"""
+        with open(redirects_path, "r") as fh:
+            for line in fh:
+                _, path, title, target = line.rstrip("\n").split("\t")
+                if target.startswith("A/"):
+                    target = target[2:]
+                try:
+                    self.creator.add_redirection(path, title, target, {})
+                except Exception as exc:
+                    self.nb_failed += 1
+                    print(f"Unable to add redirection {path} to ZIM: {exc}")
+
+    def finish(self, root, redirects_path, main_path, favicon, metadata, exclude=()):
+        """wait for queued pages, add files of root, redirections and metadata
+        then write the ZIM (in the ZIM process)"""
+        self.queue.put(
+            (
+                None,
+                dict(
+                    root=root,
+                    redirects_path=redirects_path,
+                    main_path=main_path,
+                    favicon=favicon,
+                    metadata=metadata,
+                    exclude=exclude,
+                ),
+            )
+        )
+        error = "ZIM process exited unexpectedly"
+        while True:
+            try:
+                error = self.results.get(timeout=1)
+                break
+            except queue.Empty:
+                if not self.is_alive():
+                    break
+        self.join()
+        if error:
+            raise Exception(error)
+
+    def _finish(self, root, redirects_path, main_path, favicon, metadata, exclude):
+        """returns an error message, None if the ZIM was written"""
+        try:
+            self.add_tree(root, exclude)
+            self.add_redirects(redirects_path)
+            self.creator.set_mainpath(main_path)
+            if os.path.exists(favicon):
+                with Image.open(favicon) as im:
+                    buf = io.BytesIO()
+                    im.convert("RGBA").resize((48, 48)).save(buf, "PNG")
+                self.creator.add_illustration(48, buf.getvalue())
+            metadata.setdefault("Date", datetime.date.today().isoformat())
+            for name, value in metadata.items():
+                if value:
+                    self.creator.add_metadata(name, value)
+            self.creator.__exit__(None, None, None)
+        except Exception as exc:
+            return str(exc)
+        print(
+            "ZIM: {} pages added to {} ({} entries failed)".format(
+                self.nb_pages, self.fpath, self.nb_failed
+            )
+        )
+        return None
+
+    def abort(self):
+        if self.is_alive():
+            self.queue.put(None)
+            self.join()
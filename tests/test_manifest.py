@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+import os
+
+import pytest
+
+from sotoki.manifest import Manifest
+
+CONFIG = {"version": "test"}
+PATH = "question/1.html"
+
+
+@pytest.fixture
+def root(tmp_path):
+    os.makedirs(tmp_path / "output" / "question")
+    return tmp_path
+
+
+def open_manifest(root, resume=False):
+    return Manifest(str(root / "manifest.db"), CONFIG, str(root / "output"), resume)
+
+
+def render(root, manifest, content):
+    with open(root / "output" / PATH, "w") as fh:
+        fh.write(content)
+    manifest.rendered(PATH)
+
+
+def build(root, data, interrupted=False, resume=False):
+    """one run seeing PATH with data, returns whether it was rendered"""
+    manifest = open_manifest(root, resume)
+    changed = manifest.changed("question", PATH, data)
+    manifest.flush()  # as persist_progress() or a batch would
+    if changed and not interrupted:
+        render(root, manifest, data)
+        manifest.flush()
+    return changed
+
+
+def test_unchanged_page_not_rendered_again(root):
+    assert build(root, "v1")
+    assert not build(root, "v1")
+
+
+def test_changed_page_rendered(root):
+    build(root, "v1")
+    assert build(root, "v2")
+    assert not build(root, "v2")
+
+
+def test_interrupted_before_rendering(root):
+    build(root, "v1")
+    # seen by the parser, page of v1 still on disk
+    assert build(root, "v2", interrupted=True)
+    assert build(root, "v2")
+    with open(root / "output" / PATH) as fh:
+        assert fh.read() == "v2"
+
+
+def test_resumed_after_interruption(root):
+    build(root, "v1")
+    assert build(root, "v2", interrupted=True)
+    assert build(root, "v2", resume=True)
+    assert not build(root, "v2")
+
+
+def test_rendered_written_before_seen(root):
+    build(root, "v1")
+    # renderer's buffer written before the parser's
+    manifest = open_manifest(root)
+    assert manifest.changed("question", PATH, "v2")
+    updates, manifest._updates = manifest._updates, []
+    render(root, manifest, "v2")
+    manifest.flush()
+    manifest._updates = updates
+    manifest.flush()
+    assert not build(root, "v2")
+
+
+def test_stale_pending_not_promoted(root):
+    build(root, "v1")
+    build(root, "v2", interrupted=True)
+    # v3 rendered but the parser's entry was lost (killed)
+    manifest = open_manifest(root)
+    assert manifest.changed("question", PATH, "v3")
+    manifest._updates = []
+    render(root, manifest, "v3")
+    manifest.flush()
+    assert build(root, "v2")
+
+
+def test_resume_beyond_watermark(root):
+    paths = [f"question/{index}.html" for index in range(4)]
+    manifest = open_manifest(root)
+    for path in paths:
+        assert manifest.changed("question", path, "v1")
+    for path in paths:
+        with open(root / "output" / path, "w") as fh:
+            fh.write("v1")
+        manifest.rendered(path)
+    manifest.flush()
+    # interrupted: all entries written at the watermark, two pages rendered
+    manifest = open_manifest(root)
+    for path in paths:
+        assert manifest.changed("question", path, "v2")
+    for path in paths[:2]:
+        with open(root / "output" / path, "w") as fh:
+            fh.write("v2")
+        manifest.rendered(path)
+    manifest.flush()
+    manifest = open_manifest(root, resume=True)
+    assert [manifest.changed("question", path, "v2") for path in paths] == [
+        False,
+        False,
+        True,
+        True,
+    ]